@@ -0,0 +1,134 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+
+#    http://aws.amazon.com/asl/
+
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+"""Compares the compact tracker codec with the JSON formats it replaced.
+
+Reports encode and decode throughput and the stored bytes per tracker for
+the Redis hash and the DynamoDB item of a typical started tracker.
+"""
+import argparse
+import json
+import time
+from decimal import Decimal
+import arrow
+from boto3.dynamodb.types import Binary
+from progressmonitor import DynamoDbDriver, ProgressMonitor, \
+    ProgressTracker, RedisProgressManager, TrackerBase, codec, to_micros
+
+
+def build_trackers(n):
+    # no metrics: decoding one creates a CloudWatch client, which would hide
+    # the cost of the formats
+    pm = ProgressMonitor(DbConnection=RedisProgressManager(), Name='Root')
+    pm.start()
+    trackers = []
+    for i in xrange(n):
+        t = ProgressTracker(Name='Copy file {}'.format(i),
+                            FriendlyId='copy-{}'.format(i),
+                            EstimatedSeconds=30)
+        pm.with_tracker(t)
+        t.start(StartTime=arrow.utcnow().shift(seconds=-5))
+        trackers.append(t)
+    return trackers
+
+
+def legacy_item(t):
+    """Returns the DynamoDB item written for a tracker before the codec."""
+    i = {}
+    i['Id'] = t.id
+    i['TrackerName'] = t.name
+    if t.estimated_seconds:
+        i['EstimatedSeconds'] = str(t.estimated_seconds)
+    if t.start_time:
+        i['StartTime'] = t.start_time.isoformat()
+    if t.finish_time:
+        i['FinishTime'] = t.finish_time.isoformat()
+    if t.status_msg:
+        i['StatusMessage'] = t.status_msg
+    if t.friendly_id:
+        i['FriendlyId'] = t.friendly_id
+    if t.parent_id:
+        i['ParentId'] = t.parent_id
+    if t.last_update:
+        i['LastUpdate'] = t.last_update.isoformat()
+        i['UpdatedAt'] = to_micros(t._last_update)
+    i['RootId'] = t.root_id
+    if t.source:
+        i['Source'] = t.source
+    if t.metric_namespace:
+        i['MetricNamespace'] = t.metric_namespace
+    if t.status:
+        i['TrackerStatus'] = t.status
+    if t.metric_name:
+        i['MetricName'] = t.metric_name
+    i['InProgress'] = t.is_in_progress
+    i['HasParallelChildren'] = t.has_parallel_children
+    i['IsDone'] = t.is_done
+    i['CurrentProgress'] = t.current_progress
+    i['ProgressTotal'] = t.progress_total
+    i['SubCurrentProgress'] = t.sub_current_progress
+    i['SubProgressTotal'] = t.sub_progress_total
+    return json.loads(json.dumps(i))
+
+
+def redis_bytes(h):
+    return sum([len(str(k)) + len(str(v)) for k, v in h.iteritems()])
+
+
+def dynamodb_bytes(item):
+    # DynamoDB counts attribute names plus the size of each value
+    n = 0
+    for k, v in item.iteritems():
+        n = n + len(k)
+        if isinstance(v, Binary):
+            n = n + len(v.value)
+        elif isinstance(v, bool):
+            n = n + 1
+        elif isinstance(v, (int, long, float, Decimal)):
+            n = n + len(str(v)) // 2 + 1
+        else:
+            n = n + len(unicode(v).encode('utf-8'))
+    return n
+
+
+def timed(label, n, f):
+    start = time.time()
+    result = f()
+    secs = time.time() - start
+    print '{:<32}{:>12,.0f}/s'.format(label, n / secs)
+    return result
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--trackers', type=int, default=20000)
+args = parser.parse_args()
+n = args.trackers
+trackers = build_trackers(n)
+rpm = RedisProgressManager()
+# converting records doesn't need the tables
+ddb = DynamoDbDriver.__new__(DynamoDbDriver)
+
+print 'throughput'
+old = timed('  json encode (to_json)', n,
+            lambda: [t.to_json() for t in trackers])
+timed('  json decode (from_json)', n,
+      lambda: [TrackerBase.from_json(t.id, j) for t, j in zip(trackers, old)])
+new = timed('  codec encode', n, lambda: [codec.encode(t) for t in trackers])
+timed('  codec decode', n,
+      lambda: [rpm.from_json(t.id, {'c': c}) for t, c in zip(trackers, new)])
+
+old_items = [legacy_item(t) for t in trackers]
+new_items = [ddb.to_record(t) for t in trackers]
+print 'bytes per tracker'
+print '  redis json hash       {:>6}'.format(
+    sum([redis_bytes(h) for h in old]) // n)
+print '  redis codec hash      {:>6}'.format(
+    sum([redis_bytes({'c': c, 'lu': 1792316735865877}) for c in new]) // n)
+print '  dynamodb json item    {:>6}'.format(
+    sum([dynamodb_bytes(i) for i in old_items]) // n)
+print '  dynamodb codec item   {:>6}'.format(
+    sum([dynamodb_bytes(i) for i in new_items]) // n)
@@ -0,0 +1,37 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+
+#    http://aws.amazon.com/asl/
+
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+import timeit
+from progressmonitor import DbDriver, ProgressMonitor, ProgressTracker
+
+
+def create_children(t, n, prefix):
+    i = 0
+    while i < n:
+        t.with_tracker(ProgressTracker(FriendlyId='{}-{}'.format(prefix, i)))
+        i = i + 1
+
+
+pm = ProgressMonitor(DbConnection=DbDriver())
+t = ProgressTracker()
+pm.with_tracker(t)
+create_children(t, 100, 'p')
+for c in t.children:
+    create_children(c, 100, c.friendly_id)
+
+ids = [pm.find_friendly_id('p-{}-{}'.format(i, i)).id for i in range(100)]
+fids = ['p-{}-{}'.format(i, 99 - i) for i in range(100)]
+print 'trackers: {}'.format(pm.all_children_count)
+n = 10
+print 'find_id (index):             {:.6f}s'.format(timeit.timeit(
+    lambda: [pm.find_id(i) for i in ids], number=n))
+print 'find_id (search):            {:.6f}s'.format(timeit.timeit(
+    lambda: [pm.search_id(i) for i in ids], number=n))
+print 'find_friendly_id (index):    {:.6f}s'.format(timeit.timeit(
+    lambda: [pm.find_friendly_id(f) for f in fids], number=n))
+print 'find_friendly_id (search):   {:.6f}s'.format(timeit.timeit(
+    lambda: [pm.search_friendly_id(f) for f in fids], number=n))
@@ -0,0 +1,75 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+
+#    http://aws.amazon.com/asl/
+
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+"""Reports how long `import progressmonitor` takes and which modules it
+loads.
+
+Each run imports the package in a fresh interpreter with __import__
+wrapped, much like `python -X importtime` on Python 3, and prints the
+cumulative time of the slowest top level imports. The heavy AWS modules
+are then imported on their own for comparison.
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+PROBE = r'''
+import __builtin__
+import json
+import sys
+import time
+
+real_import = __builtin__.__import__
+times = {}
+depth = [0]
+
+
+def timed_import(name, *args, **kwargs):
+    fresh = name not in sys.modules
+    depth[0] = depth[0] + 1
+    start = time.time()
+    try:
+        return real_import(name, *args, **kwargs)
+    finally:
+        depth[0] = depth[0] - 1
+        if fresh and depth[0] == 1 and name in sys.modules:
+            times[name] = times.get(name, 0) + time.time() - start
+
+__builtin__.__import__ = timed_import
+start = time.time()
+import MODULE
+total = time.time() - start
+__builtin__.__import__ = real_import
+heavy = [m for m in ('boto3', 'botocore', 'fluentmetrics', 'arrow')
+         if m in sys.modules]
+print(json.dumps({'total': total, 'modules': len(sys.modules),
+                  'imports': times, 'heavy': heavy}))
+'''
+
+
+def probe(module):
+    out = subprocess.check_output([sys.executable, '-c',
+                                   PROBE.replace('MODULE', module)])
+    return json.loads(out)
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--runs', type=int, default=5)
+parser.add_argument('--top', type=int, default=10)
+args = parser.parse_args()
+
+for module in ('progressmonitor', 'boto3', 'fluentmetrics', 'arrow'):
+    runs = [probe(module) for i in xrange(args.runs)]
+    best = min(runs, key=lambda r: r['total'])
+    print '{:<16} {:8.1f} ms  {:4} modules  heavy: {}'.format(
+        module, best['total'] * 1000, best['modules'],
+        ', '.join(best['heavy']) or '-')
+    if module == 'progressmonitor':
+        imports = sorted(best['imports'].items(), key=lambda i: -i[1])
+        for name, secs in imports[:args.top]:
+            print '    {:<24} {:8.1f} ms'.format(name, secs * 1000)
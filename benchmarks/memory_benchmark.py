@@ -0,0 +1,44 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+
+#    http://aws.amazon.com/asl/
+
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+"""Reports the memory used per tracker for a 100x100 fan-out tree.
+
+The tree is built in a fresh process and measured by the growth of the
+resident set size, so shared objects (connections, statuses) are counted
+once and per-tracker objects (dicts, lists, names, timestamps) in full.
+The growth is that of the peak resident set size, which stays at zero if
+the peak was reached before the tree was built, so the size before it is
+reported too.
+"""
+import argparse
+import gc
+import resource
+from progressmonitor import DbDriver, ProgressMonitor
+from progressmonitor.helpers.tree_helpers import build_tree
+
+
+def rss_bytes():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--width', type=int, default=100)
+parser.add_argument('--depth', type=int, default=2)
+args = parser.parse_args()
+
+gc.collect()
+before = rss_bytes()
+pm = ProgressMonitor(DbConnection=DbDriver())
+build_tree(pm, args.width, args.depth)
+gc.collect()
+after = rss_bytes()
+n = pm.all_children_count + 1
+print 'trackers:            {}'.format(n)
+print 'rss before tree:     {}'.format(before)
+print 'rss after tree:      {}'.format(after)
+print 'bytes per tracker:   {}'.format((after - before) // n)
@@ -0,0 +1,56 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+
+#    http://aws.amazon.com/asl/
+
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+"""Times flushing 10k dirty trackers to Redis one transaction per tracker
+versus one pipeline for the whole flush.
+
+Uses fakeredis unless --host is given, in which case a real Redis server is
+used and the database is flushed.
+"""
+import argparse
+import timeit
+import fakeredis
+import redis
+from progressmonitor import RedisProgressManager, ProgressMonitor, \
+    ProgressTracker
+
+
+def build_tree(rpm, n):
+    pm = ProgressMonitor(DbConnection=rpm, Name='Root')
+    for i in xrange(n):
+        pm.with_tracker(ProgressTracker(Name='Task {}'.format(i)))
+    return pm
+
+
+def per_tracker_flush(rpm, trackers):
+    for t in trackers:
+        rpm.update_tracker(t)
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--host')
+parser.add_argument('--port', type=int, default=6379)
+parser.add_argument('--trackers', type=int, default=10000)
+parser.add_argument('--chunk-size', type=int, default=None)
+args = parser.parse_args()
+
+if args.host:
+    r = redis.StrictRedis(host=args.host, port=args.port)
+else:
+    r = fakeredis.FakeStrictRedis()
+
+r.flushdb()
+rpm = RedisProgressManager(RedisConnection=r, FlushChunkSize=args.chunk_size)
+pm = build_tree(rpm, args.trackers)
+trackers = pm.index.pop_dirty()
+secs = timeit.timeit(lambda: per_tracker_flush(rpm, trackers), number=1)
+print 'per tracker:  {:.3f}s, {} round trips'.format(secs, rpm.round_trips)
+
+r.flushdb()
+rpm.round_trips = 0
+secs = timeit.timeit(lambda: rpm.update_trackers(trackers), number=1)
+print 'one pipeline: {:.3f}s, {} round trips'.format(secs, rpm.round_trips)
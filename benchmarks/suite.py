@@ -0,0 +1,226 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+
+#    http://aws.amazon.com/asl/
+
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+"""Times building, aggregating, saving and loading tracker trees of several
+shapes against the in-memory, fakeredis and moto DynamoDB drivers.
+
+    PYTHONPATH=. python benchmarks/suite.py --shapes wide,100x100 --output results.json
+    PYTHONPATH=. python benchmarks/suite.py --compare results.json
+
+A shape is one of the names in SHAPES or WIDTHxDEPTH: every tracker has
+WIDTH children, DEPTH levels below the root. Results are printed and, with
+--output, saved as JSON; --compare prints how each timing changed against
+an earlier results file.
+"""
+import argparse
+import json
+import logging
+import platform
+import subprocess
+import sys
+import time
+import fakeredis
+import boto3
+from moto import mock_dynamodb2
+from progressmonitor import DbDriver, ProgressMonitor, MemoryDriver, \
+    RedisProgressManager, DynamoDbDriver, STATUSES
+from progressmonitor.helpers.tree_helpers import build_tree
+
+SHAPES = {
+    'wide': (5000, 1),
+    'deep': (2, 12),
+    '100x100': (100, 2),
+    '1m': (1000, 2),
+}
+DEFAULT_SHAPES = 'wide,deep,100x100'
+# moto and fakeredis are far slower than the stores they stand in for, so
+# big trees are skipped unless --no-limits is given
+DRIVER_LIMITS = {'memory': None, 'fakeredis': 200000, 'moto': 20000}
+PROPERTIES = ['all_children_count'] + \
+    ['{}_{}'.format(s, k) for s in ['not_started', 'in_progress', 'paused',
+                                    'succeeded', 'canceled', 'failed',
+                                    'done'] for k in ['count', 'pct']]
+
+
+def parse_shape(name):
+    if name in SHAPES:
+        return SHAPES[name]
+    width, depth = name.lower().split('x')
+    return int(width), int(depth)
+
+
+def tree_size(width, depth):
+    return sum([width ** d for d in xrange(depth + 1)])
+
+
+def build_monitor(db, width, depth):
+    pm = ProgressMonitor(DbConnection=db, Name='Root', FriendlyId='root')
+    return pm, build_tree(pm, width, depth, friendly=True,
+                          EstimatedSeconds=10)
+
+
+def mix_statuses(pm, leaves):
+    """Starts a quarter of the leaves and finishes another quarter, so the
+    counts have something to count."""
+    pm.start()
+    for n, t in enumerate(leaves):
+        if n % 4 == 1:
+            t.start(Parents=True)
+        elif n % 4 == 2:
+            t.start(Parents=True).succeed()
+    return pm
+
+
+def timed(fn, runs, setup=None):
+    """Returns the best and mean seconds of runs calls of fn. setup is
+    called untimed before each run and its result passed to fn."""
+    times = []
+    for i in xrange(runs):
+        arg = setup() if setup else None
+        start = time.time()
+        fn(arg) if setup else fn()
+        times.append(time.time() - start)
+    return {'best': min(times), 'mean': sum(times) / len(times),
+            'runs': runs}
+
+
+class Drivers(object):
+    """Creates a store of each kind. Trees get new ids, so stores don't
+    have to be empty."""
+    def __init__(self):
+        self.dynamodb = None
+
+    def create(self, name):
+        if name == 'memory':
+            return MemoryDriver()
+        if name == 'fakeredis':
+            r = fakeredis.FakeStrictRedis()
+            r.flushall()
+            return RedisProgressManager(RedisConnection=r)
+        if name == 'moto':
+            # one mock for the whole run, as the driver only creates the
+            # tables once per process
+            if not self.dynamodb:
+                self.dynamodb = mock_dynamodb2()
+                self.dynamodb.start()
+                boto3.setup_default_session(region_name='us-east-1')
+            return DynamoDbDriver(BatchWrites=True)
+        raise Exception('Unknown driver {}'.format(name))
+
+    def close(self):
+        if self.dynamodb:
+            self.dynamodb.stop()
+
+
+def run_shape(name, drivers, args, report):
+    width, depth = parse_shape(name)
+    size = tree_size(width, depth)
+
+    def record(driver, op, result):
+        result.update({'shape': name, 'width': width, 'depth': depth,
+                       'trackers': size, 'driver': driver, 'op': op})
+        report(result)
+
+    record(None, 'build',
+           timed(lambda: build_monitor(DbDriver(), width, depth), 1))
+    pm, leaves = build_monitor(DbDriver(), width, depth)
+    mix_statuses(pm, leaves)
+    for p in PROPERTIES:
+        record(None, p, timed(lambda: getattr(pm, p), args.runs))
+    record(None, 'total_estimate',
+           timed(lambda: pm.total_estimate, args.runs))
+    fids = [t.friendly_id for t in leaves[::max(1, len(leaves) // 100)]]
+    record(None, 'find_friendly_id',
+           timed(lambda: [pm.find_friendly_id(f) for f in fids], args.runs))
+
+    for driver in args.drivers:
+        limit = DRIVER_LIMITS.get(driver)
+        if limit and size > limit and not args.no_limits:
+            print '{:<10} {:<10} skipped, {} trackers is over the limit ' \
+                'of {}'.format(name, driver, size, limit)
+            continue
+        db = drivers.create(driver)
+
+        def dirty_tree():
+            pm, leaves = build_monitor(db, width, depth)
+            return mix_statuses(pm, leaves)
+
+        record(driver, 'update_all',
+               timed(lambda t: t.update_all(), args.runs, dirty_tree))
+        saved = dirty_tree().update_all()
+        record(driver, 'load', timed(
+            lambda: ProgressMonitor(DbConnection=db).load(saved.id),
+            args.runs))
+        record(driver, 'load_depth_1', timed(
+            lambda: ProgressMonitor(DbConnection=db).load(saved.id, Depth=1),
+            args.runs))
+        loaded = ProgressMonitor(DbConnection=db).load(saved.id)
+        record(driver, 'loaded_find_friendly_id', timed(
+            lambda: [loaded.find_friendly_id(f) for f in fids], args.runs))
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result_key(r):
+    return (r['shape'], r['driver'] or '-', r['op'])
+
+
+def compare(old, new):
+    before = dict([(result_key(r), r) for r in old['results']])
+    print '\ncompared with {} ({})'.format(old.get('revision'),
+                                           old.get('started'))
+    for r in new['results']:
+        o = before.get(result_key(r))
+        if o and o['best']:
+            print '{:<10} {:<10} {:<24} {:10.6f}s {:10.6f}s {:6.2f}x'.format(
+                r['shape'], r['driver'] or '-', r['op'], o['best'],
+                r['best'], r['best'] / o['best'])
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--shapes', default=DEFAULT_SHAPES)
+parser.add_argument('--drivers', default='memory,fakeredis,moto')
+parser.add_argument('--runs', type=int, default=3)
+parser.add_argument('--no-limits', action='store_true')
+parser.add_argument('--output')
+parser.add_argument('--compare')
+args = parser.parse_args()
+args.drivers = [d for d in args.drivers.split(',') if d]
+# starting a leaf with Parents=True warns about every started parent
+logging.getLogger().setLevel(logging.ERROR)
+
+results = {'revision': git_revision(), 'started': time.time(),
+           'python': sys.version.split()[0], 'platform': platform.platform(),
+           'statuses': list(STATUSES), 'results': []}
+
+
+def report(r):
+    results['results'].append(r)
+    print '{:<10} {:<10} {:<24} best {:10.6f}s  mean {:10.6f}s'.format(
+        r['shape'], r['driver'] or '-', r['op'], r['best'], r['mean'])
+    sys.stdout.flush()
+
+
+drivers = Drivers()
+try:
+    for name in args.shapes.split(','):
+        run_shape(name, drivers, args, report)
+finally:
+    drivers.close()
+
+if args.output:
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+if args.compare:
+    with open(args.compare) as f:
+        compare(json.load(f), results)
@@ -7,13 +7,39 @@
 # or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
 from __future__ import division
 import uuid
-import arrow
+import bisect
+import random
+import time
+import threading
 import logging
 import json
-import boto3
-from fluentmetrics import FluentMetric
-from helpers.db_helpers import does_table_exist
-from boto3.dynamodb.conditions import Key
+from write_behind import WriteBehindDriver
+from metrics import MetricsBuffer
+from subscriber import ChangeSubscriber
+from instrumentation import DriverInstrumentation
+import codec
+from helpers.redis_helpers import key_slot
+# boto3, fluentmetrics and arrow take a long time to import, so they are
+# only imported by the code that uses them
+
+
+BATCH_GET_SIZE = 100
+BATCH_WRITE_SIZE = 25
+BATCH_MAX_RETRIES = 8
+BATCH_BACKOFF_BASE = .05
+BATCH_BACKOFF_CAP = 5
+# refresh() asks for changes this many seconds older than the newest one it
+# has seen, so writes that were in flight during the last refresh, or stamped
+# by a writer whose clock is behind, aren't missed. Drivers take RefreshOverlap
+# to change it.
+REFRESH_OVERLAP = 1
+# conditional writes that keep losing to other writers give up after this
+# many merges
+CONFLICT_MAX_RETRIES = 20
+CONFLICT_BACKOFF_BASE = .005
+# what a tracker's counted status is until a write has added it to the
+# stored status counts of its ancestors
+NOT_COUNTED = object()
 
 
 class TrackerStats(object):
@@ -22,80 +48,439 @@ class TrackerStats(object):
         self.trackers = kwargs.get('Trackers')
 
 
-class TrackerState(object):
+class EstimateRollup(object):
+    """Cached estimate totals for a tracker and its descendants.
+
+    Remaining time is kept as a constant part plus the deadlines of in
+    progress leaves, so it can be evaluated for any point in time without
+    walking the tree again. Trackers with parallel children can't be folded
+    into a sum, so they are kept aside and evaluated when asked.
+    """
+    def __init__(self, total, static=0, deadlines=None, parallel=None):
+        self.total = total
+        self.static = static
+        self.deadlines = sorted(deadlines or [])
+        self.parallel = parallel or []
+        self.suffix_sums = [0] * (len(self.deadlines) + 1)
+        for i in xrange(len(self.deadlines) - 1, -1, -1):
+            self.suffix_sums[i] = self.suffix_sums[i + 1] + self.deadlines[i]
+
+    def remaining_at(self, now):
+        i = bisect.bisect_right(self.deadlines, now)
+        secs = self.static + self.suffix_sums[i] - \
+            (len(self.deadlines) - i) * now
+        for p in self.parallel:
+            secs = secs + p.remaining_at(now)
+        return secs
+
+
+class TrackerIndex(object):
+    """Live id and friendly id lookup for every tracker in one tree.
+
+    It also holds the trackers that have changes or progress increments not
+    yet written to the DB, and the newest last update refresh() has seen.
+    """
     def __init__(self):
-        self.totals = {}
-        self.is_done = False
-        self.is_failed = False
-        self.is_errored = False
-        self.is_cancelled = False
-        self.is_partially_failed = False
-        self.percent_done = 0
-        self.start_time = None
-        self.finish_time = None
-
-    def start(self, **kwargs):
-        self.is_in_progress = True
-        self.start_time = kwargs.get('StartTime')
-        secs = kwargs.get("EstimatedSeconds", None)
-        if secs:
-            self.estimated_seconds = int(secs)
-        else:
-            self.estimated_seconds = None
+        self.ids = {}
+        self.friendly_ids = {}
+        self.dirty = {}
+        self.pending_progress = {}
+        self.lazy = {}
+        self.synced_at = None
+
+    def with_tree(self, t):
+        stack = [t]
+        while stack:
+            n = stack.pop()
+            n.index = self
+            self.ids[n.id] = n
+            if n.friendly_id:
+                self.friendly_ids.setdefault(n.friendly_id, n)
+            if n.is_dirty:
+                self.dirty[n.id] = n
+            if n.pending_progress or n.pending_progress_total:
+                self.pending_progress[n.id] = n
+            if n.unloaded_child_ids:
+                self.lazy[n.id] = n
+            stack.extend(reversed(n.loaded_children))
+        return self
 
-    def elapsed_time_in_seconds(self):
-        if not self.start_time:
-            return 0
-        if self.finish_time:
-            delta = self.finish_time - self.start_time
-        else:
-            delta = arrow.utcnow() - self.start_time
+    def without_descendants(self, t):
+        """Forgets the descendants of t."""
+        stack = list(t.loaded_children)
+        while stack:
+            n = stack.pop()
+            n.index = None
+            self.ids.pop(n.id, None)
+            if n.friendly_id and self.friendly_ids.get(n.friendly_id) is n:
+                del self.friendly_ids[n.friendly_id]
+            self.dirty.pop(n.id, None)
+            self.pending_progress.pop(n.id, None)
+            self.lazy.pop(n.id, None)
+            stack.extend(n.loaded_children)
+        return self
 
-        return int(round(delta.total_seconds()))
+    def pop_dirty(self):
+        """Returns the dirty trackers, parents first, and empties the set."""
+        dirty = sorted(self.dirty.values(), key=lambda t: t.depth)
+        self.dirty = {}
+        return dirty
+
+    def with_friendly_id(self, t, old):
+        if old and self.friendly_ids.get(old) is t:
+            del self.friendly_ids[old]
+        if t.friendly_id:
+            self.friendly_ids.setdefault(t.friendly_id, t)
+        return self
 
-    def remaining_time_in_seconds(self):
-        if self.estimated_seconds:
-            if self.estimated_seconds > self.elapsed_time_in_seconds:
-                return self.estimated_seconds - self.elapsed_time_in_seconds
-        return None
+    @staticmethod
+    def is_descendant(t, ancestor):
+        p = t.parent
+        while p:
+            if p is ancestor:
+                return True
+            p = p.parent
+        return False
 
 
 class DbDriver(object):
     def __init__(self, **kwargs):
         self.trackers = kwargs.get('Trackers')
+        self.round_trips = 0
+        # seconds a finished workflow is kept; None keeps it forever
+        self.retention_seconds = kwargs.get('RetentionSeconds')
+        self.archive_done = kwargs.get('ArchiveDone', False)
+        # only write a tracker if its stored version is the one it last saw
+        self.conditional_writes = kwargs.get('ConditionalWrites', False)
+        # stored ancestor ids of trackers loaded without their parents
+        self.ancestor_cache = {}
+        self.refresh_overlap = kwargs.get('RefreshOverlap', REFRESH_OVERLAP)
 
     def children_key(self, k):
         return "{}:ch".format(k)
 
+    def get_all_by_id(self, id, depth=None):
+        t = self.get_tree_by_id(id, depth)
+        if t:
+            TrackerIndex().with_tree(t)
+            t.index.synced_at = max([n._last_update
+                                     for n in t.index.ids.itervalues()])
+        return t
+
+    def get_changes(self, root_id, since):
+        """Returns the (id, record, children ids) of every tracker in a tree
+        written at or after since, and the newest last update among them.
+
+        Drivers override this with a change index; by default the whole tree
+        is read again.
+        """
+        changes = []
+        level = [root_id]
+        while level:
+            next_level = []
+            records = self.get_level(level, [root_id] * len(level))
+            for i, (j, children) in zip(level, records):
+                if j:
+                    changes.append((i, j, children))
+                    next_level.extend(children or [])
+            level = next_level
+        return changes, self.now()
+
+    def now(self):
+        """Returns the time writes are stamped with, which orders the change
+        index. By default it's the local clock, so the clocks of all writers
+        have to agree to within refresh_overlap seconds."""
+        return round(time.time(), 6)
+
+    def stamp(self, e):
+        """Sets the last update of a tracker that is about to be written."""
+        e.last_update = self.now()
+        return e
+
+    def get_tree_by_id(self, id, depth=None):
+        """Loads a tracker and its descendants one level at a time.
+
+        Trackers depth levels below it keep only the ids of their children
+        and load them when they're first used. None loads the whole tree.
+        """
+        loaded = self.load_levels([(id, None)], depth)
+        return loaded[0] if loaded else None
+
+    def load_children(self, trackers):
+        """Loads the children of lazily loaded trackers. The sibling groups
+        of all the trackers are read in one get_level call."""
+        level = []
+        dirty = []
+        for t in trackers:
+            level.extend([(c, t) for c in t.pop_unloaded_child_ids()])
+            dirty.append(t.is_dirty)
+        self.load_levels(level, 0)
+        # attaching the children isn't a change that needs to be written
+        for t, d in zip(trackers, dirty):
+            t.is_dirty = d
+        return self
+
+    def load_levels(self, level, depth=None):
+        """Loads (id, parent) pairs and their descendants a level at a time,
+        attaching each tracker to its parent. Returns the trackers that
+        have no parent."""
+        loaded = []
+        fresh = []
+        d = 0
+        while level:
+            ids = [i for i, p in level]
+            records = self.get_level(
+                ids, [p.root_id if p else None for i, p in level])
+            next_level = []
+            for (i, parent), (j, children) in zip(level, records):
+                if not j:
+                    continue
+                t = self.from_json(i, j)
+                t.db_conn = self
+                fresh.append(t)
+                if t.summary is not None:
+                    # the summary stands in for the compacted subtree
+                    pass
+                elif children and depth is not None and d >= depth:
+                    # the stored rollup stands in for the unloaded children
+                    t.with_unloaded_children(children)
+                elif children:
+                    # the rollup and counts are rebuilt as the children are
+                    # attached
+                    t.sub_current_progress = 0
+                    t.sub_progress_total = 0
+                    t.status_counts = None
+                    t.descendant_count = 0
+                    next_level.extend([(c, t) for c in children])
+                if parent:
+                    parent.with_tracker(t)
+                else:
+                    loaded.append(t)
+            level = next_level
+            d = d + 1
+        # attaching children marks the parents dirty, but they match the DB
+        for t in fresh:
+            t.is_dirty = False
+        return loaded
+
+    def rollup_ancestor_ids(self, e):
+        """Returns the ids of all of e's ancestors, nearest first, for
+        rolling up its progress and status. Ancestors that aren't in memory,
+        because e or one of its ancestors was loaded on its own, are read
+        from the stored parent ids a level at a time the first time, and
+        remembered."""
+        ids = e.ancestor_ids
+        top = e.unloaded_ancestry
+        if top is None:
+            return ids
+        top_id, pid = top
+        stored = self.ancestor_cache.get(top_id)
+        if stored is None:
+            stored = []
+            root_id = e.root_id
+            while pid:
+                stored.append(pid)
+                j, children = self.get_level([pid], [root_id])[0]
+                pid = self.from_json(pid, j).parent_id if j else None
+            self.ancestor_cache[top_id] = stored
+        return ids + stored
+
+    def count_changes(self, trackers, ancestors=None):
+        """Returns (tracker, ancestor ids, deltas, added) for each tracker
+        whose write changes the stored status counts of its ancestors.
+        ancestors has the ancestor ids of trackers already looked up."""
+        changes = []
+        for e in trackers:
+            deltas, added = e.count_changes()
+            if not deltas and not added:
+                continue
+            if ancestors is not None:
+                ids = ancestors[e.id]
+            else:
+                ids = self.rollup_ancestor_ids(e)
+            if ids:
+                changes.append((e, ids, deltas, added))
+        return changes
+
+    def count_increments(self, changes):
+        """Sums count changes by ancestor, as {(root id, ancestor id):
+        (deltas, added)}."""
+        increments = {}
+        for e, ids, deltas, added in changes:
+            for a in ids:
+                d, n = increments.get((e.root_id, a), ({}, 0))
+                for s, v in deltas.iteritems():
+                    d[s] = d.get(s, 0) + v
+                increments[(e.root_id, a)] = (d, n + added)
+        return increments
+
+    def counted(self, trackers):
+        """Notes that the stored counts have the statuses trackers were
+        written with."""
+        for e in trackers:
+            e.counted_status = e.status
+
+    def recount_from(self, e, stored):
+        """Has e's count changes start from stored, the status the stored
+        counts had for e when its write swapped it for e's, so of two
+        writers that change the same status only the first counts it.
+        Records written before the counted status was stored keep what this
+        process counted."""
+        if stored is not None:
+            e.counted_status = stored
+
+    def get_level(self, ids, root_ids=None):
+        """Returns a (record, children ids) pair for each id. Drivers
+        override this to fetch a whole level in as few calls as possible.
+        root_ids has the root id of each tracker where it is known, for
+        drivers that store trackers by root."""
+        return [(self.get_by_id(i), self.get_children(i)) for i in ids]
+
+    def from_json(self, id, j):
+        return TrackerBase.from_json(id, j)
+
+    def update_trackers(self, trackers):
+        """Writes a batch of trackers. Drivers can override this to save
+        round trips; by default each tracker is written on its own."""
+        for t in trackers:
+            self.update_tracker(t)
+
+    def done_root_ids(self, limit):
+        """Returns up to limit ids of finished roots for sweep() to expire.
+        Drivers that expire trees override this."""
+        return []
+
+    def sweep(self, limit=500):
+        """Expires the trees of up to limit finished workflows, in bulk.
+        Returns how many finished roots were swept."""
+        root_ids = self.done_root_ids(limit)
+        if root_ids:
+            self.expire_trees(root_ids)
+        return len(root_ids)
+
+    def expire_trees(self, root_ids):
+        raise Exception('{} does not expire trees'
+                        .format(type(self).__name__))
+
+    def merge_conflict(self, e, s):
+        """Folds s, the record another writer stored for e since e was
+        read, into e so writing e again doesn't undo it. The status that is
+        further along wins, with its flags and finish time, and the earliest
+        start is kept. Children are merged by the driver; everything else
+        keeps e's values. e takes the stored version, and the stored status
+        is what the stored counts have for it."""
+        e.counted_status = s.status
+        if status_rank(s.status) > status_rank(e.status):
+            e.status = s.status
+            e.is_done = s.is_done
+            e.is_in_progress = s.is_in_progress
+            e._finish_time = s._finish_time
+        if s._start_time is not None and \
+                (e._start_time is None or s._start_time < e._start_time):
+            e._start_time = s._start_time
+        if isinstance(e, TrackerBase):
+            e.invalidate_estimates()
+        e.version = s.version
+        return e
+
+    def conflict_backoff(self, attempt):
+        if attempt > CONFLICT_MAX_RETRIES:
+            return False
+        if attempt > 1:
+            # spread out writers that keep colliding
+            time.sleep(random.uniform(0, min(BATCH_BACKOFF_CAP,
+                                             CONFLICT_BACKOFF_BASE *
+                                             2 ** attempt)))
+        return True
+
+    def check_retention(self):
+        if self.retention_seconds is None:
+            raise Exception('Set RetentionSeconds to expire finished trees')
+
+    def archive_record(self, root_id, trackers):
+        """Returns the summary kept of a finished tree: the root's fields,
+        counts by status, total progress and the status and times of every
+        tracker."""
+        root = None
+        counts = {}
+        progress = [0, 0]
+        items = []
+        for t in trackers:
+            if t.id == root_id:
+                root = t
+            counts[t.status] = counts.get(t.status, 0) + 1
+            progress[0] = progress[0] + int(t.current_progress or 0)
+            progress[1] = progress[1] + int(t.progress_total or 0)
+            items.append([t.id, t.parent_id, t.name, t.status,
+                          t._start_time, t._finish_time])
+        if root is None:
+            return None
+        elapsed = None
+        if root._start_time is not None and root._finish_time is not None:
+            elapsed = root._finish_time - root._start_time
+        return {
+            'v': 1,
+            'id': root_id,
+            'name': root.name,
+            'friendly_id': root.friendly_id,
+            'status': root.status,
+            'start': root._start_time,
+            'finish': root._finish_time,
+            'elapsed_seconds': elapsed,
+            'trackers': len(items),
+            'counts': counts,
+            'progress': progress,
+            'archived_at': time.time(),
+            'items': items
+        }
+
 
 class DynamoDbDriver(DbDriver):
     def __init__(self, **kwargs):
-        try:
-            self.dynamodb = kwargs.pop('DynamoDbResource')
-        except KeyError:
-            self.dynamodb = boto3.resource('dynamodb')
+        from helpers.db_helpers import validate_tables
+        self.resource = kwargs.pop('DynamoDbResource', None)
 
         p = kwargs.get('TablePrefix', '')
         if p:
             p = p + '_'
 
         super(DynamoDbDriver, self).__init__(**kwargs)
+        self.batch_writes = kwargs.get('BatchWrites', False)
         self.TRACKER_TABLE = '{}ProgressMonitorTrackers'.format(p)
         self.CHILDREN_TABLE = '{}ProgressMonitorChildren'.format(p)
         self.FRIENDLY_ID_TABLE = '{}ProgressMonitorFriendlyIds'.format(p)
+        self.CHANGES_INDEX = 'RootIdUpdatedAt'
+        # root id the markers of finished roots are indexed under
+        self.DONE_ROOT_ID = 'progressmonitor:done'
+        self.LEGACY_ATTRIBUTES = [
+            'TrackerName', 'EstimatedSeconds', 'StartTime', 'FinishTime',
+            'StatusMessage', 'FriendlyId', 'ParentId', 'LastUpdate', 'Source',
+            'MetricNamespace', 'TrackerStatus', 'MetricName', 'InProgress',
+            'HasParallelChildren', 'IsDone']
+
+        if kwargs.get('ValidateTables', True):
+            validate_tables([self.TRACKER_TABLE, self.CHILDREN_TABLE,
+                             self.FRIENDLY_ID_TABLE], self.create_tables,
+                            self.dynamodb.meta.client)
+            if self.retention_seconds is not None:
+                self.enable_ttl()
 
-        client = self.dynamodb.meta.client
-        if not does_table_exist(self.TRACKER_TABLE, client) or \
-           not does_table_exist(self.CHILDREN_TABLE, client) or \
-           not does_table_exist(self.FRIENDLY_ID_TABLE, client):
-            self.create_tables()
 
+    @property
+    def dynamodb(self):
+        """The DynamoDbResource the driver was given, or else the calling
+        thread's resource on the client shared by the process."""
+        if self.resource is not None:
+            return self.resource
+        from helpers.db_helpers import dynamodb_resource
+        return dynamodb_resource()
 
     def children_key(self, k):
         return "{}".format(k)
 
 
     def get_by_friendly_id(self, friendly_id):
+        from boto3.dynamodb.conditions import Key
         table = self.dynamodb.Table(self.FRIENDLY_ID_TABLE)
         response = table.query(
             KeyConditionExpression=Key('FriendlyId').eq(friendly_id)
@@ -106,28 +491,113 @@ class DynamoDbDriver(DbDriver):
         else:
             return None
 
-
-    def get_all_by_id(self, id):
-        j = self.get_by_id(id)
-        if j:
-            t = self.from_json(id, j)
-            logging.debug("{}".format(t.name))
-            t.db_conn = self
-            children = self.get_children(id)
-            if children:
-                for c in children:
-                    t.with_tracker(self.get_all_by_id(c))
-        return t
-
     def get_by_id(self, id):
+        from boto3.dynamodb.conditions import Key
         table = self.dynamodb.Table(self.TRACKER_TABLE)
         response = table.query(
             KeyConditionExpression=Key('Id').eq(id)
         )
-        return response['Items'][0]
+        if len(response['Items']) > 0:
+            return response['Items'][0]
+        else:
+            return None
+
+    def get_level(self, ids, root_ids=None):
+        keys = [(self.TRACKER_TABLE, i) for i in ids] + \
+            [(self.CHILDREN_TABLE, i) for i in ids]
+        items = {self.TRACKER_TABLE: {}, self.CHILDREN_TABLE: {}}
+        for n in xrange(0, len(keys), BATCH_GET_SIZE):
+            request = {}
+            for table, id in keys[n:n + BATCH_GET_SIZE]:
+                request.setdefault(table, {'Keys': []})['Keys'] \
+                    .append({'Id': id})
+            for table, found in self.batch_get(request).iteritems():
+                for item in found:
+                    items[table][item['Id']] = item
+        trackers = items[self.TRACKER_TABLE]
+        children = items[self.CHILDREN_TABLE]
+        return [(trackers.get(i), children.get(i, {}).get('children'))
+                for i in ids]
+
+    def batch_get(self, request):
+        found = {}
+        for response in self.batch_request(self.dynamodb.batch_get_item,
+                                           request, 'UnprocessedKeys'):
+            for table, items in response.get('Responses', {}).iteritems():
+                found.setdefault(table, []).extend(items)
+        return found
+
+    def batch_request(self, call, request, unprocessed):
+        """Runs a batch call, retrying unprocessed requests with backoff."""
+        responses = []
+        attempt = 0
+        while request:
+            if attempt:
+                if attempt > BATCH_MAX_RETRIES:
+                    raise Exception('Unable to process {} in DynamoDB after {} '
+                                    'retries'.format(request.keys(),
+                                                     BATCH_MAX_RETRIES))
+                time.sleep(min(BATCH_BACKOFF_CAP,
+                               BATCH_BACKOFF_BASE * 2 ** attempt))
+            response = call(RequestItems=request)
+            self.round_trips = self.round_trips + 1
+            responses.append(response)
+            request = response.get(unprocessed)
+            attempt = attempt + 1
+        return responses
+
+    def update_trackers(self, trackers):
+        # batch writes can't be conditional
+        if not self.batch_writes or self.conditional_writes:
+            if self.conditional_writes:
+                # puts write the counts held in memory, so the changes of
+                # the whole batch are counted first
+                self.add_counts(trackers)
+            return super(DynamoDbDriver, self).update_trackers(trackers)
+
+        # a put replaces the whole item, so only records that aren't stored
+        # yet are put; the others are updated, keeping the counters, counts,
+        # version and TTL other writers changed on the server
+        new = [e for e in trackers if e.counted_status is NOT_COUNTED]
+        # the puts write the counts held in memory, so only ancestors that
+        # aren't put have theirs added
+        new_ids = set([e.id for e in new])
+        self.add_counts(new, new_ids)
+
+        puts = []
+        friendly_ids = {}
+        for e in new:
+            puts.append((self.TRACKER_TABLE, self.to_record(self.stamp(e))))
+            if e.child_ids:
+                puts.append((self.CHILDREN_TABLE,
+                             {'Id': e.id, 'children': e.child_ids}))
+            if e.friendly_id:
+                friendly_ids[e.friendly_id] = e.id
+            if self.is_done_root(e):
+                puts.append((self.TRACKER_TABLE, self.done_marker(e)))
+        for f, id in friendly_ids.iteritems():
+            puts.append((self.FRIENDLY_ID_TABLE,
+                         {'FriendlyId': f, 'TrackerId': id}))
+        self.batch_put(puts)
+        for e in trackers:
+            if e.id not in new_ids:
+                self.update_record(e, new_ids)
+
+    def batch_put(self, puts, deletes=()):
+        """Writes (table, item) pairs and deletes (table, key) pairs,
+        BATCH_WRITE_SIZE to a request."""
+        writes = [(t, {'PutRequest': {'Item': i}}) for t, i in puts] + \
+            [(t, {'DeleteRequest': {'Key': k}}) for t, k in deletes]
+        for n in xrange(0, len(writes), BATCH_WRITE_SIZE):
+            request = {}
+            for table, write in writes[n:n + BATCH_WRITE_SIZE]:
+                request.setdefault(table, []).append(write)
+            self.batch_request(self.dynamodb.batch_write_item, request,
+                               'UnprocessedItems')
 
 
     def get_children(self, id):
+        from boto3.dynamodb.conditions import Key
         k = self.children_key(id)
         table = self.dynamodb.Table(self.CHILDREN_TABLE)
         response = table.query(
@@ -154,6 +624,36 @@ class DynamoDbDriver(DbDriver):
                              'AttributeName': 'Id',
                              'AttributeType': 'S'
                          },
+                         {
+                             'AttributeName': 'RootId',
+                             'AttributeType': 'S'
+                         },
+                         {
+                             'AttributeName': 'UpdatedAt',
+                             'AttributeType': 'N'
+                         },
+            ],
+            GlobalSecondaryIndexes=[
+                {
+                    'IndexName': self.CHANGES_INDEX,
+                    'KeySchema': [
+                        {
+                            'AttributeName': 'RootId',
+                            'KeyType': 'HASH'
+                        },
+                        {
+                            'AttributeName': 'UpdatedAt',
+                            'KeyType': 'RANGE'
+                        }
+                    ],
+                    'Projection': {
+                        'ProjectionType': 'ALL'
+                    },
+                    'ProvisionedThroughput': {
+                        'ReadCapacityUnits': 3,
+                        'WriteCapacityUnits': 3,
+                    }
+                },
             ],
             ProvisionedThroughput={
                     'ReadCapacityUnits': 3,
@@ -207,19 +707,161 @@ class DynamoDbDriver(DbDriver):
         table.meta.client.get_waiter('table_exists') \
             .wait(TableName=self.FRIENDLY_ID_TABLE)
 
-    def update_tracker(self, e):
+    def enable_ttl(self):
+        """Turns on DynamoDB TTL on the ExpiresAt attribute of the tables
+        that don't have it, so expired trees are deleted. Runs when a
+        driver with RetentionSeconds validates its tables."""
+        from helpers.db_helpers import validate_ttl
+        for table in [self.TRACKER_TABLE, self.CHILDREN_TABLE,
+                      self.FRIENDLY_ID_TABLE]:
+            try:
+                validate_ttl(table, 'ExpiresAt', self.dynamodb.meta.client)
+            except Exception as e:
+                logging.warn('Unable to enable TTL on {}: {}'
+                             .format(table, str(e)))
+        return self
+
+    def is_done_root(self, e):
+        return self.retention_seconds is not None and not e.parent_id \
+            and e.is_done
+
+    def done_marker(self, e):
+        """Returns the item marking e as a finished root. Markers are
+        indexed under a root id of their own, oldest finish first, so the
+        sweep() of any process finds them."""
+        return {'Id': self.done_id(e.id), 'DoneRoot': e.id,
+                'RootId': self.DONE_ROOT_ID,
+                'UpdatedAt': to_micros(e._finish_time or e._last_update)}
+
+    def note_root(self, e):
+        if self.is_done_root(e):
+            table = self.dynamodb.Table(self.TRACKER_TABLE)
+            table.put_item(Item=self.done_marker(e))
+
+    def done_root_ids(self, limit):
+        from boto3.dynamodb.conditions import Key
         table = self.dynamodb.Table(self.TRACKER_TABLE)
-        ue, eav = e.to_update_item()
-        table.update_item(
-            Key={
-                'Id': e.id
-            },
-            UpdateExpression=ue,
-            ExpressionAttributeValues=eav
-        )
+        response = table.query(
+            IndexName=self.CHANGES_INDEX,
+            KeyConditionExpression=Key('RootId').eq(self.DONE_ROOT_ID),
+            Limit=limit)
+        self.round_trips = self.round_trips + 1
+        return [i['DoneRoot'] for i in response['Items']]
+
+    def expire_trees(self, root_ids):
+        """Sets ExpiresAt on every item of the trees of root_ids, archiving
+        each tree first if ArchiveDone is set. Items are rewritten with
+        batch writes, so this takes a query per tree and a batch request
+        per BATCH_WRITE_SIZE items. Trees whose root was reopened since it
+        finished are left alone."""
+        self.check_retention()
+        expires = int(time.time() + self.retention_seconds)
+        puts = []
+        friendly = {}
+        for r in root_ids:
+            items, synced = self.get_changes(r, None)
+            roots = [j for i, j, children in items if i == r]
+            if not roots or not self.from_json(r, roots[0]).is_done:
+                continue
+            trackers = []
+            for i, j, children in items:
+                j['ExpiresAt'] = expires
+                puts.append((self.TRACKER_TABLE, j))
+                if children:
+                    puts.append((self.CHILDREN_TABLE,
+                                 {'Id': i, 'children': children,
+                                  'ExpiresAt': expires}))
+                t = self.from_json(i, j)
+                trackers.append(t)
+                if t.friendly_id:
+                    friendly[t.friendly_id] = i
+            if self.archive_done:
+                record = self.archive_record(r, trackers)
+                if record:
+                    puts.append((self.TRACKER_TABLE, {
+                        'Id': self.archive_id(r),
+                        'Archive': json.dumps(record,
+                                              separators=(',', ':'))}))
+
+        # a friendly id may have been taken by a newer tracker since
+        keys = friendly.keys()
+        for n in xrange(0, len(keys), BATCH_GET_SIZE):
+            request = {self.FRIENDLY_ID_TABLE: {
+                'Keys': [{'FriendlyId': f} for f in keys[n:n + BATCH_GET_SIZE]]
+            }}
+            for item in self.batch_get(request).get(self.FRIENDLY_ID_TABLE,
+                                                    []):
+                if item['TrackerId'] == friendly[item['FriendlyId']]:
+                    item['ExpiresAt'] = expires
+                    puts.append((self.FRIENDLY_ID_TABLE, item))
+        self.batch_put(puts, [(self.TRACKER_TABLE, {'Id': self.done_id(r)})
+                              for r in root_ids])
+        return self
+
+    def archive_id(self, root_id):
+        return 'archive:{}'.format(root_id)
 
-        if e.children:
-            children = [c.id for c in e.children]
+    def done_id(self, root_id):
+        return 'done:{}'.format(root_id)
+
+    def get_archive(self, root_id):
+        """Returns the archived summary of a finished tree, or None."""
+        table = self.dynamodb.Table(self.TRACKER_TABLE)
+        item = table.get_item(Key={'Id': self.archive_id(root_id)}) \
+            .get('Item')
+        if item:
+            return json.loads(item['Archive'])
+
+    def to_record(self, e):
+        """Returns the item a put writes for a tracker."""
+        from boto3.dynamodb.types import Binary
+        item = {
+            'Id': e.id,
+            'C': Binary(codec.encode(e)),
+            'RootId': e.root_id,
+            'UpdatedAt': to_micros(e._last_update),
+            'CountedStatus': e.status,
+            # a put replaces the whole item, so keep the counters that are
+            # otherwise only changed with ADD
+            'CurrentProgress': e.current_progress,
+            'ProgressTotal': e.progress_total,
+            'SubCurrentProgress': e.sub_current_progress,
+            'SubProgressTotal': e.sub_progress_total
+        }
+        if e.descendant_count:
+            item['Descendants'] = e.descendant_count
+            for s, n in (e.status_counts or {}).iteritems():
+                item['Count:' + s] = n
+        return item
+
+    def update_tracker(self, e):
+        if self.conditional_writes:
+            # the put writes e's counts, which have the changes of its dirty
+            # descendants, so those are counted first
+            index = getattr(e, 'index', None)
+            if e.descendant_count and index:
+                self.add_counts([e] + [
+                    d for d in index.dirty.values()
+                    if TrackerIndex.is_descendant(d, e)])
+            else:
+                self.add_counts([e])
+            self.put_tracker(e)
+            if e.child_ids:
+                self.write_children(e)
+            self.write_friendly_id(e)
+            self.note_root(e)
+            return
+        self.update_record(e)
+
+    def update_record(self, e, skip=()):
+        """Updates the record of a tracker, leaving the attributes that are
+        changed with ADD alone, and adds its status count changes to its
+        ancestors other than those with ids in skip."""
+        self.swap_record(e)
+        self.add_counts([e], skip)
+
+        if e.child_ids:
+            children = e.child_ids
 
             c_table = self.dynamodb.Table(self.CHILDREN_TABLE)
             c_table.update_item(
@@ -230,6 +872,61 @@ class DynamoDbDriver(DbDriver):
                 ExpressionAttributeValues={':c': children }
             )
 
+        self.write_friendly_id(e)
+        self.note_root(e)
+
+    def swap_record(self, e):
+        """Updates the record of a tracker if no other writer has swapped
+        its CountedStatus since it was read. The status count changes then
+        start from the stored CountedStatus, so of two writers that change
+        the same status only the first counts it."""
+        from boto3.dynamodb.conditions import Attr
+        from boto3.dynamodb.types import Binary
+        from botocore.exceptions import ClientError
+        table = self.dynamodb.Table(self.TRACKER_TABLE)
+        self.stamp(e)
+        attempt = 0
+        while self.conflict_backoff(attempt):
+            attempt = attempt + 1
+            stored = table.get_item(Key={'Id': e.id}, ConsistentRead=True,
+                                    ProjectionExpression='CountedStatus') \
+                .get('Item') or {}
+            self.round_trips = self.round_trips + 1
+            if 'CountedStatus' in stored:
+                swapped = Attr('CountedStatus').eq(stored['CountedStatus'])
+            else:
+                swapped = Attr('CountedStatus').not_exists()
+            try:
+                table.update_item(
+                    Key={
+                        'Id': e.id
+                    },
+                    # records written before the codec had an attribute per
+                    # field
+                    UpdateExpression='SET C=:c, RootId=:rid, UpdatedAt=:u_a, '
+                                     'CountedStatus=:cs REMOVE ' +
+                                     ', '.join(self.LEGACY_ATTRIBUTES),
+                    ConditionExpression=swapped,
+                    ExpressionAttributeValues={
+                        ':c': Binary(codec.encode(e)),
+                        ':rid': e.root_id,
+                        ':u_a': to_micros(e._last_update),
+                        ':cs': e.status
+                    }
+                )
+            except ClientError as err:
+                if 'ConditionalCheckFailed' not in \
+                        err.response['Error']['Code']:
+                    raise
+                continue
+            finally:
+                self.round_trips = self.round_trips + 1
+            self.recount_from(e, stored.get('CountedStatus'))
+            return self
+        raise Exception('Gave up writing {} after {} conflicting writes'
+                        .format(e.id, CONFLICT_MAX_RETRIES))
+
+    def write_friendly_id(self, e):
         if e.friendly_id:
             c_table = self.dynamodb.Table(self.FRIENDLY_ID_TABLE)
             c_table.update_item(
@@ -240,38 +937,231 @@ class DynamoDbDriver(DbDriver):
                 ExpressionAttributeValues={':t': e.id}
             )
 
+    def expected_version(self, version):
+        if version:
+            return {'Version': {'Value': version}}
+        return {'Version': {'Exists': False}}
 
+    def put_versioned(self, table, item, version):
+        """Puts an item with the next version if its stored version is
+        still version. Returns False if another writer got there first."""
+        from botocore.exceptions import ClientError
+        item['Version'] = version + 1
+        try:
+            table.put_item(Item=item, Expected=self.expected_version(version))
+        except ClientError as err:
+            if 'ConditionalCheckFailed' not in err.response['Error']['Code']:
+                raise
+            return False
+        finally:
+            self.round_trips = self.round_trips + 1
+        return True
+
+    def put_tracker(self, e):
+        """Puts a tracker's record if nobody has written it since it was
+        read. Otherwise the stored record is merged into the tracker and the
+        put tried again, keeping the stored progress counters and status
+        counts, which are changed on the server."""
+        table = self.dynamodb.Table(self.TRACKER_TABLE)
+        stored = None
+        attempt = 0
+        while self.conflict_backoff(attempt):
+            attempt = attempt + 1
+            item = self.to_record(self.stamp(e))
+            if stored:
+                for k in ['CurrentProgress', 'ProgressTotal',
+                          'SubCurrentProgress', 'SubProgressTotal']:
+                    item[k] = stored.get(k, 0)
+                for k in item.keys() + stored.keys():
+                    if k == 'Descendants' or k.startswith('Count:'):
+                        item.pop(k, None)
+                        if k in stored:
+                            item[k] = stored[k]
+            if self.put_versioned(table, item, e.version):
+                e.version = e.version + 1
+                return self
+            stored = table.get_item(Key={'Id': e.id},
+                                    ConsistentRead=True).get('Item')
+            self.round_trips = self.round_trips + 1
+            if stored:
+                self.merge_conflict(e, self.from_json(e.id, stored))
+            else:
+                e.version = 0
+        raise Exception('Gave up writing {} after {} conflicting writes'
+                        .format(e.id, CONFLICT_MAX_RETRIES))
+
+    def write_children(self, e):
+        """Adds a tracker's children to the stored list, keeping children
+        other writers added."""
+        table = self.dynamodb.Table(self.CHILDREN_TABLE)
+        attempt = 0
+        while self.conflict_backoff(attempt):
+            attempt = attempt + 1
+            item = table.get_item(Key={'Id': e.id},
+                                  ConsistentRead=True).get('Item')
+            self.round_trips = self.round_trips + 1
+            children = list(item['children']) if item else []
+            known = set(children)
+            added = [c for c in e.child_ids if c not in known]
+            if item and not added:
+                return self
+            version = int(item.get('Version', 0)) if item else 0
+            if self.put_versioned(table, {'Id': e.id,
+                                          'children': children + added},
+                                  version):
+                return self
+        raise Exception('Gave up writing the children of {} after {} '
+                        'conflicting writes'.format(e.id,
+                                                    CONFLICT_MAX_RETRIES))
+
+
+    def inc_progress(self, e, value=1, total=0):
+        """Atomically adds to a tracker's progress counters and to the
+        rolled-up counters of all its ancestors."""
+        loaded = dict([(t.id, t) for t in [e] + e.ancestors])
+        updates = [(e.id, 'CurrentProgress', 'ProgressTotal')] + \
+            [(a, 'SubCurrentProgress', 'SubProgressTotal')
+             for a in self.rollup_ancestor_ids(e)]
+        now = self.now()
+        for id, c, tot in updates:
+            adds = {}
+            if value:
+                adds[c] = {'Action': 'ADD', 'Value': value}
+            if total:
+                adds[tot] = {'Action': 'ADD', 'Value': total}
+            self.add_counters(id, adds, now, loaded.get(id))
+
+    def add_counts(self, trackers, skip=()):
+        """Adds the status count changes of trackers about to be written to
+        the stored counts of their ancestors, one update per ancestor.
+        Ancestors with ids in skip are left alone."""
+        changes = self.count_changes(trackers)
+        if changes:
+            loaded = {}
+            for e in trackers:
+                for a in getattr(e, 'ancestors', []):
+                    loaded[a.id] = a
+            now = self.now()
+            for (root_id, a), (deltas, added) in \
+                    self.count_increments(changes).iteritems():
+                if a in skip:
+                    continue
+                adds = dict([('Count:' + s, {'Action': 'ADD', 'Value': n})
+                             for s, n in deltas.iteritems() if n])
+                if added:
+                    adds['Descendants'] = {'Action': 'ADD', 'Value': added}
+                if adds:
+                    self.add_counters(a, adds, now, loaded.get(a))
+        self.counted(trackers)
+
+    def add_counters(self, id, adds, now, t=None):
+        """Adds to counters of one item. t is the item's tracker, if it is
+        loaded."""
+        # the change index has to see the new counters, and a conditional
+        # put has to see that they changed
+        adds = dict(adds)
+        adds['UpdatedAt'] = {'Action': 'PUT', 'Value': to_micros(now)}
+        adds['Version'] = {'Action': 'ADD', 'Value': 1}
+        table = self.dynamodb.Table(self.TRACKER_TABLE)
+        response = table.update_item(
+            Key={
+                'Id': id
+            },
+            AttributeUpdates=adds,
+            ReturnValues='UPDATED_NEW'
+        )
+        self.round_trips = self.round_trips + 1
+        version = int(response.get('Attributes', {}).get('Version', 0))
+        # only this increment moved the version
+        if t and version == t.version + 1:
+            t.version = version
+
+    def get_changes(self, root_id, since):
+        from boto3.dynamodb.conditions import Key
+        table = self.dynamodb.Table(self.TRACKER_TABLE)
+        cond = Key('RootId').eq(root_id)
+        if since is not None:
+            cond = cond & Key('UpdatedAt').gte(to_micros(since))
+        kwargs = {'IndexName': self.CHANGES_INDEX,
+                  'KeyConditionExpression': cond}
+        items = []
+        while True:
+            response = table.query(**kwargs)
+            self.round_trips = self.round_trips + 1
+            items.extend(response['Items'])
+            if 'LastEvaluatedKey' not in response:
+                break
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        if not items:
+            return [], since
+
+        ids = [i['Id'] for i in items]
+        children = {}
+        for n in xrange(0, len(ids), BATCH_GET_SIZE):
+            request = {self.CHILDREN_TABLE: {
+                'Keys': [{'Id': i} for i in ids[n:n + BATCH_GET_SIZE]]}}
+            for item in self.batch_get(request).get(self.CHILDREN_TABLE, []):
+                children[item['Id']] = item.get('children')
+        synced = max([int(i['UpdatedAt']) for i in items]) / 1000000.0
+        return [(i['Id'], i, children.get(i['Id'])) for i in items], synced
 
     def from_json(self, id, j):
+        if 'C' in j:
+            t = codec.decode(ProgressTracker(Id=id), j['C'].value)
+            t.with_loaded_progress(j.get('CurrentProgress'),
+                                   j.get('ProgressTotal'),
+                                   j.get('SubCurrentProgress'),
+                                   j.get('SubProgressTotal'))
+            t.last_update = int(j['UpdatedAt']) / 1000000.0
+            t.version = int(j.get('Version', 0))
+            t.with_stored_counts(*read_counts(j, 'Count:', 'Descendants'))
+            t.is_dirty = False
+            return t
+        return self.from_legacy_item(id, j)
+
+    def from_legacy_item(self, id, j):
+        """Reads a record written before the codec."""
         t = ProgressTracker(Id=id)
-        if 'TrackerName' in j.keys():
+        if 'TrackerName' in j:
             t.with_name(j['TrackerName'], True)
-        if 'EstimatedSeconds' in j.keys():
+        if 'EstimatedSeconds' in j:
             t.with_estimated_seconds(float(j['EstimatedSeconds']), True)
-        if 'StartTime' in j.keys():
-            t.with_start_time(arrow.get(j['StartTime']), True)
-        if 'FinishTime' in j.keys():
-            t.with_finish_time(arrow.get(j['FinishTime']), True)
-        if 'StatusMessage' in j.keys():
+        if 'StartTime' in j:
+            t.with_start_time(j['StartTime'], True)
+        if 'FinishTime' in j:
+            t.with_finish_time(j['FinishTime'], True)
+        if 'StatusMessage' in j:
             t.with_status_msg(j['StatusMessage'], True)
-        if 'FriendlyId' in j.keys():
+        if 'FriendlyId' in j:
             t.with_friendly_id(j['FriendlyId'], True)
-        if 'ParentId' in j.keys():
+        if 'ParentId' in j:
             t.parent_id = j['ParentId']
-        if 'InProgress' in j.keys():
+        if 'RootId' in j:
+            t.with_root_id(j['RootId'])
+        if 'InProgress' in j:
             t.is_in_progress = str(j['InProgress']) == 'True'
-        if 'TrackerStatus' in j.keys():
+        if 'TrackerStatus' in j:
             t.status = j['TrackerStatus']
-        if 'Source' in j.keys():
+        if 'Source' in j:
             t.with_source(j['Source'], True)
-        if 'IsDone' in j.keys():
+        if 'IsDone' in j:
             t.is_done = str(j['IsDone']) == 'True'
-        if 'HasParallelChildren' in j.keys():
+        if 'HasParallelChildren' in j:
             t.has_parallel_children = str(j['HasParallelChildren']) == 'True'
-        if 'MetricNamespace' in j.keys() and 'MetricName' in j.keys():
+        if 'MetricNamespace' in j and 'MetricName' in j:
             ns = j['MetricNamespace']
             m = j['MetricName']
             t.with_metric(Namespace=ns, Metric=m, Clean=True)
+        t.with_loaded_progress(j.get('CurrentProgress'),
+                               j.get('ProgressTotal'),
+                               j.get('SubCurrentProgress'),
+                               j.get('SubProgressTotal'))
+        if 'UpdatedAt' in j:
+            t.last_update = int(j['UpdatedAt']) / 1000000.0
+        elif 'LastUpdate' in j:
+            t.last_update = j['LastUpdate']
+        t.version = int(j.get('Version', 0))
+        t.with_stored_counts(*read_counts(j, 'Count:', 'Descendants'))
         t.is_dirty = False
         return t
 
@@ -279,64 +1169,729 @@ class DynamoDbDriver(DbDriver):
 
 
 class RedisProgressManager(DbDriver):
+    # writes of one tracker go through MULTI/EXEC
+    ATOMIC_WRITES = True
+
     def __init__(self, **kwargs):
         super(RedisProgressManager, self).__init__(**kwargs)
         self.redis = kwargs.get('RedisConnection')
+        self.flush_chunk_size = kwargs.get('FlushChunkSize', None)
+        self.transactional_flush = kwargs.get('TransactionalFlush', False)
+        self.publish_changes = kwargs.get('PublishChanges', False)
+        # lets subscribers skip the events they published themselves
+        self.client_id = str(uuid.uuid4())
+        # offset of the server's clock from the local one
+        self.clock_offset = 0
+        self.clock_synced_at = None
+        self.clock_sync_interval = kwargs.get('ClockSyncInterval', 60)
 
     def update_tracker(self, e):
-        pipe = self.redis.pipeline(True)
-        data = e.to_json()
-        pipe.hmset(e.get_full_key(), data)
-        if e.children:
-            children = []
-            for c in e.children:
-                children.append(c.id)
-            pipe.sadd(self.children_key(e.id), *set(children))
+        if self.conditional_writes:
+            return self.write_versioned([e])
+        self.write_chunk([e], self.ATOMIC_WRITES)
+
+    def update_trackers(self, trackers):
+        """Writes trackers through one pipeline per chunk. A transactional
+        flush wraps each chunk in MULTI/EXEC so no tracker is half written."""
+        size = self.flush_chunk_size or len(trackers)
+        for n in xrange(0, len(trackers), size):
+            if self.conditional_writes:
+                self.write_versioned(trackers[n:n + size])
+                continue
+            self.write_chunk(trackers[n:n + size], self.transactional_flush)
+
+    def write_chunk(self, trackers, transaction):
+        """Writes trackers through one pipeline. Trackers that aren't stored
+        yet are counted in it. The others have their stored counted status
+        swapped with GETSET, and the changes from the statuses it held are
+        counted in a second pipeline, so of two writers that change the same
+        status only the first counts it. A writer that dies between the two
+        leaves that change uncounted until the counts are rebuilt."""
+        stored = [e for e in trackers if e.counted_status is not NOT_COUNTED]
+        pipe = self.redis.pipeline(transaction)
+        for e in stored:
+            pipe.getset(self.counted_status_key(e.root_id, e.id), e.status)
+        new = [e for e in trackers if e.counted_status is NOT_COUNTED]
+        changes = self.count_changes(new)
+        for e in trackers:
+            self.write_tracker(pipe, e)
+        self.write_counts(pipe, changes)
+        swapped = pipe.execute()[:len(stored)]
+        self.round_trips = self.round_trips + 1
+        self.counted(new)
+        for e, s in zip(stored, swapped):
+            self.recount_from(e, s)
+        changes = self.count_changes(stored)
+        if changes:
+            pipe = self.redis.pipeline(transaction)
+            self.write_counts(pipe, changes)
+            pipe.execute()
+            self.round_trips = self.round_trips + 1
+        self.counted(stored)
+
+    def write_versioned(self, trackers):
+        """Writes trackers in one MULTI/EXEC that only runs if none of their
+        records changed since their versions were checked. Trackers another
+        writer has written since they were read are merged with the stored
+        record first, and the whole batch is tried again if a record changes
+        while it is being written. Takes three round trips, plus one to read
+        the records of trackers with conflicts."""
+        from redis import WatchError
+        keys = [self.tracker_key(e.root_id, e.id) for e in trackers]
+        attempt = 0
+        while self.conflict_backoff(attempt):
+            attempt = attempt + 1
+            pipe = self.redis.pipeline(True)
+            try:
+                pipe.watch(*keys)
+                read = self.redis.pipeline(False)
+                for k in keys:
+                    read.hget(k, 'v')
+                versions = read.execute()
+                self.round_trips = self.round_trips + 2
+                stale = [(e, k) for e, k, v in zip(trackers, keys, versions)
+                         if int(v or 0) != e.version]
+                if stale:
+                    read = self.redis.pipeline(False)
+                    for e, k in stale:
+                        read.hgetall(k)
+                    for (e, k), j in zip(stale, read.execute()):
+                        self.merge_conflict(e, self.from_json(e.id, j))
+                    self.round_trips = self.round_trips + 1
+                changes = self.count_changes(trackers)
+                pipe.multi()
+                for e in trackers:
+                    self.write_tracker(pipe, e)
+                self.write_counts(pipe, changes)
+                pipe.execute()
+                self.round_trips = self.round_trips + 1
+            except WatchError:
+                continue
+            finally:
+                pipe.reset()
+            for e in trackers:
+                e.version = e.version + 1
+            self.counted(trackers)
+            return self
+        raise Exception('Gave up writing {} trackers after {} conflicting '
+                        'writes'.format(len(trackers), CONFLICT_MAX_RETRIES))
+
+    def now(self):
+        """Returns the Redis server's time, so the change index keeps the
+        writes of clients whose clocks disagree in order. The local clock's
+        offset from it is read with TIME every ClockSyncInterval seconds."""
+        local = time.time()
+        if self.clock_synced_at is None or \
+                local - self.clock_synced_at >= self.clock_sync_interval:
+            self.clock_synced_at = local
+            try:
+                secs, micros = self.redis.time()
+                self.round_trips = self.round_trips + 1
+                # the server read its clock about halfway through the call
+                self.clock_offset = secs + micros / 1000000.0 - \
+                    (local + time.time()) / 2
+            except Exception as e:
+                logging.warn('Unable to read the Redis server time, using '
+                             'the local clock: {}'.format(str(e)))
+        return round(time.time() + self.clock_offset, 6)
+
+    def tracker_key(self, root_id, id):
+        return id
+
+    def tree_children_key(self, root_id, id):
+        return self.children_key(id)
+
+    def friendly_id_key(self, friendly_id):
+        return friendly_id
+
+    def changes_key(self, root_id):
+        return '{}:changes'.format(root_id)
+
+    def events_channel(self, root_id):
+        return '{}:events'.format(root_id)
+
+    def done_key(self):
+        return 'progressmonitor:done'
+
+    def archive_key(self, root_id):
+        return '{}:archive'.format(root_id)
+
+    def counted_status_key(self, root_id, id):
+        return '{}:cs'.format(self.tracker_key(root_id, id))
+
+    def tree_keys(self, root_id, id):
+        """Returns the keys written for one tracker of a tree."""
+        return [self.tracker_key(root_id, id),
+                self.tree_children_key(root_id, id),
+                self.counted_status_key(root_id, id)]
+
+    def publish(self, pipe, root_id, event):
+        event['src'] = self.client_id
+        pipe.publish(self.events_channel(root_id),
+                     json.dumps(event, separators=(',', ':')))
+
+    def change_event(self, e):
+        """Returns the compact change event published when e is written."""
+        event = {'id': e.id, 'st': e.status, 'cp': e.current_progress,
+                 'pt': e.progress_total, 'ts': e._last_update}
+        if e.parent_id:
+            event['pid'] = e.parent_id
+        if e._start_time is not None:
+            event['start'] = e._start_time
+        if e._finish_time is not None:
+            event['fin'] = e._finish_time
+        return event
+
+    def write_tracker(self, pipe, e):
+        self.stamp(e)
+        root_id = e.root_id
+        pipe.hmset(self.tracker_key(root_id, e.id),
+                   {'c': codec.encode(e), 'lu': to_micros(e._last_update)})
+        pipe.hincrby(self.tracker_key(root_id, e.id), 'v', 1)
+        if e.counted_status is NOT_COUNTED or self.conditional_writes:
+            pipe.set(self.counted_status_key(root_id, e.id), e.status)
+        pipe.zadd(self.changes_key(root_id), e._last_update, e.id)
+        if self.publish_changes:
+            self.publish(pipe, root_id, self.change_event(e))
+        if e.child_ids:
+            pipe.sadd(self.tree_children_key(root_id, e.id),
+                      *set(e.child_ids))
         if e.friendly_id:
-            pipe.set(e.friendly_id, e.id)
+            pipe.set(self.friendly_id_key(e.friendly_id), e.id)
+        if self.retention_seconds is not None and not e.parent_id:
+            if e.is_done:
+                pipe.zadd(self.done_key(), e._finish_time or e._last_update,
+                          e.id)
+            else:
+                pipe.zrem(self.done_key(), e.id)
+
+    def write_counts(self, pipe, changes):
+        """Adds the status count changes of the trackers being written to
+        the stored counts of their ancestors."""
+        if not changes:
+            return
+        now = self.now()
+        for (root_id, a), (deltas, added) in \
+                self.count_increments(changes).iteritems():
+            k = self.tracker_key(root_id, a)
+            for s, n in deltas.iteritems():
+                if n:
+                    pipe.hincrby(k, 'n:' + s, n)
+            if added:
+                pipe.hincrby(k, 'n', added)
+            # the change index has to see the new counts
+            pipe.hset(k, 'lu', to_micros(now))
+            pipe.zadd(self.changes_key(root_id), now, a)
+        if self.publish_changes:
+            for e, ids, deltas, added in changes:
+                self.publish(pipe, e.root_id,
+                             {'id': e.id, 'cd': deltas, 'ca': added,
+                              'ts': now, 'aids': ids})
+
+    def done_root_ids(self, limit):
+        return self.redis.zrangebyscore(self.done_key(), '-inf', '+inf',
+                                        start=0, num=limit)
+
+    def expire_trees(self, root_ids):
+        """Sets the retention TTL on every key of the trees of root_ids,
+        archiving each tree first if ArchiveDone is set. Takes four round
+        trips however many trees and trackers there are."""
+        self.check_retention()
+        pipe = self.redis.pipeline(False)
+        for r in root_ids:
+            pipe.zrange(self.changes_key(r), 0, -1)
+        trees = pipe.execute()
+        self.round_trips = self.round_trips + 1
+
+        ids = []
+        roots = []
+        for r, tree_ids in zip(root_ids, trees):
+            ids.extend(tree_ids)
+            roots.extend([r] * len(tree_ids))
+        trackers = dict([(r, []) for r in root_ids])
+        if ids:
+            for i, r, (j, children) in zip(ids, roots,
+                                           self.get_level(ids, roots)):
+                if j:
+                    trackers[r].append(self.from_json(i, j))
+
+        # a friendly id may have been taken by a newer tracker since
+        friendly = [(t.friendly_id, t.id) for r in root_ids
+                    for t in trackers[r] if t.friendly_id]
+        owned = []
+        if friendly:
+            pipe = self.redis.pipeline(False)
+            for f, i in friendly:
+                pipe.get(self.friendly_id_key(f))
+            owned = [f for (f, i), current in zip(friendly, pipe.execute())
+                     if current == i]
+            self.round_trips = self.round_trips + 1
+
+        secs = int(self.retention_seconds)
+        pipe = self.redis.pipeline(False)
+        for r in root_ids:
+            if self.archive_done:
+                record = self.archive_record(r, trackers[r])
+                if record:
+                    pipe.set(self.archive_key(r),
+                             json.dumps(record, separators=(',', ':')))
+            pipe.expire(self.changes_key(r), secs)
+        for i, r in zip(ids, roots):
+            for k in self.tree_keys(r, i):
+                pipe.expire(k, secs)
+        for f in owned:
+            pipe.expire(self.friendly_id_key(f), secs)
+        pipe.zrem(self.done_key(), *root_ids)
         pipe.execute()
+        self.round_trips = self.round_trips + 1
+        return self
+
+    def get_archive(self, root_id):
+        """Returns the archived summary of a finished tree, or None."""
+        j = self.redis.get(self.archive_key(root_id))
+        if j:
+            return json.loads(j)
 
     def get_by_friendly_id(self, friendly_id):
-        if (self.redis.exists(friendly_id)):
-            id = self.redis.get(friendly_id)
-            if id:
-                return self.get_all_by_id(id)
+        id = self.redis.get(self.friendly_id_key(friendly_id))
+        if id:
+            return self.get_all_by_id(id)
 
     def get_by_id(self, id):
         logging.info('Reading {} from Redis DB'.format(id))
-        return self.redis.hgetall(id)
+        return self.redis.hgetall(self.tracker_key(None, id))
 
     def get_children(self, id):
-        k = self.children_key(id)
+        k = self.tree_children_key(None, id)
         if self.redis.exists(k):
-            return self.redis.smembers(self.children_key(id))
+            return self.redis.smembers(k)
+
+    def get_level(self, ids, root_ids=None):
+        root_ids = root_ids or [None] * len(ids)
+        pipe = self.redis.pipeline(False)
+        for id, root_id in zip(ids, root_ids):
+            pipe.hgetall(self.tracker_key(root_id, id))
+            pipe.smembers(self.tree_children_key(root_id, id))
+        results = pipe.execute()
+        self.round_trips = self.round_trips + 1
+        return zip(results[::2], results[1::2])
 
-    def get_all_by_id(self, id):
-        j = self.get_by_id(id)
-        if j:
+    def from_json(self, id, j):
+        if 'c' in j:
+            t = codec.decode(ProgressTracker(Id=id), j['c'])
+            t.with_loaded_progress(j.get('curr_prog'), j.get('prog_tot'),
+                                   j.get('sub_curr_prog'),
+                                   j.get('sub_prog_tot'))
+            t.is_dirty = False
+        else:
+            # a record written before the codec
             t = TrackerBase.from_json(id, j)
-            t.db_conn = self
-            children = self.get_children(id)
-            if children:
-                for c in children:
-                    t.with_tracker(self.get_all_by_id(c))
+        if 'lu' in j:
+            t.last_update = int(j['lu']) / 1000000.0
+        t.version = int(j.get('v', 0))
+        t.with_stored_counts(*read_counts(j, 'n:', 'n'))
         return t
 
-    def inc_progress(self, e, value=1):
-        self.redis.hincrby(e.get_full_key(), "curr_prog", value)
+    def get_changes(self, root_id, since):
+        changed = self.redis.zrangebyscore(
+            self.changes_key(root_id),
+            since if since is not None else '-inf', '+inf', withscores=True)
+        self.round_trips = self.round_trips + 1
+        if not changed:
+            return [], since
+        ids = [i for i, score in changed]
+        records = self.get_level(ids, [root_id] * len(ids))
+        return [(i, j, children) for i, (j, children) in zip(ids, records)
+                if j], max([score for i, score in changed])
+
+    def inc_progress(self, e, value=1, total=0):
+        """Atomically adds to a tracker's progress counters and to the
+        rolled-up counters of all its ancestors."""
+        root_id = e.root_id
+        ancestor_ids = self.rollup_ancestor_ids(e)
+        pipe = self.redis.pipeline(False)
+        for i, f, n in [(e.id, 'curr_prog', value),
+                        (e.id, 'prog_tot', total)] + \
+                [(a, 'sub_curr_prog', value) for a in ancestor_ids] + \
+                [(a, 'sub_prog_tot', total) for a in ancestor_ids]:
+            if n:
+                pipe.hincrby(self.tracker_key(root_id, i), f, n)
+        # the change index has to see the new counters
+        now = self.now()
+        for i in [e.id] + ancestor_ids:
+            pipe.hset(self.tracker_key(root_id, i), 'lu', to_micros(now))
+            pipe.zadd(self.changes_key(root_id), now, i)
+        if self.publish_changes:
+            self.publish(pipe, e.root_id,
+                         {'id': e.id, 'dc': value, 'dt': total, 'ts': now,
+                          'aids': ancestor_ids})
+        pipe.execute()
+        self.round_trips = self.round_trips + 1
+
+
+class RedisClusterProgressManager(RedisProgressManager):
+    """Stores each monitor's tree under keys that share the monitor's hash
+    tag, so on Redis Cluster a whole tree lives in one slot:
+
+        {<root id>}:<id>          tracker record
+        {<root id>}:<id>:ch       children ids
+        {<root id>}:changes       change index
+        {<root id>}:events        change events channel
+        {<root id>}:archive       summary of an expired tree
+
+    Loads know the root of every level below the first. A tracker loaded by
+    its id alone is found through <id>:root, and friendly ids stay plain
+    keys, so those two lookups can go to another node. Cluster clients don't
+    run MULTI/EXEC, so writes use plain pipelines.
+
+    RedisConnection is a cluster client such as rediscluster's
+    StrictRedisCluster; any client works on a single node. Trees written by
+    RedisProgressManager use other keys and aren't read by this driver.
+    """
+    ATOMIC_WRITES = False
+
+    def __init__(self, **kwargs):
+        super(RedisClusterProgressManager, self).__init__(**kwargs)
+        self.transactional_flush = False
+        if self.conditional_writes:
+            raise Exception('ConditionalWrites needs WATCH, which Redis '
+                            'Cluster clients do not run')
+
+    def tracker_key(self, root_id, id):
+        return '{{{}}}:{}'.format(root_id, id)
+
+    def tree_children_key(self, root_id, id):
+        return '{{{}}}:{}:ch'.format(root_id, id)
+
+    def root_key(self, id):
+        return '{}:root'.format(id)
+
+    def changes_key(self, root_id):
+        return '{{{}}}:changes'.format(root_id)
+
+    def events_channel(self, root_id):
+        return '{{{}}}:events'.format(root_id)
+
+    def archive_key(self, root_id):
+        return '{{{}}}:archive'.format(root_id)
+
+    def tree_keys(self, root_id, id):
+        return super(RedisClusterProgressManager, self) \
+            .tree_keys(root_id, id) + [self.root_key(id)]
+
+    def tree_slot(self, root_id):
+        """Returns the hash slot that holds a monitor's tree."""
+        return key_slot(self.changes_key(root_id))
+
+    def write_tracker(self, pipe, e):
+        super(RedisClusterProgressManager, self).write_tracker(pipe, e)
+        pipe.set(self.root_key(e.id), e.root_id)
+
+    def get_root_ids(self, ids):
+        pipe = self.redis.pipeline(False)
+        for id in ids:
+            pipe.get(self.root_key(id))
+        roots = pipe.execute()
+        self.round_trips = self.round_trips + 1
+        return roots
+
+    def get_level(self, ids, root_ids=None):
+        root_ids = list(root_ids or [None] * len(ids))
+        unknown = [n for n, r in enumerate(root_ids) if r is None]
+        if unknown:
+            found = self.get_root_ids([ids[n] for n in unknown])
+            for n, r in zip(unknown, found):
+                root_ids[n] = r
+        return super(RedisClusterProgressManager, self).get_level(ids,
+                                                                 root_ids)
+
+    def get_by_id(self, id):
+        return self.get_level([id])[0][0]
+
+    def get_children(self, id):
+        return self.get_level([id])[0][1] or None
+
+
+class MemoryDriver(DbDriver):
+    """Keeps trackers in this process, in the same records the Redis driver
+    writes, so trees can be saved and loaded without a server.
+
+    Every method that would be a round trip to a real store counts as a
+    call. Each call waits Latency seconds plus up to Jitter more, and fails
+    with an exception, before changing anything, FailureRate of the time.
+    Seed makes the jitter and failures repeatable. stats has the calls by
+    method, which shows how many round trips a load or flush pattern takes.
+    """
+    def __init__(self, **kwargs):
+        super(MemoryDriver, self).__init__(**kwargs)
+        self.latency = kwargs.get('Latency', 0)
+        self.jitter = kwargs.get('Jitter', 0)
+        self.failure_rate = kwargs.get('FailureRate', 0)
+        self.random = random.Random(kwargs.get('Seed'))
+        self.records = {}
+        self.children = {}
+        self.friendly_ids = {}
+        self.changes = {}
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.failures = 0
+        self.waited_seconds = 0
+
+    @property
+    def stats(self):
+        with self.lock:
+            return {
+                'calls': dict(self.calls),
+                'round_trips': self.round_trips,
+                'failures': self.failures,
+                'waited_seconds': self.waited_seconds,
+            }
+
+    def reset_stats(self):
+        with self.lock:
+            self.calls = {}
+            self.round_trips = 0
+            self.failures = 0
+            self.waited_seconds = 0
+        return self
+
+    def call(self, name):
+        """Counts a round trip and injects its latency and failures."""
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            self.round_trips = self.round_trips + 1
+            wait = self.latency
+            if self.jitter:
+                wait = wait + self.random.uniform(0, self.jitter)
+            failed = self.random.random() < self.failure_rate
+            if failed:
+                self.failures = self.failures + 1
+            self.waited_seconds = self.waited_seconds + wait
+        if wait:
+            time.sleep(wait)
+        if failed:
+            raise Exception('Injected failure in {}'.format(name))
+
+    def write_tracker(self, e):
+        self.stamp(e)
+        r = self.records.setdefault(e.id, {})
+        if self.conditional_writes and r.get('v', 0) != e.version:
+            # the check and the write both happen under the lock
+            self.merge_conflict(e, self.from_json(e.id, r))
+        self.recount_from(e, r.get('cs'))
+        r['cs'] = e.status
+        r['c'] = codec.encode(e)
+        r['lu'] = to_micros(e._last_update)
+        r['v'] = r.get('v', 0) + 1
+        if self.conditional_writes:
+            e.version = r['v']
+        self.changes.setdefault(e.root_id, {})[e.id] = e._last_update
+        if e.child_ids:
+            self.children.setdefault(e.id, set()).update(e.child_ids)
+        if e.friendly_id:
+            self.friendly_ids[e.friendly_id] = e.id
+
+    def write_counts(self, changes):
+        now = self.now()
+        for (root_id, a), (deltas, added) in \
+                self.count_increments(changes).iteritems():
+            r = self.records.setdefault(a, {})
+            for s, n in deltas.iteritems():
+                r['n:' + s] = r.get('n:' + s, 0) + n
+            r['n'] = r.get('n', 0) + added
+            r['lu'] = to_micros(now)
+            self.changes.setdefault(root_id, {})[a] = now
+
+    def update_tracker(self, e):
+        self.write_trackers('update_tracker', [e])
+
+    def update_trackers(self, trackers):
+        """Writes a batch of trackers in one call, like a pipeline."""
+        self.write_trackers('update_trackers', trackers)
+
+    def write_trackers(self, name, trackers):
+        # looking up ancestors can take calls of its own, so it's done
+        # before taking the lock
+        ancestors = dict([(e.id, self.rollup_ancestor_ids(e))
+                          for e in trackers])
+        self.call(name)
+        with self.lock:
+            for e in trackers:
+                self.write_tracker(e)
+            # conflicts are merged first, since they change what is counted
+            self.write_counts(self.count_changes(trackers, ancestors))
+        self.counted(trackers)
+
+    def get_by_friendly_id(self, friendly_id):
+        self.call('get_by_friendly_id')
+        with self.lock:
+            id = self.friendly_ids.get(friendly_id)
+        if id:
+            return self.get_all_by_id(id)
+
+    def get_by_id(self, id):
+        self.call('get_by_id')
+        with self.lock:
+            return dict(self.records.get(id, {}))
+
+    def get_children(self, id):
+        self.call('get_children')
+        with self.lock:
+            c = self.children.get(id)
+            return set(c) if c else None
+
+    def get_level(self, ids, root_ids=None):
+        self.call('get_level')
+        with self.lock:
+            return [(dict(self.records.get(i, {})),
+                     set(self.children.get(i, ()))) for i in ids]
+
+    def from_json(self, id, j):
+        if 'c' not in j:
+            # only progress or counts have been written for it
+            return TrackerBase.from_json(id, j)
+        t = codec.decode(ProgressTracker(Id=id), j['c'])
+        t.with_loaded_progress(j.get('curr_prog'), j.get('prog_tot'),
+                               j.get('sub_curr_prog'), j.get('sub_prog_tot'))
+        t.last_update = j['lu'] / 1000000.0
+        t.version = j.get('v', 0)
+        t.with_stored_counts(*read_counts(j, 'n:', 'n'))
+        t.is_dirty = False
+        return t
+
+    def get_changes(self, root_id, since):
+        self.call('get_changes')
+        with self.lock:
+            changed = [(i, ts) for i, ts in
+                       self.changes.get(root_id, {}).iteritems()
+                       if since is None or ts >= since]
+            records = [(i, dict(self.records[i]),
+                        set(self.children.get(i, ()))) for i, ts in changed]
+        if not changed:
+            return [], since
+        return records, max([ts for i, ts in changed])
+
+    def inc_progress(self, e, value=1, total=0):
+        ancestor_ids = self.rollup_ancestor_ids(e)
+        self.call('inc_progress')
+        now = self.now()
+        with self.lock:
+            for k, f, n in [(e.id, 'curr_prog', value),
+                            (e.id, 'prog_tot', total)] + \
+                    [(a, 'sub_curr_prog', value) for a in ancestor_ids] + \
+                    [(a, 'sub_prog_tot', total) for a in ancestor_ids]:
+                r = self.records.setdefault(k, {})
+                r[f] = r.get(f, 0) + n
+            for k in [e.id] + ancestor_ids:
+                self.records[k]['lu'] = to_micros(now)
+                self.changes.setdefault(e.root_id, {})[k] = now
+
+
+DONE_STATUSES = ['Succeeded', 'Canceled', 'Failed']
+# trackers store these statuses as their index into STATUSES, and any
+# other status as the string itself
+STATUSES = ['Not started', 'In Progress', 'Paused'] + DONE_STATUSES
+STATUS_CODES = dict([(s, i) for i, s in enumerate(STATUSES)])
+
+
+def status_rank(s):
+    """Returns how far along a status is, for merging concurrent writes."""
+    if s is None:
+        return -1
+    if s == 'Not started':
+        return 0
+    if s in DONE_STATUSES:
+        return 2
+    return 1
+
+
+def status_code(s):
+    """Returns what a status is stored as: its index in STATUSES, or the
+    status itself if it isn't one of them."""
+    return STATUS_CODES.get(s, s)
+
+
+def to_epoch(t):
+    """Returns an arrow object, datetime or ISO 8601 string as epoch
+    seconds."""
+    if t is None or isinstance(t, float):
+        return t
+    if isinstance(t, (int, long)):
+        return float(t)
+    import arrow
+    return arrow.get(t).float_timestamp
+
+
+def from_epoch(e):
+    if e is None:
+        return None
+    import arrow
+    return arrow.get(e)
+
+
+def to_micros(e):
+    return int(round(e * 1000000))
+
+
+def read_counts(j, prefix, total):
+    """Returns the status counts and the descendant count a record has for
+    its subtree, kept in fields named prefix + status and total."""
+    counts = dict([(k[len(prefix):], int(v)) for k, v in j.iteritems()
+                   if k.startswith(prefix)])
+    return counts, int(j.get(total, 0))
+
+
+def count_deltas(old, new):
+    """Returns the changes by status that turn the counts old into new."""
+    deltas = dict([(s, -n) for s, n in (old or {}).iteritems()])
+    for s, n in (new or {}).iteritems():
+        deltas[s] = deltas.get(s, 0) + n
+    return deltas
 
 
 class TrackerBase(object):
+    # trees can hold millions of trackers, so they keep their fields in
+    # slots instead of a per-instance dict
+    __slots__ = ('friendly_id', 'id', 'name', 'parent', 'index',
+                 '_is_dirty', 'status_counts', 'descendant_count', '_status',
+                 '_estimate_rollup', 'estimated_seconds', 'parent_id',
+                 'status_msg', 'message', '_last_update', 'source',
+                 'is_in_progress', 'is_done', 'metric', 'metric_name',
+                 'metric_namespace', '_start_time', '_finish_time', 'db_conn',
+                 'metrics_buffer', 'autosave', 'current_progress',
+                 'progress_total', 'sub_current_progress',
+                 'sub_progress_total', 'pending_progress',
+                 'pending_progress_total', 'progress_flushed_at',
+                 'progress_batch_size', 'progress_flush_interval',
+                 'has_parallel_children', '_children', 'unloaded_child_ids',
+                 '_root_id', 'summary', 'version', 'counted_status')
+
     def __init__(self, **kwargs):
         self.friendly_id = kwargs.get('FriendlyId', None)
-        self.id = kwargs.get('Id', str(uuid.uuid4()))
+        self.id = kwargs.get('Id') or str(uuid.uuid4())
         self.name = kwargs.get('Name', self.id)
-        self.children = []
-        self.state = TrackerState()
+        self._children = []
+        self.unloaded_child_ids = None
+        self._root_id = None
+        # set when compact() has replaced the subtree
+        self.summary = None
+        # the stored version this tracker was read or last written at
+        self.version = 0
+        self.parent = None
+        self.index = None
+        self._is_dirty = False
+        # only trackers with children keep status counts
+        self.status_counts = None
+        self.descendant_count = 0
+        # the status the stored counts of the ancestors have for it
+        self.counted_status = NOT_COUNTED
+        self._status = None
+        self._estimate_rollup = None
         self.estimated_seconds = kwargs.get('EstimatedSeconds', 0)
         self.parent_id = kwargs.get('ParentId', None)
         self.status_msg = None
-        self.last_update = arrow.utcnow()
+        self.message = None
+        self._last_update = time.time()
         self.source = kwargs.get('Source', None)
         self.is_in_progress = False
         self.is_done = False
@@ -344,18 +1899,388 @@ class TrackerBase(object):
         self.metric = None
         self.metric_name = None
         self.metric_namespace = None
-        self.finish_time = None
+        self._start_time = None
+        self._finish_time = None
         self.db_conn = kwargs.get('DbConnection')
-        self.parent = None
+        self.metrics_buffer = kwargs.get('MetricsBuffer')
+        self.autosave = False
+        self.current_progress = 0
+        self.progress_total = 0
+        self.sub_current_progress = 0
+        self.sub_progress_total = 0
+        self.pending_progress = 0
+        self.pending_progress_total = 0
+        self.progress_flushed_at = self._last_update
+        self.progress_batch_size = kwargs.get('ProgressBatchSize', 100)
+        self.progress_flush_interval = kwargs.get('ProgressFlushInterval', 1)
         self.is_dirty = True
         self.has_parallel_children = kwargs.get('HasParallelChildren', False)
+        self.with_start_time(kwargs.get('StartTime'))
 
-    def load(self, id):
+    @property
+    def status(self):
+        if self._status is None or not isinstance(self._status, int):
+            return self._status
+        return STATUSES[self._status]
+
+    @status.setter
+    def status(self, s):
+        old = self.status
+        if old == s:
+            return
+        self._status = status_code(s) if s is not None else None
+        self.invalidate_estimates()
+        deltas = {s: 1}
+        if old is not None:
+            deltas[old] = -1
+        if self.parent:
+            self.parent.apply_status_deltas(deltas, 0)
+
+    @property
+    def start_time(self):
+        return from_epoch(self._start_time)
+
+    @start_time.setter
+    def start_time(self, s):
+        self._start_time = to_epoch(s)
+
+    @property
+    def finish_time(self):
+        return from_epoch(self._finish_time)
+
+    @finish_time.setter
+    def finish_time(self, f):
+        self._finish_time = to_epoch(f)
+
+    @property
+    def last_update(self):
+        return from_epoch(self._last_update)
+
+    @last_update.setter
+    def last_update(self, d):
+        self._last_update = to_epoch(d)
+
+    @property
+    def children(self):
+        if self.unloaded_child_ids:
+            self.load_children()
+        return self._children
+
+    @property
+    def root_id(self):
+        """The id of the root of the whole tree, even when only a subtree of
+        it is loaded."""
+        t = self
+        while t.parent:
+            t = t.parent
+        return t._root_id or t.id
+
+    def with_root_id(self, r):
+        self._root_id = r if r != self.id else None
+        return self
+
+    @property
+    def loaded_children(self):
+        """The children that are in memory, without loading lazy ones."""
+        return self._children
+
+    @property
+    def is_dirty(self):
+        return self._is_dirty
+
+    @is_dirty.setter
+    def is_dirty(self, d):
+        self._is_dirty = d
+        if self.index:
+            if d:
+                self.index.dirty[self.id] = self
+            else:
+                self.index.dirty.pop(self.id, None)
+
+    @property
+    def depth(self):
+        d = 0
+        p = self.parent
+        while p:
+            d = d + 1
+            p = p.parent
+        return d
+
+    def apply_status_deltas(self, deltas, added):
+        """Applies per-status count changes to this tracker and its ancestors.
+
+        deltas maps a status to the change in the number of descendants with
+        that status, and added is the change in the total descendant count.
+        """
+        t = self
+        while t:
+            counts = t.status_counts
+            if counts is None:
+                counts = t.status_counts = {}
+            for k, v in deltas.iteritems():
+                n = counts.get(k, 0) + v
+                if n:
+                    counts[k] = n
+                else:
+                    counts.pop(k, None)
+            t.descendant_count = t.descendant_count + added
+            t = t.parent
+        return self
+
+    def subtree_status_deltas(self):
+        """Returns the status counts of this tracker and all its descendants."""
+        deltas = dict(self.status_counts or {})
+        if self.status is not None:
+            deltas[self.status] = deltas.get(self.status, 0) + 1
+        return deltas
+
+    def count_changes(self):
+        """Returns how the stored status counts of this tracker's ancestors
+        have to change to count its status: deltas by status, and 1 if they
+        don't count it at all yet."""
+        s = self.status
+        c = self.counted_status
+        if c == s:
+            return {}, 0
+        deltas = {}
+        if s is not None:
+            deltas[s] = 1
+        if c is NOT_COUNTED:
+            return deltas, 1
+        if c is not None:
+            deltas[c] = -1
+        return deltas, 0
+
+    def with_stored_counts(self, counts, n):
+        """Takes the status counts a record has for its tracker's subtree,
+        for as long as the children aren't loaded. The stored counts of the
+        ancestors already count the tracker's own status."""
+        self.counted_status = self.status
+        if n and self.summary is None:
+            self.status_counts = dict([(s, c) for s, c in counts.iteritems()
+                                       if c])
+            self.descendant_count = n
+        return self
+
+    def get_status_count(self, status):
+        self.load_subtree(True)
+        counts = self.status_counts or {}
+        return sum([counts.get(s, 0) for s in status])
+
+    def load(self, id, **kwargs):
+        """Loads a tracker tree. With Depth, only trackers up to that many
+        levels below the root are loaded; deeper ones are loaded the first
+        time their parent's children are used."""
         self.id = id
-        return self.db_conn.get_all_by_id(id)
+        return self.db_conn.get_all_by_id(id, kwargs.get('Depth'))
+
+    def with_unloaded_children(self, ids):
+        self.unloaded_child_ids = list(ids)
+        if self.index:
+            self.index.lazy[self.id] = self
+        return self
+
+    def pop_unloaded_child_ids(self):
+        """Returns the ids of the children that haven't been loaded yet.
+        The stored progress rollup and status counts are taken off this
+        tracker and its ancestors, since they are rebuilt as the children are
+        attached."""
+        ids = self.unloaded_child_ids or []
+        self.unloaded_child_ids = None
+        if self.index:
+            self.index.lazy.pop(self.id, None)
+        c = self.sub_current_progress
+        tot = self.sub_progress_total
+        p = self
+        while p:
+            p.sub_current_progress = p.sub_current_progress - c
+            p.sub_progress_total = p.sub_progress_total - tot
+            p = p.parent
+        self.apply_status_deltas(
+            dict([(s, -n) for s, n in (self.status_counts or {}).iteritems()]),
+            -self.descendant_count)
+        return ids
+
+    def load_children(self):
+        if self.unloaded_child_ids:
+            self.db_conn.load_children([self])
+        return self
+
+    def load_subtree(self, uncounted=False):
+        """Loads every lazily loaded descendant, a level at a time. With
+        uncounted, only those whose records don't have the status counts of
+        their subtree, such as records written before the counts were
+        stored, are loaded."""
+        while True:
+            if self.index:
+                lazy = [t for t in self.index.lazy.values()
+                        if t is self or TrackerIndex.is_descendant(t, self)]
+            else:
+                lazy = []
+                stack = [self]
+                while stack:
+                    n = stack.pop()
+                    if n.unloaded_child_ids:
+                        lazy.append(n)
+                    stack.extend(n.loaded_children)
+            if uncounted:
+                lazy = [t for t in lazy if not t.descendant_count]
+            if not lazy:
+                return self
+            lazy[0].db_conn.load_children(lazy)
 
     def refresh(self):
-        self = self.load(self.id)
+        """Updates the loaded tree in place with the trackers written to the
+        DB since it was loaded or last refreshed. Trackers with changes that
+        haven't been written yet keep them."""
+        if not self.index:
+            TrackerIndex().with_tree(self)
+        index = self.index
+        since = index.synced_at
+        if since is not None:
+            since = since - self.db_conn.refresh_overlap
+        changes, synced = self.db_conn.get_changes(self.root_id, since)
+        new_children = []
+        for id, j, children in changes:
+            t = index.ids.get(id)
+            if t is None or t.is_dirty:
+                # new trackers come in through their parent's children
+                continue
+            new_children.extend(
+                t.merge_stored(self.db_conn.from_json(id, j), children))
+        if new_children:
+            parents = set([p for c, p in new_children])
+            self.db_conn.load_levels(new_children, 0)
+            for p in parents:
+                p.is_dirty = False
+        if synced is not None:
+            index.synced_at = max(synced, index.synced_at or synced)
+        return self
+
+    def merge_stored(self, s, child_ids):
+        """Copies a freshly loaded copy of this tracker's record into it.
+        Returns (id, parent) pairs for children that aren't loaded yet."""
+        if s._last_update == self._last_update and \
+                set(child_ids or []) == set(self.child_ids):
+            return []
+        self.name = s.name
+        self.with_estimated_seconds(s.estimated_seconds, True)
+        self.with_start_time(s._start_time, True)
+        self.with_finish_time(s._finish_time, True)
+        self.with_status_msg(s.status_msg, True)
+        self.with_friendly_id(s.friendly_id, True)
+        self.with_source(s.source, True)
+        if s.metric_name:
+            self.with_metric(Namespace=s.metric_namespace,
+                             Metric=s.metric_name, Clean=True)
+        if not self.has_parallel_children == s.has_parallel_children:
+            self.has_parallel_children = s.has_parallel_children
+            self.invalidate_estimates()
+        self.is_in_progress = s.is_in_progress
+        self.is_done = s.is_done
+        self.status = s.status
+        self.counted_status = s.counted_status
+        self._last_update = s._last_update
+        self.version = s.version
+
+        # increments that haven't been sent yet stay on top of the stored
+        # counters
+        c = s.current_progress + self.pending_progress - self.current_progress
+        tot = s.progress_total + self.pending_progress_total - \
+            self.progress_total
+        if c or tot:
+            self.apply_progress_deltas(c, tot)
+        if self.unloaded_child_ids:
+            # nothing below is loaded, so the stored rollup is the best there
+            # is
+            c = s.sub_current_progress - self.sub_current_progress
+            tot = s.sub_progress_total - self.sub_progress_total
+            p = self
+            while p:
+                p.sub_current_progress = p.sub_current_progress + c
+                p.sub_progress_total = p.sub_progress_total + tot
+                p = p.parent
+            if s.descendant_count:
+                self.apply_status_deltas(
+                    count_deltas(self.status_counts, s.status_counts),
+                    s.descendant_count - self.descendant_count)
+            self.with_unloaded_children(child_ids or [])
+            return []
+        if self.summary is not None:
+            return []
+        loaded = set([c.id for c in self._children])
+        return [(c, self) for c in child_ids or [] if c not in loaded]
+
+    def apply_change(self, e):
+        """Applies a change event published by RedisProgressManager to the
+        tree this tracker is in. Returns False if the event was ignored."""
+        if not self.index:
+            TrackerIndex().with_tree(self)
+        t = self.index.ids.get(e['id'])
+        if 'cd' in e:
+            # loaded trackers are counted by their own change event
+            return t is None and self.apply_unloaded_counts(e)
+        if t is None:
+            return self.apply_unloaded_change(e)
+        if t.is_dirty:
+            return False
+        if 'dc' in e:
+            t.apply_progress_deltas(e['dc'], e['dt'])
+        else:
+            t.with_start_time(e.get('start'), True)
+            t.with_finish_time(e.get('fin'), True)
+            t.is_in_progress = e['st'] == 'In Progress'
+            t.is_done = e['st'] in DONE_STATUSES
+            t.status = e['st']
+            t.counted_status = t.status
+            c = e['cp'] + t.pending_progress - t.current_progress
+            tot = e['pt'] + t.pending_progress_total - t.progress_total
+            if c or tot:
+                t.apply_progress_deltas(c, tot)
+        t.last_update = e['ts']
+        return True
+
+    def apply_unloaded_counts(self, e):
+        """Applies the status count changes of a tracker that isn't loaded.
+        Only the stored counts of its nearest loaded ancestor change, and only
+        while that ancestor's children aren't loaded."""
+        for a in e['aids']:
+            p = self.index.ids.get(a)
+            if p:
+                if not p.unloaded_child_ids or not p.descendant_count:
+                    return False
+                p.apply_status_deltas(e['cd'], e['ca'])
+                return True
+        return False
+
+    def apply_unloaded_change(self, e):
+        ids = self.index.ids
+        if 'dc' in e:
+            # only the rollup of the nearest loaded ancestor can change
+            for a in e['aids']:
+                p = ids.get(a)
+                if p:
+                    if not p.unloaded_child_ids:
+                        return False
+                    while p:
+                        p.sub_current_progress = p.sub_current_progress + \
+                            e['dc']
+                        p.sub_progress_total = p.sub_progress_total + e['dt']
+                        p = p.parent
+                    return True
+            return False
+        parent = ids.get(e.get('pid'))
+        if not parent or parent.summary is not None:
+            return False
+        if parent.unloaded_child_ids:
+            if e['id'] not in parent.unloaded_child_ids:
+                parent.unloaded_child_ids.append(e['id'])
+            return True
+        # a new tracker: read its record and attach it
+        dirty = parent.is_dirty
+        self.db_conn.load_levels([(e['id'], parent)], 0)
+        parent.is_dirty = dirty
+        return e['id'] in ids
 
     def print_node(self, lvl=0):
         if lvl > 0:
@@ -372,14 +2297,12 @@ class TrackerBase(object):
         self.print_node()
 
     def get_tracker_progress_total(self, pe=None):
-        t = 0
-        c = 0
+        """Returns the current and total progress units of a tracker,
+        including all its descendants."""
         if pe is None:
             pe = self
-        for k in pe.progress_trackers.keys():
-            e = pe.progress_trackers[k]
-            t = t + e.progress_total
-            c = c + e.current_progress
+        c = pe.current_progress + pe.sub_current_progress
+        t = pe.progress_total + pe.sub_progress_total
         return c, t
 
     def get_progress_remaining(self):
@@ -390,14 +2313,106 @@ class TrackerBase(object):
         c, t = self.get_tracker_progress_total()
         return 1.0 * c/t if t else 0
 
+    @property
+    def child_ids(self):
+        return [c.id for c in self._children] + \
+            list(self.unloaded_child_ids or [])
+
+    def snapshot(self):
+        return TrackerSnapshot(self)
+
     def get_full_key(self):
         if not self.parent_id:
             return self.id
         else:
             return "{}".format(self.id)
 
+    @property
+    def ancestors(self):
+        """The loaded ancestors of this tracker, nearest first."""
+        ancestors = []
+        p = self.parent
+        while p:
+            ancestors.append(p)
+            p = p.parent
+        return ancestors
+
+    @property
+    def ancestor_ids(self):
+        return [p.id for p in self.ancestors]
+
+    @property
+    def unloaded_ancestry(self):
+        """The id and parent id of the topmost loaded tracker of this one's
+        branch when that tracker has a parent that isn't loaded, else None."""
+        top = self
+        while top.parent:
+            top = top.parent
+        if top.parent_id:
+            return top.id, top.parent_id
+        return None
+
+    def add_subtree_progress(self, t):
+        c, tot = t.get_tracker_progress_total()
+        p = self
+        while p:
+            p.sub_current_progress = p.sub_current_progress + c
+            p.sub_progress_total = p.sub_progress_total + tot
+            p = p.parent
+        return self
+
+    def apply_progress_deltas(self, value, total):
+        self.current_progress = self.current_progress + value
+        self.progress_total = self.progress_total + total
+        p = self.parent
+        while p:
+            p.sub_current_progress = p.sub_current_progress + value
+            p.sub_progress_total = p.sub_progress_total + total
+            p = p.parent
+        return self
+
     def inc_progress(self, val=1):
-        self.db_conn.inc_progress(val)
+        """Counts units of work done. Increments are sent to the DB once
+        progress_batch_size of them are waiting or progress_flush_interval
+        seconds have passed, and whenever the tracker is updated."""
+        self.apply_progress_deltas(val, 0)
+        self.pending_progress = self.pending_progress + val
+        if self.index:
+            self.index.pending_progress[self.id] = self
+        if abs(self.pending_progress) >= self.progress_batch_size or \
+                time.time() - self.progress_flushed_at >= \
+                self.progress_flush_interval:
+            self.flush_progress()
+        return self
+
+    def with_progress_total(self, n):
+        if not self.progress_total == n:
+            delta = n - self.progress_total
+            self.apply_progress_deltas(0, delta)
+            self.pending_progress_total = self.pending_progress_total + delta
+            if self.index:
+                self.index.pending_progress[self.id] = self
+        return self
+
+    def with_loaded_progress(self, current, total, sub_current, sub_total):
+        self.current_progress = int(current or 0)
+        self.progress_total = int(total or 0)
+        self.sub_current_progress = int(sub_current or 0)
+        self.sub_progress_total = int(sub_total or 0)
+        return self
+
+    def flush_progress(self):
+        if not self.db_conn:
+            return self
+        if self.pending_progress or self.pending_progress_total:
+            self.db_conn.inc_progress(self, self.pending_progress,
+                                      self.pending_progress_total)
+            self.pending_progress = 0
+            self.pending_progress_total = 0
+        self.progress_flushed_at = time.time()
+        if self.index:
+            self.index.pending_progress.pop(self.id, None)
+        return self
 
     @property
     def stats(self):
@@ -417,38 +2432,195 @@ class TrackerBase(object):
         tot = tot + len(t.children)
         return tot
 
+    def invalidate_estimates(self):
+        """Drops the cached estimates of this tracker and its ancestors."""
+        t = self
+        while t and t._estimate_rollup is not None:
+            t._estimate_rollup = None
+            t = t.parent
+        return self
+
     @property
-    def total_estimate(self):
+    def estimate_rollup(self):
+        if self._estimate_rollup is None:
+            self.load_subtree()
+        return self.loaded_estimate_rollup()
+
+    def loaded_estimate_rollup(self):
+        if self._estimate_rollup is None:
+            self._estimate_rollup = self.build_estimate_rollup()
+        return self._estimate_rollup
+
+    def build_estimate_rollup(self):
+        if self.summary is not None:
+            return EstimateRollup(self.summary['estimate'])
+        if not len(self.children):
+            return self.build_leaf_estimate_rollup()
+
+        rollups = [k.loaded_estimate_rollup() for k in self.children]
         if self.has_parallel_children:
-            longest = 0
-
-        secs = 0
-        if len(self.children):
-            for k in self.children:
-                tot = int(k.total_estimate)
-                if self.has_parallel_children and tot > longest:
-                    longest = tot
-                else:
-                    secs = secs + tot
-        else:
-            return int(self.estimated_seconds)
+            return EstimateRollup(max([r.total for r in rollups]))
+
+        static = 0
+        deadlines = []
+        parallel = []
+        for k, r in zip(self.children, rollups):
+            if k.has_parallel_children and len(k.children):
+                parallel.append(k)
+                continue
+            static = static + r.static
+            deadlines.extend(r.deadlines)
+            parallel.extend(r.parallel)
+        return EstimateRollup(sum([r.total for r in rollups]), static,
+                              deadlines, parallel)
+
+    def build_leaf_estimate_rollup(self):
+        est = int(self.estimated_seconds)
+        if self.status in DONE_STATUSES:
+            return EstimateRollup(est)
+        start = self._start_time
+        if 'Not started' in self.status or start is None:
+            return EstimateRollup(est, est)
+        if self._finish_time is not None:
+            return EstimateRollup(
+                est, max(0, est - self.elapsed_time_in_seconds))
+        return EstimateRollup(est, deadlines=[start + est])
+
+    def remaining_at(self, now):
+        if self.has_parallel_children and len(self.children):
+            return max([k.remaining_at(now) for k in self.children])
+        return self.estimate_rollup.remaining_at(now)
 
-        if self.has_parallel_children:
-            return longest
-        else:
-            return secs
+    @property
+    def total_estimate(self):
+        return self.estimate_rollup.total
 
     def get_children_by_status(self, status):
+        self.load_subtree()
+        items = []
+        stack = list(reversed(self.children))
+        while stack:
+            k = stack.pop()
+            if len(status) == 0 or k.status in status:
+                items.append(k)
+            if k.summary is not None:
+                items.extend(k.get_compacted_by_status(status))
+            stack.extend(reversed(k.children))
+        return items
+
+    def get_compacted_by_status(self, status):
+        """Returns the trackers compact() took out of the tree that have one
+        of the statuses, read from the DB. Nothing is read when the summary
+        counts say none of them match."""
+        counts = self.status_counts or {}
+        if status and not sum([counts.get(s, 0) for s in status]):
+            return []
+        ids = self.db_conn.get_level([self.id], [self.root_id])[0][1]
         items = []
-        if len(self.children):
-            for k in self.children:
-                if len(status) == 0 or k.status in status:
-                    items.append(k)
-                match = k.get_children_by_status(status)
-                if len(match) > 0:
-                    items.extend(match)
+        for c in self.db_conn.load_levels([(i, None) for i in ids or []]):
+            if len(status) == 0 or c.status in status:
+                items.append(c)
+            items.extend(c.get_children_by_status(status))
         return items
 
+    def compact(self):
+        """Replaces the finished subtree below this tracker with a summary
+        of it: counts by status, the estimate, the total and critical path
+        durations of the leaves and the first start and last finish.
+
+        The subtree is written first and its records are left in the DB,
+        where expand() reads them back. Counts, progress, estimates and
+        get_children_by_status still see the compacted trackers; find_id
+        and find_friendly_id don't. Loads stop at a compacted tracker.
+        """
+        if self.summary is not None:
+            return self
+        self.load_subtree()
+        if not self._children:
+            return self
+        if not self.db_conn:
+            raise Exception("{} can't be compacted without a DbConnection"
+                            .format(self.id))
+        if not self.is_done or \
+                self.get_status_count(DONE_STATUSES) < self.descendant_count:
+            raise Exception("{} isn't finished and can't be compacted"
+                            .format(self.id))
+        self.update()
+
+        nodes = []
+        stack = list(self._children)
+        while stack:
+            n = stack.pop()
+            nodes.append(n)
+            stack.extend(n._children)
+        critical = {}
+        total = 0
+        starts = []
+        finishes = []
+        # children come after their parents in nodes
+        for n in reversed(nodes):
+            if n._start_time is not None:
+                starts.append(n._start_time)
+            if n._finish_time is not None:
+                finishes.append(n._finish_time)
+            if n._children:
+                paths = [critical.pop(c.id) for c in n._children]
+                critical[n.id] = max(paths) if n.has_parallel_children \
+                    else sum(paths)
+            else:
+                secs = 0
+                if n._start_time is not None and n._finish_time is not None:
+                    secs = n._finish_time - n._start_time
+                total = total + secs
+                critical[n.id] = secs
+        paths = [critical[c.id] for c in self._children]
+        summary = {
+            'counts': dict(self.status_counts or {}),
+            'trackers': self.descendant_count,
+            'estimate': self.loaded_estimate_rollup().total,
+            'total_seconds': total,
+            'critical_path_seconds': max(paths)
+            if self.has_parallel_children else sum(paths),
+            'first_start': min(starts) if starts else None,
+            'last_finish': max(finishes) if finishes else None
+        }
+
+        if self.index:
+            self.index.without_descendants(self)
+        self._children = []
+        self.summary = summary
+        self.invalidate_estimates()
+        self.is_dirty = True
+        self.update(False)
+        return self
+
+    def expand(self):
+        """Puts back the subtree compact() replaced, reading it from the
+        DB. The tracker is written again without its summary on the next
+        update."""
+        if self.summary is None:
+            return self
+        ids = self.db_conn.get_level([self.id], [self.root_id])[0][1]
+        # the counts are added back as the children are attached
+        self.apply_status_deltas(
+            dict([(s, -n) for s, n in (self.status_counts or {}).iteritems()]),
+            -self.descendant_count)
+        self.summary = None
+        self.invalidate_estimates()
+        self.with_unloaded_children(ids or [])
+        self.load_children()
+        self.is_dirty = True
+        return self
+
+    def with_summary(self, summary):
+        """Sets the summary of a compacted subtree on a tracker that isn't
+        in a tree yet."""
+        self.summary = summary
+        self.status_counts = dict(summary['counts'])
+        self.descendant_count = summary['trackers']
+        self.invalidate_estimates()
+        return self
+
     def start(self, **kwargs):
         if self.is_in_progress:
             logging.warning('{} is already started. Ignoring start()'
@@ -460,15 +2632,15 @@ class TrackerBase(object):
         m = kwargs.get('Message', None)
         if m:
             self.with_status_msg(m)
-        self.start_time = kwargs.get('StartTime', arrow.utcnow())
+        start = to_epoch(kwargs.get('StartTime')) or time.time()
         if bool(kwargs.get('Parents', False)):
             if self.parent:
                 self.parent.start(Parents=True)
         if self.parent and not self.parent.is_in_progress:
             raise Exception("You can't start a tracker if the parent isn't " +
                             'started')
-        self.state.start(StartTime=self.start_time,
-                         EstimatedSeconds=self.estimated_seconds)
+        self._start_time = start
+        self.invalidate_estimates()
         self.status = 'In Progress'
         self.is_in_progress = True
         self.is_dirty = True
@@ -489,40 +2661,25 @@ class TrackerBase(object):
     @property
     def remaining_tracker_time_in_seconds(self):
         """Returns the time remaining of all in progress or not started trackers"""
-        if self.has_parallel_children:
-            longest = 0
-
-        secs = 0
-        if len(self.children):
-            for k in self.children:
-                remain = int(k.remaining_tracker_time_in_seconds)
-                if self.has_parallel_children and remain > longest:
-                    longest = remain
-                else:
-                    secs = secs + remain
-        else:
-            if self.status in ['Succeeded', 'Canceled', 'Failed']:
-                report = 0
-            elif 'Not started' in self.status:
-                report = self.total_estimate
-            else:
-                report = max(
-                    0, self.total_estimate - self.elapsed_time_in_seconds)
-
-        if self.has_parallel_children:
-            return longest
-        else:
-            return secs
+        return int(round(self.remaining_at(time.time())))
 
     @property
     def elapsed_time_in_seconds(self):
-        return self.state.elapsed_time_in_seconds()
+        if self._start_time is None:
+            return 0
+        end = self._finish_time
+        if end is None:
+            end = time.time()
+        return int(round(end - self._start_time))
 
     def update(self, recursive=True):
         p = self.parent
         if p:
             p.update(False)
 
+        if self.pending_progress or self.pending_progress_total:
+            self.flush_progress()
+
         if self.is_dirty:
             try:
                 self.db_conn.update_tracker(self)
@@ -532,7 +2689,8 @@ class TrackerBase(object):
             self.is_dirty = False
 
         if recursive:
-            for c in self.children:
+            # children that aren't loaded can't have changed
+            for c in self._children:
                 c.update()
         return self
 
@@ -543,12 +2701,12 @@ class TrackerBase(object):
         if self.estimated_seconds:
             ue = ue + ', EstimatedSeconds=:est_sec'
             eav[':est_sec'] = str(self.estimated_seconds)
-        if self.state.start_time:
+        if self.start_time:
             ue = ue + ', StartTime=:start'
-            eav[':start'] = self.state.start_time.isoformat()
-        if self.state.finish_time:
+            eav[':start'] = self.start_time.isoformat()
+        if self.finish_time:
             ue = ue + ', FinishTime=:finish'
-            eav[':finish'] = self.state.finish_time.isoformat()
+            eav[':finish'] = self.finish_time.isoformat()
         if self.status_msg:
             ue = ue + ', StatusMessage=:status_msg'
             eav[':status_msg'] = self.status_msg
@@ -561,6 +2719,10 @@ class TrackerBase(object):
         if self.last_update:
             ue = ue + ', LastUpdate=:l_u'
             eav[':l_u'] = self.last_update.isoformat()
+            ue = ue + ', UpdatedAt=:u_a'
+            eav[':u_a'] = to_micros(self._last_update)
+        ue = ue + ', RootId=:rid'
+        eav[':rid'] = self.root_id
         if self.source:
             ue = ue + ', Source=:source'
             eav[':source'] = self.source
@@ -587,10 +2749,10 @@ class TrackerBase(object):
         j['name'] = self.name
         if self.estimated_seconds:
             j['est_sec'] = self.estimated_seconds
-        if self.state.start_time:
-            j['start'] = self.state.start_time.isoformat()
-        if self.state.finish_time:
-            j['finish'] = self.state.finish_time.isoformat()
+        if self.start_time:
+            j['start'] = self.start_time.isoformat()
+        if self.finish_time:
+            j['finish'] = self.finish_time.isoformat()
         if self.status_msg:
             j['st_msg'] = self.status_msg
         if self.parent_id:
@@ -599,6 +2761,7 @@ class TrackerBase(object):
             j['fid'] = self.friendly_id
         if self.last_update:
             j['l_u'] = self.last_update.isoformat()
+        j['rid'] = self.root_id
         if self.source:
             j['s'] = self.source
         if self.metric_namespace:
@@ -615,92 +2778,120 @@ class TrackerBase(object):
     @staticmethod
     def from_json(id, j):
         t = ProgressTracker(Id=id)
-        if 'name' in j.keys():
+        if 'name' in j:
             t.with_name(j['name'], True)
-        if 'est_sec' in j.keys():
+        if 'est_sec' in j:
             t.with_estimated_seconds(j['est_sec'], True)
-        if 'start' in j.keys():
-            t.with_start_time(arrow.get(j['start']), True)
-        if 'finish' in j.keys():
-            t.with_finish_time(arrow.get(j['finish']), True)
-        if 'st_msg' in j.keys():
-            t.with_status_msg(arrow.get(j['st_msg']), True)
-        if 'fid' in j.keys():
+        if 'start' in j:
+            t.with_start_time(j['start'], True)
+        if 'finish' in j:
+            t.with_finish_time(j['finish'], True)
+        if 'st_msg' in j:
+            t.with_status_msg(j['st_msg'], True)
+        if 'fid' in j:
             t.with_friendly_id(j['fid'], True)
-        if 'pid' in j.keys():
+        if 'pid' in j:
             t.parent_id = j['pid']
-        if 'in_p' in j.keys():
+        if 'rid' in j:
+            t.with_root_id(j['rid'])
+        if 'in_p' in j:
             t.is_in_progress = str(j['in_p']) == 'True'
-        if 'st' in j.keys():
+        if 'st' in j:
             t.status = j['st']
-        if 's' in j.keys():
+        if 's' in j:
             t.with_source(j['s'], True)
-        if 'd' in j.keys():
+        if 'd' in j:
             t.is_done = str(j['d']) == 'True'
-        if 'has_p' in j.keys():
+        if 'has_p' in j:
             t.has_parallel_children = str(j['has_p']) == 'True'
-        if 'm_ns' in j.keys() and 'm' in j.keys():
+        if 'm_ns' in j and 'm' in j:
             ns = j['m_ns']
             m = j['m']
             t.with_metric(Namespace=ns, Metric=m, Clean=True)
+        t.with_loaded_progress(j.get('curr_prog'), j.get('prog_tot'),
+                               j.get('sub_curr_prog'), j.get('sub_prog_tot'))
+        if 'l_u' in j:
+            t.last_update = j['l_u']
+        t.with_stored_counts(*read_counts(j, 'n:', 'n'))
         t.is_dirty = False
         return t
 
     def with_parallel_children(self):
         if not self.has_parallel_children:
             self.has_parallel_children = True
+            self.invalidate_estimates()
             self.is_dirty = True
         return self
 
     def without_parallel_children(self):
         if self.has_parallel_children:
             self.has_parallel_children = False
+            self.invalidate_estimates()
             self.is_dirty = True
         return self
 
     def with_tracker(self, t):
         t.db_conn = self.db_conn
+        t.metrics_buffer = self.metrics_buffer
         t.parent = self
         t.parent_id = self.id
         self.children.append(t)
+        self.apply_status_deltas(t.subtree_status_deltas(),
+                                 t.descendant_count + 1)
+        self.add_subtree_progress(t)
+        self.invalidate_estimates()
+        if self.index:
+            self.index.with_tree(t)
         self.is_dirty = True
         return self
 
     def with_child(self, c):
+        c.db_conn = self.db_conn
+        c.metrics_buffer = self.metrics_buffer
         c.parent = self
-        t.parent_id = self.id
+        c.parent_id = self.id
         if self.children and c in self.children:
             return self
         self.is_dirty = True
         self.children.append(c)
+        self.apply_status_deltas(c.subtree_status_deltas(),
+                                 c.descendant_count + 1)
+        self.add_subtree_progress(c)
+        self.invalidate_estimates()
+        if self.index:
+            self.index.with_tree(c)
         return self
 
     def with_estimated_seconds(self, e, clean=False):
         if not self.estimated_seconds == e:
             self.estimated_seconds = e
+            self.invalidate_estimates()
             if not clean:
                 self.is_dirty = True
         return self
 
     def with_start_time(self, s, clean=False):
-        if not self.start_time == s:
-            self.start_time = s
-            self.state.start_time = s
+        s = to_epoch(s)
+        if not self._start_time == s:
+            self._start_time = s
+            self.invalidate_estimates()
             if not clean:
                 self.is_dirty = True
         return self
 
     def with_finish_time(self, f, clean=False):
-        if not self.finish_time == f:
-            self.finish_time = f
-            self.state.finish_time = f
+        f = to_epoch(f)
+        if not self._finish_time == f:
+            self._finish_time = f
+            self.invalidate_estimates()
             if not clean:
                 self.is_dirty = True
         return self
 
     def with_last_update(self, d):
-        self.is_dirty = not self.last_update == d
-        self.last_update = d
+        d = to_epoch(d)
+        self.is_dirty = not self._last_update == d
+        self._last_update = d
         return self
 
     def with_autosave(self):
@@ -718,7 +2909,10 @@ class TrackerBase(object):
 
     def with_friendly_id(self, f, clean=False):
         if not self.friendly_id == f:
+            old = self.friendly_id
             self.friendly_id = f
+            if self.index:
+                self.index.with_friendly_id(self, old)
             if not clean:
                 self.is_dirty = True
         return self
@@ -731,6 +2925,7 @@ class TrackerBase(object):
             return self
         self.metric_name = m
         self.metric_namespace = ns
+        from fluentmetrics import FluentMetric
         self.metric = FluentMetric().with_namespace(self.metric_namespace)
         if not clean:
             self.is_dirty = True
@@ -773,31 +2968,31 @@ class TrackerBase(object):
 
     @property
     def not_started_count(self):
-        return len(self.not_started)
+        return self.get_status_count(['Not started'])
 
     @property
     def in_progress_count(self):
-        return len(self.in_progress)
+        return self.get_status_count(['In Progress'])
 
     @property
     def canceled_count(self):
-        return len(self.canceled)
+        return self.get_status_count(['Canceled'])
 
     @property
     def succeeded_count(self):
-        return len(self.succeeded)
+        return self.get_status_count(['Succeeded'])
 
     @property
     def failed_count(self):
-        return len(self.failed)
+        return self.get_status_count(['Failed'])
 
     @property
     def done_count(self):
-        return len(self.done)
+        return self.get_status_count(DONE_STATUSES)
 
     @property
     def paused_count(self):
-        return len(self.paused)
+        return self.get_status_count(['Paused'])
 
     @property
     def not_started(self):
@@ -821,7 +3016,7 @@ class TrackerBase(object):
 
     @property
     def done(self):
-        return self.get_children_by_status(['Succeeded', 'Canceled', 'Failed'])
+        return self.get_children_by_status(DONE_STATUSES)
 
     @property
     def not_done(self):
@@ -837,27 +3032,53 @@ class TrackerBase(object):
 
     @property
     def all_children_count(self):
-        return len(self.all_children)
+        self.load_subtree(True)
+        return self.descendant_count
 
     def find_id(self, f):
+        if not self.index:
+            return self.search_id(f)
+        t = self.index.ids.get(f)
+        if not t and self.index.lazy:
+            self.load_subtree()
+            t = self.index.ids.get(f)
+        if t and TrackerIndex.is_descendant(t, self):
+            return t
+        return None
+
+    def find_friendly_id(self, f):
+        if not self.index:
+            return self.search_friendly_id(f)
+        t = self.index.friendly_ids.get(f)
+        if not t and self.index.lazy:
+            self.load_subtree()
+            t = self.index.friendly_ids.get(f)
+        if not t:
+            return None
+        if TrackerIndex.is_descendant(t, self):
+            return t
+        # the friendly id is shared with a tracker outside of this branch
+        return self.search_friendly_id(f)
+
+    def search_id(self, f):
         found = None
         for c in self.children:
             if c.id == f:
                 found = c
             else:
-                found = c.find_id(f)
+                found = c.search_id(f)
             if found:
                 break
 
         return found
 
-    def find_friendly_id(self, f):
+    def search_friendly_id(self, f):
         found = None
         for c in self.children:
             if c.friendly_id == f:
                 found = c
             else:
-                found = c.find_friendly_id(f)
+                found = c.search_friendly_id(f)
             if found:
                 break
 
@@ -868,6 +3089,9 @@ class TrackerBase(object):
             logging.debug('No metric defined for {}'.format(self.id))
             return self
         try:
+            if self.metrics_buffer:
+                self.metrics_buffer.log_done(self)
+                return self
             self.metric.seconds(MetricName=self.metric_name,
                                 Value=self.elapsed_time_in_seconds)
             self.metric.count(MetricName="{}/{}"
@@ -884,7 +3108,7 @@ class TrackerBase(object):
             return self
         if m:
             self.with_status_msg(m)
-        self.with_finish_time(arrow.utcnow())
+        self.with_finish_time(time.time())
         self.is_done = True
         self.is_in_progress = False
         self.status = status
@@ -920,10 +3144,39 @@ class TrackerBase(object):
         return self
 
 
+class TrackerSnapshot(object):
+    """Copy of the fields the drivers write for a tracker, taken when a
+    write is queued so later changes to the tracker don't leak into it."""
+    FIELDS = ['id', 'name', 'estimated_seconds', 'status_msg', 'friendly_id',
+              'parent_id', '_last_update', 'source', 'metric',
+              'metric_namespace', 'metric_name', 'is_in_progress',
+              'has_parallel_children', 'is_done', 'status', 'child_ids',
+              'current_progress', 'progress_total', 'sub_current_progress',
+              'sub_progress_total', '_start_time', '_finish_time',
+              'root_id', 'summary', 'version', 'status_counts',
+              'descendant_count', 'counted_status', 'ancestor_ids',
+              'unloaded_ancestry']
+
+    def __init__(self, t):
+        for f in self.FIELDS:
+            setattr(self, f, getattr(t, f))
+        self.status_counts = dict(self.status_counts or {})
+        # the live tracker, to put back what a dropped write didn't count
+        self.tracker = t
+
+    start_time = TrackerBase.__dict__['start_time']
+    finish_time = TrackerBase.__dict__['finish_time']
+    last_update = TrackerBase.__dict__['last_update']
+    get_full_key = TrackerBase.__dict__['get_full_key']
+    to_json = TrackerBase.__dict__['to_json']
+    to_update_item = TrackerBase.__dict__['to_update_item']
+    count_changes = TrackerBase.__dict__['count_changes']
+
+
 class ProgressTracker(TrackerBase):
+    __slots__ = ()
+
     def __init__(self, **kwargs):
-        self.start_time = kwargs.get('StartTime', arrow.utcnow().isoformat())
-        self.is_done = False
         super(ProgressTracker, self).__init__(**kwargs)
 
     def with_name(self, n, clean=False):
@@ -941,7 +3194,7 @@ class ProgressTracker(TrackerBase):
 
     def with_timestamp(self, m):
         if not m:
-            m = arrow.utcnow().isoformat()
+            m = from_epoch(time.time()).isoformat()
         self.is_dirty = True
         return self
 
@@ -951,14 +3204,29 @@ class ProgressTracker(TrackerBase):
 
 
 class ProgressMonitor(ProgressTracker):
+    __slots__ = ('trackers', 'main')
+
     def __init__(self, **kwargs):
-        self.trackers = {}
         super(ProgressMonitor, self).__init__(**kwargs)
-        self.trackers[self.id] = self
+        TrackerIndex().with_tree(self)
+        self.trackers = self.index.ids
         self.main = self.trackers[self.id]
         self.db_conn.trackers = self.trackers
 
     def update_all(self):
-        self.update(True)
+        for t in self.index.pending_progress.values():
+            t.flush_progress()
+        dirty = self.index.pop_dirty()
+        if not dirty:
+            return self
+        try:
+            self.db_conn.update_trackers(dirty)
+        except Exception as e:
+            logging.error('Error persisting to DB: {}'.format(str(e)))
+            for t in dirty:
+                t.is_dirty = True
+            raise
+        for t in dirty:
+            t.is_dirty = False
         return self
 
@@ -0,0 +1,222 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+
+#    http://aws.amazon.com/asl/
+
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+"""Compact binary encoding of a tracker record.
+
+A record is a version byte, a flags byte, a status byte, the timestamps
+and estimate the flags say are present, then length-prefixed string
+fields, each tagged with a fixed field id:
+
+    B version | B flags | B status | q start | q finish | d estimate |
+    (B field id | varint length | bytes)*
+
+Timestamps are epoch microseconds. Ids that are uuids are stored as their
+16 raw bytes, with ID_FIELD added to the field id. Decoders skip field
+ids they don't know, so fields can be added without a new version.
+
+A tracker compacted with compact() keeps the summary of its subtree in
+the SUMMARY field, as JSON.
+
+Progress counters and the last update time aren't part of the record;
+the drivers keep them in separate fields so they can be changed on the
+server.
+"""
+import json
+import struct
+from binascii import hexlify, unhexlify
+
+VERSION = 1
+
+IN_PROGRESS = 1
+DONE = 2
+PARALLEL_CHILDREN = 4
+HAS_START = 8
+HAS_FINISH = 16
+HAS_ESTIMATE = 32
+
+# status codes are part of the format, so they can't follow STATUSES
+STATUSES = ['Not started', 'In Progress', 'Paused', 'Succeeded', 'Canceled',
+            'Failed']
+STATUS_CODES = dict([(s, i) for i, s in enumerate(STATUSES)])
+NO_STATUS = 254
+OTHER_STATUS = 255
+
+NAME = 1
+STATUS_MSG = 2
+FRIENDLY_ID = 3
+PARENT_ID = 4
+ROOT_ID = 5
+SOURCE = 6
+METRIC_NAMESPACE = 7
+METRIC_NAME = 8
+STATUS = 9
+SUMMARY = 10
+ID_FIELD = 128
+
+STRING_FIELDS = [(NAME, 'name'), (STATUS_MSG, 'status_msg'),
+                 (FRIENDLY_ID, 'friendly_id'), (SOURCE, 'source'),
+                 (METRIC_NAMESPACE, 'metric_namespace'),
+                 (METRIC_NAME, 'metric_name')]
+# the metric is set up with with_metric once both of its fields are read
+FIELD_NAMES = dict([(f, a) for f, a in STRING_FIELDS
+                    if f not in (METRIC_NAMESPACE, METRIC_NAME)])
+
+HEADER = struct.Struct('<BBB')
+TIME = struct.Struct('<q')
+ESTIMATE = struct.Struct('<d')
+
+
+def to_bytes(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return str(s)
+
+
+def pack_varint(n):
+    out = []
+    while n >= 0x80:
+        out.append(chr((n & 0x7f) | 0x80))
+        n = n >> 7
+    out.append(chr(n))
+    return ''.join(out)
+
+
+def pack_field(out, field, value):
+    b = to_bytes(value)
+    out.append(chr(field))
+    out.append(pack_varint(len(b)))
+    out.append(b)
+
+
+def format_id(b):
+    h = hexlify(b)
+    return '{}-{}-{}-{}-{}'.format(h[:8], h[8:12], h[12:16], h[16:20], h[20:])
+
+
+def pack_id(out, field, value):
+    b = None
+    if len(value) == 36:
+        try:
+            b = unhexlify(value.replace('-', ''))
+        except TypeError:
+            pass
+    # only ids that come back exactly the same are packed
+    if b and len(b) == 16 and format_id(b) == value:
+        out.append(chr(field | ID_FIELD))
+        out.append(b)
+    else:
+        pack_field(out, field, value)
+
+
+def encode(t):
+    """Returns the record of a tracker, or of a snapshot of one."""
+    flags = 0
+    if t.is_in_progress:
+        flags = flags | IN_PROGRESS
+    if t.is_done:
+        flags = flags | DONE
+    if t.has_parallel_children:
+        flags = flags | PARALLEL_CHILDREN
+    if t._start_time is not None:
+        flags = flags | HAS_START
+    if t._finish_time is not None:
+        flags = flags | HAS_FINISH
+    if t.estimated_seconds:
+        flags = flags | HAS_ESTIMATE
+    status = t.status
+    if status is None:
+        code = NO_STATUS
+    else:
+        code = STATUS_CODES.get(status, OTHER_STATUS)
+
+    out = [HEADER.pack(VERSION, flags, code)]
+    if flags & HAS_START:
+        out.append(TIME.pack(int(round(t._start_time * 1000000))))
+    if flags & HAS_FINISH:
+        out.append(TIME.pack(int(round(t._finish_time * 1000000))))
+    if flags & HAS_ESTIMATE:
+        out.append(ESTIMATE.pack(float(t.estimated_seconds)))
+    if code == OTHER_STATUS:
+        pack_field(out, STATUS, status)
+    for field, attr in STRING_FIELDS:
+        v = getattr(t, attr)
+        # the name defaults to the id
+        if v and not (field == NAME and v == t.id):
+            pack_field(out, field, v)
+    if t.summary is not None:
+        pack_field(out, SUMMARY, json.dumps(t.summary, separators=(',', ':'),
+                                            sort_keys=True))
+    if t.parent_id:
+        pack_id(out, PARENT_ID, t.parent_id)
+    root_id = t.root_id
+    if root_id and root_id != t.id:
+        pack_id(out, ROOT_ID, root_id)
+    return ''.join(out)
+
+
+def decode(t, data):
+    """Fills in a new tracker from a record. Returns the tracker."""
+    data = str(data)
+    version, flags, code = HEADER.unpack_from(data)
+    if version > VERSION:
+        raise Exception('Tracker record version {} is newer than this '
+                        'library understands ({})'.format(version, VERSION))
+    pos = HEADER.size
+    if flags & HAS_START:
+        t._start_time = TIME.unpack_from(data, pos)[0] / 1000000.0
+        pos = pos + TIME.size
+    if flags & HAS_FINISH:
+        t._finish_time = TIME.unpack_from(data, pos)[0] / 1000000.0
+        pos = pos + TIME.size
+    if flags & HAS_ESTIMATE:
+        e = ESTIMATE.unpack_from(data, pos)[0]
+        t.estimated_seconds = int(e) if e.is_integer() else e
+        pos = pos + ESTIMATE.size
+    t.is_in_progress = bool(flags & IN_PROGRESS)
+    t.is_done = bool(flags & DONE)
+    t.has_parallel_children = bool(flags & PARALLEL_CHILDREN)
+    status = None if code == NO_STATUS else \
+        STATUSES[code] if code < len(STATUSES) else None
+
+    metric = {}
+    end = len(data)
+    while pos < end:
+        field = ord(data[pos])
+        pos = pos + 1
+        if field & ID_FIELD:
+            value = format_id(data[pos:pos + 16])
+            field = field & ~ID_FIELD
+            pos = pos + 16
+        else:
+            n = 0
+            shift = 0
+            while True:
+                b = ord(data[pos])
+                pos = pos + 1
+                n = n | ((b & 0x7f) << shift)
+                shift = shift + 7
+                if not b & 0x80:
+                    break
+            value = data[pos:pos + n].decode('utf-8')
+            pos = pos + n
+        if field in FIELD_NAMES:
+            setattr(t, FIELD_NAMES[field], value)
+        elif field == PARENT_ID:
+            t.parent_id = value
+        elif field == ROOT_ID:
+            t.with_root_id(value)
+        elif field == STATUS:
+            status = value
+        elif field == SUMMARY:
+            t.with_summary(json.loads(value))
+        elif field in (METRIC_NAMESPACE, METRIC_NAME):
+            metric[field] = value
+    t.status = status
+    if METRIC_NAME in metric:
+        t.with_metric(Namespace=metric.get(METRIC_NAMESPACE),
+                      Metric=metric[METRIC_NAME], Clean=True)
+    return t
@@ -5,12 +5,51 @@
 #    http://aws.amazon.com/asl/
 
 # or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
-import boto3
+import threading
+
+# connections kept open by the shared client, for drivers used from
+# several threads
+MAX_POOL_CONNECTIONS = 25
+
+lock = threading.Lock()
+shared = {}
+# (endpoint, table name) of every table known to exist
+validated_tables = set()
+# (endpoint, table name) of every table known to have TTL on
+ttl_tables = set()
+
+
+def dynamodb_client():
+    """Returns the low-level DynamoDB client shared by every driver in the
+    process, creating it on first use. Clients are thread-safe and hold the
+    connection pool."""
+    with lock:
+        if 'client' not in shared:
+            import boto3
+            from botocore.config import Config
+            config = Config(max_pool_connections=MAX_POOL_CONNECTIONS)
+            shared['client'] = boto3.client('dynamodb', config=config)
+            shared['threads'] = threading.local()
+        return shared['client']
+
+
+def dynamodb_resource():
+    """Returns the calling thread's DynamoDB resource. Resources aren't
+    thread-safe, so each thread gets its own, all on the shared client."""
+    client = dynamodb_client()
+    with lock:
+        threads = shared['threads']
+    if getattr(threads, 'resource', None) is None:
+        import boto3
+        resource = boto3.resource('dynamodb')
+        resource.meta.client = client
+        threads.resource = resource
+    return threads.resource
 
 
 def does_table_exist(table_name, client=None):
     if not client:
-        client = boto3.client('dynamodb')
+        client = dynamodb_client()
 
     try:
         client.describe_table(TableName=table_name)
@@ -20,6 +59,60 @@ def does_table_exist(table_name, client=None):
         return False
 
 
-def validate_table(table_name, create_table):
-    if (not does_table_exist(table_name)):
-        create_table()
+def table_key(table_name, client):
+    return (client.meta.endpoint_url, table_name)
+
+
+def validate_tables(table_names, create_tables, client=None):
+    """Calls create_tables unless every table exists. Tables found once
+    aren't described again by this process. Returns True if the tables
+    had to be created."""
+    if not client:
+        client = dynamodb_client()
+    with lock:
+        unknown = [n for n in table_names
+                   if table_key(n, client) not in validated_tables]
+    if not unknown:
+        return False
+    created = False
+    if not all(does_table_exist(n, client) for n in unknown):
+        create_tables()
+        created = True
+    with lock:
+        validated_tables.update([table_key(n, client) for n in unknown])
+    return created
+
+
+def validate_table(table_name, create_table, client=None):
+    return validate_tables([table_name], create_table, client)
+
+
+def validate_ttl(table_name, attribute, client=None):
+    """Turns on TTL on attribute unless the table already has it on. Tables
+    found with TTL on aren't described again by this process. Returns True
+    if TTL had to be turned on."""
+    if not client:
+        client = dynamodb_client()
+    key = table_key(table_name, client)
+    with lock:
+        if key in ttl_tables:
+            return False
+    description = client.describe_time_to_live(TableName=table_name)
+    status = description['TimeToLiveDescription']['TimeToLiveStatus']
+    enabled = False
+    if status not in ('ENABLED', 'ENABLING'):
+        client.update_time_to_live(
+            TableName=table_name,
+            TimeToLiveSpecification={'Enabled': True,
+                                     'AttributeName': attribute})
+        enabled = True
+    with lock:
+        ttl_tables.add(key)
+    return enabled
+
+
+def clear_validated_tables():
+    """Forgets which tables exist, e.g. after they were deleted."""
+    with lock:
+        validated_tables.clear()
+        ttl_tables.clear()
@@ -0,0 +1,40 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+
+#    http://aws.amazon.com/asl/
+
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+# Redis Cluster has 16384 hash slots
+SLOTS = 16384
+
+
+def crc16(data):
+    """CRC16-XMODEM, the checksum Redis Cluster hashes keys with."""
+    crc = 0
+    for c in data:
+        crc = crc ^ (ord(c) << 8)
+        for i in xrange(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xffff
+            else:
+                crc = (crc << 1) & 0xffff
+    return crc
+
+
+def hash_tag(key):
+    """Returns the part of a key Redis Cluster hashes: the text between the
+    first { and the next }, if it isn't empty, else the whole key."""
+    start = key.find('{')
+    if start != -1:
+        end = key.find('}', start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    return key
+
+
+def key_slot(key):
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return crc16(hash_tag(key)) % SLOTS
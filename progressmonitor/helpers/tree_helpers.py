@@ -0,0 +1,28 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+
+#    http://aws.amazon.com/asl/
+
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+from progressmonitor import ProgressTracker
+
+
+def build_tree(pm, width, depth, friendly=False, **kwargs):
+    """Gives pm width children, and each of them width children, depth
+    levels deep. Trackers are named <level>-<n>; with friendly, their
+    friendly id is their parent's friendly id (or name) and -<n>. kwargs go
+    to every ProgressTracker. Returns the trackers of the deepest level."""
+    level = [pm]
+    for d in range(depth):
+        next_level = []
+        for t in level:
+            for i in range(width):
+                fid = '{}-{}'.format(t.friendly_id or t.name, i) \
+                    if friendly else None
+                c = ProgressTracker(Name='{}-{}'.format(d, i), FriendlyId=fid,
+                                    **kwargs)
+                t.with_tracker(c)
+                next_level.append(c)
+        level = next_level
+    return level
@@ -0,0 +1,236 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+
+#    http://aws.amazon.com/asl/
+
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+import bisect
+import logging
+import threading
+import time
+import codec
+
+# upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = [.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5,
+                   5, 10]
+OPERATIONS = ['update_tracker', 'update_trackers', 'inc_progress',
+              'get_by_id', 'get_children', 'get_level', 'get_changes',
+              'get_all_by_id', 'get_by_friendly_id', 'load_children',
+              'expire_trees']
+
+
+def size_of(v):
+    """Returns roughly how many bytes a stored record takes on the wire."""
+    if v is None:
+        return 0
+    if isinstance(v, dict):
+        return sum([len(str(k)) + size_of(x) for k, x in v.iteritems()])
+    if isinstance(v, (list, tuple, set, frozenset)):
+        return sum([size_of(x) for x in v])
+    if isinstance(v, unicode):
+        return len(v.encode('utf-8'))
+    if hasattr(v, 'value'):
+        # boto3 Binary
+        return len(v.value)
+    return len(str(v))
+
+
+class OperationStats(object):
+    __slots__ = ('calls', 'errors', 'round_trips', 'bytes', 'seconds',
+                 'max_seconds', 'histogram', 'last_error')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.round_trips = 0
+        self.bytes = 0
+        self.seconds = 0
+        self.max_seconds = 0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.last_error = None
+
+    def add(self, secs, round_trips, size, error):
+        self.calls = self.calls + 1
+        self.round_trips = self.round_trips + round_trips
+        self.bytes = self.bytes + size
+        self.seconds = self.seconds + secs
+        self.max_seconds = max(self.max_seconds, secs)
+        i = bisect.bisect_left(LATENCY_BUCKETS, secs)
+        self.histogram[i] = self.histogram[i] + 1
+        if error is not None:
+            self.errors = self.errors + 1
+            self.last_error = error
+
+    def percentile(self, p):
+        """Returns the upper bound of the bucket the pth percentile call
+        fell in."""
+        rank = p * self.calls
+        seen = 0
+        for bound, n in zip(LATENCY_BUCKETS, self.histogram):
+            seen = seen + n
+            if seen >= rank:
+                return bound
+        return self.max_seconds
+
+    def to_dict(self):
+        bounds = [str(b) for b in LATENCY_BUCKETS] + ['+inf']
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'round_trips': self.round_trips,
+            'bytes': self.bytes,
+            'seconds': self.seconds,
+            'max_seconds': self.max_seconds,
+            'p50_seconds': self.percentile(.5),
+            'p99_seconds': self.percentile(.99),
+            'histogram': dict(zip(bounds, self.histogram)),
+            'last_error': self.last_error,
+        }
+
+
+class DriverInstrumentation(object):
+    """Records call counts, round trips, bytes moved and latency histograms
+    for each operation of a DbDriver, overall and per monitor.
+
+    The driver's own methods are wrapped on the instance, so the get_level
+    calls a load makes and the loads lazily loaded trackers make are counted
+    too. Calls made inside another operation are counted under the monitor
+    of the outer one. Read bytes are the size of the records read; write
+    bytes are the size of the encoded trackers. round_trips is how far the
+    driver's round trip counter moved during the call.
+
+    Exporter is called with stats every ExportInterval seconds, from the
+    thread that made the call, and by export(). Setting enabled to False
+    leaves only a flag check in each call; remove() unwraps the driver.
+    """
+    def __init__(self, **kwargs):
+        self.driver = kwargs.get('Driver')
+        self.exporter = kwargs.get('Exporter')
+        self.export_interval = kwargs.get('ExportInterval', 60)
+        self.measure_bytes = kwargs.get('MeasureBytes', True)
+        self.enabled = True
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.operations = {}
+        self.monitors = {}
+        self.exported_at = time.time()
+        self.exporting = False
+        self.wrapped = []
+        for name in OPERATIONS:
+            method = getattr(self.driver, name, None)
+            if method is not None:
+                setattr(self.driver, name, self.wrap(name, method))
+                self.wrapped.append(name)
+
+    def remove(self):
+        """Puts the driver's own methods back."""
+        for name in self.wrapped:
+            delattr(self.driver, name)
+        self.wrapped = []
+        return self
+
+    def wrap(self, name, method):
+        def instrumented(*args, **kwargs):
+            if not self.enabled:
+                return method(*args, **kwargs)
+            return self.call(name, method, args, kwargs)
+        instrumented.__name__ = name
+        instrumented.__doc__ = method.__doc__
+        return instrumented
+
+    def monitor_of(self, name, args):
+        if not args:
+            return None
+        a = args[0]
+        if name in ['update_tracker', 'inc_progress']:
+            return a.root_id
+        if name in ['update_trackers', 'load_children']:
+            return a[0].root_id if a else None
+        if name in ['get_all_by_id', 'get_changes']:
+            return a
+
+    def call(self, name, method, args, kwargs):
+        outer = getattr(self.local, 'monitor', None)
+        monitor = outer or self.monitor_of(name, args)
+        self.local.monitor = monitor
+        round_trips = getattr(self.driver, 'round_trips', 0)
+        error = None
+        result = None
+        start = time.time()
+        try:
+            result = method(*args, **kwargs)
+            return result
+        except Exception as e:
+            error = str(e)
+            raise
+        finally:
+            secs = time.time() - start
+            self.local.monitor = outer
+            trips = getattr(self.driver, 'round_trips', 0) - round_trips
+            size = self.size(name, args, result) if self.measure_bytes \
+                else 0
+            self.record(name, monitor, secs, trips, size, error)
+
+    def size(self, name, args, result):
+        try:
+            if name == 'update_tracker':
+                return len(codec.encode(args[0]))
+            if name == 'update_trackers':
+                return sum([len(codec.encode(t)) for t in args[0]])
+            if name == 'get_changes':
+                return size_of(result[0]) if result else 0
+            if name in ['get_by_id', 'get_children', 'get_level']:
+                return size_of(result)
+        except Exception as e:
+            logging.warn('Error measuring {} bytes: {}'.format(name, str(e)))
+        return 0
+
+    def record(self, name, monitor, secs, round_trips, size, error):
+        with self.lock:
+            s = self.operations.get(name)
+            if s is None:
+                s = self.operations[name] = OperationStats()
+            s.add(secs, round_trips, size, error)
+            if monitor is not None:
+                ops = self.monitors.setdefault(monitor, {})
+                s = ops.get(name)
+                if s is None:
+                    s = ops[name] = OperationStats()
+                s.add(secs, round_trips, size, error)
+            export = self.exporter and not self.exporting and \
+                time.time() - self.exported_at >= self.export_interval
+            if export:
+                self.exporting = True
+        if export:
+            self.export()
+
+    @property
+    def stats(self):
+        with self.lock:
+            return {
+                'operations': dict([(n, s.to_dict()) for n, s in
+                                    self.operations.iteritems()]),
+                'monitors': dict([(m, dict([(n, s.to_dict()) for n, s in
+                                            ops.iteritems()]))
+                                  for m, ops in self.monitors.iteritems()]),
+            }
+
+    def export(self):
+        """Hands the current stats to the Exporter."""
+        try:
+            if self.exporter:
+                self.exporter(self.stats)
+        except Exception as e:
+            logging.error('Error exporting driver stats: {}'.format(str(e)))
+        finally:
+            with self.lock:
+                self.exported_at = time.time()
+                self.exporting = False
+        return self
+
+    def reset(self):
+        with self.lock:
+            self.operations = {}
+            self.monitors = {}
+        return self
@@ -0,0 +1,173 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+
+#    http://aws.amazon.com/asl/
+
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+import logging
+import threading
+import time
+
+# PutMetricData accepts at most 20 datums per call
+MAX_DATUMS_PER_CALL = 20
+# the dimension FluentMetric gives every metric a uuid of its own in
+STREAM_ID_DIMENSION = 'MetricStreamId'
+
+
+class MetricsBuffer(object):
+    """Aggregates done metrics into CloudWatch statistic sets and sends them
+    from a background thread.
+
+    Each done tracker adds a seconds sample and a status count, under each
+    of its dimensions and under all of them together, like FluentMetric.log
+    but without sending a lone dimension twice. The MetricStreamId dimension
+    is left out: FluentMetric gives every tracker its own, which would keep
+    the samples of different trackers apart. Samples with the same
+    namespace, metric name, unit and dimensions are folded into one
+    statistic set. The buffer is sent every FlushInterval seconds, or sooner
+    once it holds MaxDatums statistic sets.
+
+    Sink is anything with a put_metric_data(Namespace, MetricData) method;
+    it defaults to a CloudWatch client.
+    """
+    def __init__(self, **kwargs):
+        self.sink = kwargs.get('Sink')
+        self.max_datums = kwargs.get('MaxDatums', 1000)
+        self.flush_interval = kwargs.get('FlushInterval', 60)
+        self.pending = {}
+        self.sending = 0
+        self.flush_requested = False
+        self.closed = False
+        self.lock = threading.Lock()
+        self.wake = threading.Condition(self.lock)
+        self.idle = threading.Condition(self.lock)
+        self.samples = 0
+        self.datums_sent = 0
+        self.put_calls = 0
+        self.failed = 0
+        self.sender = threading.Thread(target=self.run,
+                                       name='progressmonitor-metrics')
+        self.sender.daemon = True
+        self.sender.start()
+
+    @property
+    def stats(self):
+        with self.lock:
+            return {
+                'pending_datums': len(self.pending),
+                'samples': self.samples,
+                'datums_sent': self.datums_sent,
+                'put_calls': self.put_calls,
+                'failed': self.failed,
+            }
+
+    def log_done(self, t):
+        m = t.metric
+        dims = [d for d in m.dimensions if d['Name'] != STREAM_ID_DIMENSION]
+        self.add(m.namespace, t.metric_name, 'Seconds', dims,
+                 t.elapsed_time_in_seconds)
+        self.add(m.namespace, '{}/{}'.format(t.metric_name, t.status),
+                 'Count', dims, 1)
+        return self
+
+    def add(self, namespace, name, unit, dimensions, value):
+        value = float(value)
+        combos = [[d] for d in dimensions]
+        if len(dimensions) != 1:
+            combos.append(dimensions)
+        with self.lock:
+            if self.closed:
+                raise Exception('Metrics buffer is closed')
+            for dims in combos:
+                k = (namespace, name, unit,
+                     tuple([(d['Name'], d['Value']) for d in dims]))
+                s = self.pending.get(k)
+                if s:
+                    s['SampleCount'] = s['SampleCount'] + 1
+                    s['Sum'] = s['Sum'] + value
+                    s['Minimum'] = min(s['Minimum'], value)
+                    s['Maximum'] = max(s['Maximum'], value)
+                else:
+                    self.pending[k] = {'SampleCount': 1, 'Sum': value,
+                                       'Minimum': value, 'Maximum': value}
+            self.samples = self.samples + 1
+            if len(self.pending) >= self.max_datums:
+                self.wake.notify()
+        return self
+
+    def run(self):
+        while True:
+            with self.lock:
+                if not self.closed and not self.flush_requested and \
+                        len(self.pending) < self.max_datums:
+                    self.wake.wait(self.flush_interval)
+                pending = self.pending
+                self.pending = {}
+                self.sending = len(pending)
+                closed = self.closed
+            self.send(pending)
+            with self.lock:
+                self.sending = 0
+                if not self.pending:
+                    self.flush_requested = False
+                self.idle.notify_all()
+            if closed and not self.pending:
+                return
+
+    def send(self, pending):
+        if not pending:
+            return
+        if not self.sink:
+            import boto3
+            self.sink = boto3.client('cloudwatch')
+        import arrow
+        ts = arrow.utcnow().datetime
+        by_namespace = {}
+        for (ns, name, unit, dims), s in pending.iteritems():
+            by_namespace.setdefault(ns, []).append({
+                'MetricName': name,
+                'Dimensions': [{'Name': n, 'Value': v} for n, v in dims],
+                'Timestamp': ts,
+                'StatisticValues': s,
+                'Unit': unit
+            })
+        for ns, datums in by_namespace.iteritems():
+            for n in xrange(0, len(datums), MAX_DATUMS_PER_CALL):
+                chunk = datums[n:n + MAX_DATUMS_PER_CALL]
+                try:
+                    self.sink.put_metric_data(Namespace=ns, MetricData=chunk)
+                    sent = len(chunk)
+                except Exception as e:
+                    logging.warn('Error sending done metrics to {}: {}'
+                                 .format(ns, str(e)))
+                    sent = 0
+                with self.lock:
+                    self.put_calls = self.put_calls + 1
+                    self.datums_sent = self.datums_sent + sent
+                    self.failed = self.failed + len(chunk) - sent
+
+    def flush(self, timeout=None):
+        """Sends everything buffered so far. Returns False if the timeout
+        ran out first."""
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.lock:
+            while self.pending or self.sending:
+                self.flush_requested = True
+                self.wake.notify()
+                if deadline is None:
+                    self.idle.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.idle.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        """Sends everything still buffered and stops the sender thread."""
+        with self.lock:
+            self.closed = True
+            self.wake.notify()
+        self.sender.join(timeout)
+        return not self.sender.is_alive()
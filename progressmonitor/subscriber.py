@@ -0,0 +1,63 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+
+#    http://aws.amazon.com/asl/
+
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+import json
+import logging
+
+
+class ChangeSubscriber(object):
+    """Follows the change events a RedisProgressManager created with
+    PublishChanges=True sends for a workflow, and applies them to a tree
+    held in memory.
+
+    Redis pub/sub delivers each event at most once, so anything published
+    while the subscriber isn't connected is lost; call refresh() on the tree
+    after reconnecting. Trees aren't thread safe, so events are applied by
+    poll() in the caller's thread.
+    """
+    def __init__(self, **kwargs):
+        self.tracker = kwargs.get('Tracker')
+        self.driver = self.tracker.db_conn
+        redis = kwargs.get('RedisConnection', self.driver.redis)
+        self.channel = self.driver.events_channel(self.tracker.root_id)
+        self.pubsub = redis.pubsub()
+        self.pubsub.subscribe(self.channel)
+        self.received = 0
+        self.applied = 0
+
+    @property
+    def stats(self):
+        return {'received': self.received, 'applied': self.applied}
+
+    def poll(self, timeout=0):
+        """Applies the events that have arrived, waiting up to timeout
+        seconds for the first one. Returns the number applied."""
+        applied = 0
+        while True:
+            m = self.pubsub.get_message(timeout=timeout)
+            if not m:
+                return applied
+            timeout = 0
+            if m['type'] != 'message':
+                continue
+            self.received = self.received + 1
+            try:
+                e = json.loads(m['data'])
+            except ValueError:
+                logging.warn('Ignoring malformed change event on {}'
+                             .format(self.channel))
+                continue
+            if e.get('src') == self.driver.client_id:
+                # the tree already has the changes this process wrote
+                continue
+            if self.tracker.apply_change(e):
+                applied = applied + 1
+                self.applied = self.applied + 1
+
+    def close(self):
+        self.pubsub.unsubscribe(self.channel)
+        self.pubsub.close()
@@ -0,0 +1,278 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+
+#    http://aws.amazon.com/asl/
+
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+
+class WriteBehindDriver(object):
+    """Wraps a DbDriver so tracker writes happen on a background thread.
+
+    update_tracker and update_trackers queue a snapshot of each tracker and
+    return right away. Repeated updates to the same tracker are coalesced
+    and the writer thread hands them to the wrapped driver's update_trackers
+    in batches. Everything else is passed through to the wrapped driver.
+
+    When the queue holds MaxQueueSize trackers, the Backpressure policy
+    decides what happens to a new one: 'block' waits for room, 'raise'
+    raises an exception and 'sync' writes it in the caller's thread.
+
+    A batch the wrapped driver fails to write is queued again, after
+    RetryBackoff seconds doubled for every earlier failure, unless a newer
+    update of the same tracker is already queued. Trackers that still can't
+    be written after MaxRetries retries are dropped and counted as failed,
+    and the next flush() or close() returns False.
+
+    Drivers with ConditionalWrites are refused: their version checks and
+    merges would apply to the queued snapshots, not to the live trackers.
+    """
+    POLICIES = ['block', 'raise', 'sync']
+
+    def __init__(self, **kwargs):
+        self.driver = kwargs.get('Driver')
+        self.max_queue_size = kwargs.get('MaxQueueSize', 10000)
+        self.batch_size = kwargs.get('BatchSize', 500)
+        self.flush_interval = kwargs.get('FlushInterval', .5)
+        self.backpressure = kwargs.get('Backpressure', 'block')
+        self.max_retries = kwargs.get('MaxRetries', 3)
+        self.retry_backoff = kwargs.get('RetryBackoff', .1)
+        if self.backpressure not in self.POLICIES:
+            raise Exception('Unknown backpressure policy {}. Use one of {}'
+                            .format(self.backpressure, self.POLICIES))
+        if getattr(self.driver, 'conditional_writes', False):
+            raise Exception('WriteBehindDriver does not support drivers with '
+                            'ConditionalWrites')
+        self.pending = OrderedDict()
+        # failed writes of the trackers waiting to be retried
+        self.attempts = {}
+        # trackers dropped since the last flush() or close()
+        self.unreported = 0
+        self.in_flight = 0
+        self.flush_requested = False
+        self.closed = False
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.idle = threading.Condition(self.lock)
+        self.enqueued = 0
+        self.coalesced = 0
+        self.flushed = 0
+        self.failed = 0
+        self.retried = 0
+        self.flushes = 0
+        self.max_queue_depth = 0
+        self.last_flush_seconds = 0
+        self.total_flush_seconds = 0
+        self.writer = threading.Thread(target=self.run,
+                                       name='progressmonitor-write-behind')
+        self.writer.daemon = True
+        self.writer.start()
+
+    def __getattr__(self, name):
+        return getattr(self.driver, name)
+
+    @property
+    def queue_depth(self):
+        return len(self.pending) + self.in_flight
+
+    @property
+    def stats(self):
+        with self.lock:
+            return {
+                'queue_depth': len(self.pending) + self.in_flight,
+                'max_queue_depth': self.max_queue_depth,
+                'enqueued': self.enqueued,
+                'coalesced': self.coalesced,
+                'flushed': self.flushed,
+                'failed': self.failed,
+                'retried': self.retried,
+                'flushes': self.flushes,
+                'last_flush_seconds': self.last_flush_seconds,
+                'total_flush_seconds': self.total_flush_seconds,
+            }
+
+    def update_tracker(self, e):
+        self.enqueue(e.snapshot())
+        # the snapshot carries the change to the stored status counts
+        e.counted_status = e.status
+
+    def update_trackers(self, trackers):
+        for e in trackers:
+            self.update_tracker(e)
+
+    def enqueue(self, s):
+        with self.lock:
+            if self.closed:
+                raise Exception('Write-behind queue is closed')
+            # a dropped write may have put back the tracker's counted status
+            # since the snapshot was taken
+            s.counted_status = s.tracker.counted_status
+            if s.id in self.pending:
+                # the replaced write's count changes are still to be made
+                s.counted_status = self.pending[s.id].counted_status
+                self.pending[s.id] = s
+                self.enqueued = self.enqueued + 1
+                self.coalesced = self.coalesced + 1
+                return
+            while len(self.pending) >= self.max_queue_size:
+                if self.backpressure == 'raise':
+                    raise Exception('Write-behind queue is full ({} trackers)'
+                                    .format(self.max_queue_size))
+                if self.backpressure == 'sync':
+                    break
+                self.not_full.wait()
+                if self.closed:
+                    raise Exception('Write-behind queue is closed')
+            else:
+                self.pending[s.id] = s
+                self.enqueued = self.enqueued + 1
+                self.max_queue_depth = max(self.max_queue_depth,
+                                           len(self.pending) + self.in_flight)
+                self.not_empty.notify()
+                return
+        self.write([s], False)
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.pending and not self.closed:
+                    self.not_empty.wait()
+                if not self.pending:
+                    return
+                deadline = time.time() + self.flush_interval
+                while len(self.pending) < self.batch_size and \
+                        not self.flush_requested and not self.closed:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.not_empty.wait(remaining)
+                batch = []
+                while self.pending and len(batch) < self.batch_size:
+                    batch.append(self.pending.popitem(last=False)[1])
+                self.in_flight = len(batch)
+                self.not_full.notify_all()
+            self.write(batch)
+            with self.lock:
+                self.in_flight = 0
+                if not self.pending:
+                    self.flush_requested = False
+                self.idle.notify_all()
+
+    def write(self, batch, retry=True):
+        """Writes a batch with the wrapped driver. A failed batch is queued
+        again, or with retry False, the error is raised to the caller."""
+        start = time.time()
+        error = None
+        try:
+            self.driver.update_trackers(batch)
+        except Exception as e:
+            logging.error('Error persisting to DB: {}'.format(str(e)))
+            error = e
+        secs = time.time() - start
+        with self.lock:
+            self.flushes = self.flushes + 1
+            self.last_flush_seconds = secs
+            self.total_flush_seconds = self.total_flush_seconds + secs
+            if error is None:
+                self.flushed = self.flushed + len(batch)
+                for s in batch:
+                    self.attempts.pop(s.id, None)
+                return
+            attempt = max([self.attempts.get(s.id, 0) for s in batch]) + 1
+        if not retry:
+            for s in batch:
+                self.uncount(s)
+            raise error
+        if attempt <= self.max_retries:
+            time.sleep(self.retry_backoff * 2 ** (attempt - 1))
+        self.requeue(batch)
+
+    def requeue(self, batch):
+        """Queues the trackers of a failed batch again, dropping the ones
+        that have run out of retries."""
+        with self.lock:
+            for s in batch:
+                attempt = self.attempts.pop(s.id, 0) + 1
+                if s.id in self.pending:
+                    # the newer update replaces this one
+                    self.pending[s.id].counted_status = s.counted_status
+                    continue
+                if attempt > self.max_retries:
+                    logging.error('Gave up writing {} after {} retries'
+                                  .format(s.id, self.max_retries))
+                    self.uncount(s)
+                    self.failed = self.failed + 1
+                    self.unreported = self.unreported + 1
+                    continue
+                self.attempts[s.id] = attempt
+                self.pending[s.id] = s
+                self.retried = self.retried + 1
+
+    def uncount(self, s):
+        """Gives the tracker of a snapshot that won't be written back the
+        counted status it had, so its next write makes the count changes
+        this one didn't."""
+        s.tracker.counted_status = s.counted_status
+
+    def flush(self, timeout=None):
+        """Waits until every queued tracker has been written. Returns False
+        if the timeout ran out first, or if trackers were dropped after
+        failed writes since the last flush() or close()."""
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.lock:
+            while self.pending or self.in_flight:
+                self.flush_requested = True
+                self.not_empty.notify()
+                if deadline is None:
+                    self.idle.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.idle.wait(remaining)
+            return self.take_unreported()
+
+    def close(self, timeout=None):
+        """Writes everything still queued and stops the writer thread.
+        Returns False if the timeout ran out first, or if trackers were
+        dropped after failed writes since the last flush()."""
+        with self.lock:
+            self.closed = True
+            self.not_empty.notify()
+            self.not_full.notify_all()
+        self.writer.join(timeout)
+        with self.lock:
+            return self.take_unreported() and not self.writer.is_alive()
+
+    def take_unreported(self):
+        written = not self.unreported
+        self.unreported = 0
+        return written
+
+    def get_all_by_id(self, id, depth=None):
+        self.flush()
+        return self.attach(self.driver.get_all_by_id(id, depth))
+
+    def get_by_friendly_id(self, friendly_id):
+        self.flush()
+        return self.attach(self.driver.get_by_friendly_id(friendly_id))
+
+    def attach(self, t):
+        """Points a loaded tree at this driver so its writes are queued."""
+        stack = [t] if t else []
+        while stack:
+            n = stack.pop()
+            n.db_conn = self
+            stack.extend(n.loaded_children)
+        return t
+
+    def load_children(self, trackers):
+        self.flush()
+        self.driver.load_children(trackers)
+        return self
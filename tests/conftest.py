@@ -0,0 +1,17 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+
+#    http://aws.amazon.com/asl/
+
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+import pytest
+from progressmonitor.helpers import db_helpers
+
+
+@pytest.fixture(autouse=True)
+def forget_validated_tables():
+    # every moto mock starts with no tables
+    db_helpers.clear_validated_tables()
+    db_helpers.shared.clear()
+    yield
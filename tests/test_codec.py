@@ -0,0 +1,123 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+
+#    http://aws.amazon.com/asl/
+
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+import json
+import arrow
+import boto3
+import pytest
+import fakeredis
+from moto import mock_dynamodb2
+from progressmonitor import ProgressTracker, ProgressMonitor, \
+    RedisProgressManager, DynamoDbDriver, codec
+
+
+boto3.setup_default_session(region_name='foo')
+
+
+def full_tracker():
+    pm = ProgressMonitor(DbConnection=RedisProgressManager(), Name='Root')
+    t = ProgressTracker(Name=u'T\xe2che', FriendlyId='f', EstimatedSeconds=30,
+                        Source='src')
+    pm.with_tracker(t)
+    t.with_metric(Namespace='ns', Metric='m').with_status_msg('half way')
+    t.start(Parents=True, StartTime=arrow.utcnow().shift(seconds=-5))
+    return pm, t
+
+
+def decoded(t):
+    return codec.decode(ProgressTracker(Id=t.id), codec.encode(t))
+
+
+def test_tracker_fields_round_trip():
+    pm, t = full_tracker()
+    t.fail()
+    d = decoded(t)
+    for f in ['name', 'friendly_id', 'estimated_seconds', 'source',
+              'status_msg', 'parent_id', 'root_id', 'status', 'is_done',
+              'is_in_progress', 'has_parallel_children', 'metric_name',
+              'metric_namespace', 'start_time', 'finish_time']:
+        assert getattr(d, f) == getattr(t, f), f
+    assert d.metric
+
+
+def test_uuid_ids_are_packed():
+    pm, t = full_tracker()
+    assert len(codec.encode(t)) < 100
+    t.parent_id = 'not-a-uuid'
+    assert decoded(t).parent_id == 'not-a-uuid'
+
+
+def test_custom_status_and_no_status_round_trip():
+    pm, t = full_tracker()
+    t.status = 'Waiting on approval'
+    assert decoded(t).status == 'Waiting on approval'
+    t.status = None
+    assert decoded(t).status is None
+
+
+def test_summary_round_trips_with_its_counts():
+    pm, t = full_tracker()
+    t.summary = {'counts': {'Succeeded': 3}, 'trackers': 3, 'estimate': 30,
+                 'total_seconds': 1.5, 'critical_path_seconds': 1,
+                 'first_start': None, 'last_finish': None}
+    d = decoded(t)
+    assert d.summary == t.summary
+    assert d.succeeded_count == 3 and d.total_estimate == 30
+
+
+def test_unknown_fields_are_skipped():
+    pm, t = full_tracker()
+    out = [codec.encode(t)]
+    codec.pack_field(out, 99, 'from a newer writer')
+    assert codec.decode(ProgressTracker(Id=t.id), ''.join(out)).name == t.name
+
+
+def test_newer_versions_are_rejected():
+    pm, t = full_tracker()
+    data = chr(codec.VERSION + 1) + codec.encode(t)[1:]
+    with pytest.raises(Exception) as e:
+        codec.decode(ProgressTracker(Id=t.id), data)
+    assert 'version' in str(e.value)
+
+
+def test_redis_reads_records_written_before_the_codec():
+    r = fakeredis.FakeStrictRedis()
+    r.flushall()
+    rpm = RedisProgressManager(RedisConnection=r)
+    pm, t = full_tracker()
+    t.with_name('Task')
+    for n in [pm, t]:
+        r.hmset(n.id, n.to_json())
+    r.sadd(rpm.children_key(pm.id), t.id)
+    loaded = rpm.get_all_by_id(pm.id)
+    c = loaded.children[0]
+    assert c.name == t.name and c.status == 'In Progress'
+    assert c.start_time == t.start_time and c.status_msg == 'half way'
+    c.succeed().update()
+    assert set(r.hkeys(c.id)) >= set(['c', 'lu'])
+    assert rpm.get_all_by_id(pm.id).children[0].status == 'Succeeded'
+
+
+@mock_dynamodb2
+def test_dynamodb_reads_records_written_before_the_codec():
+    d = DynamoDbDriver()
+    pm, t = full_tracker()
+    table = d.dynamodb.Table(d.TRACKER_TABLE)
+    for n in [pm, t]:
+        ue, eav = n.to_update_item()
+        table.update_item(Key={'Id': n.id}, UpdateExpression=ue,
+                          ExpressionAttributeValues=eav)
+    d.dynamodb.Table(d.CHILDREN_TABLE).put_item(
+        Item={'Id': pm.id, 'children': [t.id]})
+    loaded = d.get_all_by_id(pm.id)
+    c = loaded.children[0]
+    assert c.name == t.name and c.status == 'In Progress'
+    assert c.start_time == t.start_time
+    c.succeed().update(False)
+    item = table.get_item(Key={'Id': c.id})['Item']
+    assert 'C' in item and 'TrackerName' not in item
+    assert d.get_all_by_id(pm.id).children[0].status == 'Succeeded'
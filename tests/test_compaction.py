@@ -0,0 +1,141 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+
+#    http://aws.amazon.com/asl/
+
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+import fakeredis
+import pytest
+from progressmonitor import ProgressTracker, ProgressMonitor, MemoryDriver, \
+    RedisProgressManager
+from progressmonitor.helpers.tree_helpers import build_tree
+
+STATUS_PROPERTIES = ['not_started', 'in_progress', 'succeeded', 'failed',
+                     'canceled', 'done', 'all_children']
+
+
+def setup_tree(db):
+    """A monitor with a finished branch of 3 parallel groups of 4 leaves,
+    and a running branch."""
+    pm = ProgressMonitor(DbConnection=db, Name='Root', FriendlyId='root')
+    pm.start()
+    branch = ProgressTracker(Name='branch', FriendlyId='branch')
+    pm.with_tracker(branch)
+    branch.with_parallel_children().start()
+    # leaves have friendly ids branch-<group>-<n>
+    for g, group in enumerate(build_tree(branch, 3, 1, friendly=True)):
+        group.start()
+        for i, leaf in enumerate(build_tree(group, 4, 1, friendly=True,
+                                            EstimatedSeconds=10)):
+            leaf.start(StartTime=100 + g * 10 + i * 2)
+            leaf.with_progress_total(2).inc_progress(2)
+            if g == 2 and i == 3:
+                leaf.fail()
+            else:
+                leaf.succeed()
+            leaf.with_finish_time(100 + g * 10 + i * 2 + 1 + g)
+        group.succeed().with_finish_time(leaf._finish_time)
+    branch.succeed()
+    running = ProgressTracker(Name='running', EstimatedSeconds=5)
+    pm.with_tracker(running)
+    running.start()
+    pm.with_tracker(ProgressTracker(Name='waiting', EstimatedSeconds=7))
+    pm.update_all()
+    return pm, branch
+
+
+def aggregates(t):
+    out = dict([(p, len(getattr(t, p))) for p in STATUS_PROPERTIES])
+    out.update(dict([(p + '_count', getattr(t, p + '_count'))
+                     for p in STATUS_PROPERTIES if p != 'all_children']))
+    out['all_children_count'] = t.all_children_count
+    out['progress'] = t.get_tracker_progress_total()
+    out['total_estimate'] = t.total_estimate
+    return out
+
+
+def redis_driver():
+    r = fakeredis.FakeStrictRedis()
+    r.flushall()
+    return RedisProgressManager(RedisConnection=r)
+
+
+@pytest.mark.parametrize('make_db', [MemoryDriver, redis_driver])
+def test_compacted_tree_aggregates_like_the_full_tree(make_db):
+    db = make_db()
+    pm, branch = setup_tree(db)
+    before = aggregates(pm)
+    branch.compact()
+    assert branch.loaded_children == []
+    assert aggregates(pm) == before
+    loaded = db.get_all_by_id(pm.id)
+    assert aggregates(loaded) == before
+    assert loaded.find_id(branch.id).summary == branch.summary
+
+
+def test_summary_holds_counts_durations_and_timestamps():
+    pm, branch = setup_tree(MemoryDriver())
+    branch.compact()
+    s = branch.summary
+    assert s['trackers'] == 15
+    assert s['counts'] == {'Succeeded': 14, 'Failed': 1}
+    assert s['estimate'] == 40
+    # leaves take 1, 2 and 3 seconds in the three groups
+    assert s['total_seconds'] == 4 * 1 + 4 * 2 + 4 * 3
+    # the groups run in parallel, their leaves one after another
+    assert s['critical_path_seconds'] == 4 * 3
+    assert s['first_start'] == 100
+    assert s['last_finish'] == 100 + 2 * 10 + 3 * 2 + 1 + 2
+
+
+def test_loads_stop_at_compacted_trackers():
+    db = MemoryDriver()
+    pm, branch = setup_tree(db)
+    branch.compact()
+    db.reset_stats()
+    t = db.get_all_by_id(pm.id)
+    # the root, its children, and nothing below the compacted branch
+    assert db.stats['calls'] == {'get_level': 2}
+    assert t.find_friendly_id('branch-0-0') is None
+    assert t.find_friendly_id('branch').summary['trackers'] == 15
+
+
+def test_status_queries_only_read_compacted_trackers_that_match():
+    db = MemoryDriver()
+    pm, branch = setup_tree(db)
+    branch.compact()
+    t = db.get_all_by_id(pm.id)
+    db.reset_stats()
+    assert [c.name for c in t.in_progress] == ['running']
+    assert db.stats['calls'] == {}
+    failed = t.failed
+    assert [c.friendly_id for c in failed] == ['branch-2-3']
+    assert db.stats['calls']['get_level'] > 0
+
+
+def test_expand_puts_the_subtree_back():
+    db = MemoryDriver()
+    pm, branch = setup_tree(db)
+    before = aggregates(pm)
+    branch.compact()
+    t = db.get_all_by_id(pm.id)
+    b = t.find_id(branch.id)
+    b.expand()
+    assert b.summary is None and len(b.children) == 3
+    assert aggregates(t) == before
+    assert t.find_friendly_id('branch-1-2').is_done
+    t.update()
+    again = db.get_all_by_id(pm.id)
+    assert again.find_id(branch.id).summary is None
+    assert aggregates(again) == before
+
+
+def test_only_finished_subtrees_compact():
+    pm, branch = setup_tree(MemoryDriver())
+    with pytest.raises(Exception) as e:
+        pm.compact()
+    assert "isn't finished" in str(e.value)
+    with pytest.raises(Exception) as e:
+        ProgressTracker().with_tracker(ProgressTracker()).compact()
+    assert 'DbConnection' in str(e.value)
@@ -0,0 +1,213 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+
+#    http://aws.amazon.com/asl/
+
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+import threading
+import boto3
+import fakeredis
+import pytest
+from moto import mock_dynamodb2
+from moto.dynamodb2.responses import DynamoHandler
+from progressmonitor import ProgressTracker, ProgressMonitor, MemoryDriver, \
+    RedisProgressManager, RedisClusterProgressManager, DynamoDbDriver
+
+boto3.setup_default_session(region_name='foo')
+WORKERS = 12
+
+
+@pytest.fixture
+def atomic_fakes(monkeypatch):
+    # Redis runs EXEC and DynamoDB each request atomically; fakeredis and
+    # moto check and write in separate steps another thread can run between
+    lock = threading.RLock()
+
+    def locked(f):
+        def call(*args, **kwargs):
+            with lock:
+                return f(*args, **kwargs)
+        return call
+    monkeypatch.setattr(fakeredis.FakePipeline, 'execute',
+                        locked(fakeredis.FakePipeline.execute))
+    monkeypatch.setattr(DynamoHandler, 'call_action',
+                        locked(DynamoHandler.call_action))
+
+
+class RedisStore(object):
+    def __init__(self):
+        fakeredis.FakeStrictRedis().flushall()
+
+    def driver(self, **kwargs):
+        # every fakeredis client sees the same data, like clients of one
+        # server
+        return RedisProgressManager(RedisConnection=fakeredis.FakeStrictRedis(),
+                                    **kwargs)
+
+
+class MemoryStore(object):
+    def __init__(self):
+        self.db = MemoryDriver(ConditionalWrites=True)
+
+    def driver(self, **kwargs):
+        return self.db
+
+
+class DynamoDbStore(object):
+    def driver(self, **kwargs):
+        return DynamoDbDriver(**kwargs)
+
+
+def setup_shared_tree(store):
+    db = store.driver(ConditionalWrites=True)
+    pm = ProgressMonitor(DbConnection=db, Name='Root')
+    pm.with_tracker(ProgressTracker(Name='shared', FriendlyId='shared'))
+    pm.with_tracker(ProgressTracker(Name='flag', FriendlyId='flag'))
+    pm.start()
+    pm.update_all()
+    return pm
+
+
+def stores():
+    return [RedisStore, MemoryStore, DynamoDbStore]
+
+
+def run_in_store(make_store, fn):
+    if make_store is DynamoDbStore:
+        with mock_dynamodb2():
+            return fn(make_store())
+    return fn(make_store())
+
+
+@pytest.mark.parametrize('make_store', stores())
+def test_stale_writers_keep_each_others_children_and_status(make_store):
+    def run(store):
+        pm = setup_shared_tree(store)
+        shared_id = pm.children[0].id
+        # every worker reads the tree before any of them writes
+        copies = [store.driver(ConditionalWrites=True).get_all_by_id(pm.id)
+                  for i in range(WORKERS)]
+        for n, t in enumerate(copies):
+            s = t.find_id(shared_id)
+            if n == 3:
+                s.start().succeed()
+            else:
+                s.with_status_msg('worker {}'.format(n))
+            s.with_tracker(ProgressTracker(Name='child-{}'.format(n)))
+            t.update()
+        final = store.driver().get_all_by_id(pm.id)
+        s = final.find_id(shared_id)
+        assert sorted([c.name for c in s.children]) == \
+            sorted(['child-{}'.format(n) for n in range(WORKERS)])
+        assert s.status == 'Succeeded'
+        assert s.status_msg == 'worker {}'.format(WORKERS - 1)
+        return final
+    run_in_store(make_store, run)
+
+
+@pytest.mark.parametrize('make_store', stores())
+def test_concurrent_workers_lose_nothing(make_store, atomic_fakes):
+    def run(store):
+        pm = setup_shared_tree(store)
+        pm.children[0].start()
+        pm.update_all()
+        shared_id = pm.children[0].id
+        errors = []
+        start = threading.Event()
+
+        def work(n):
+            try:
+                t = store.driver(ConditionalWrites=True).get_all_by_id(pm.id)
+                start.wait()
+                s = t.find_id(shared_id)
+                flag = t.find_friendly_id('flag')
+                for i in range(3):
+                    c = ProgressTracker(Name='{}-{}'.format(n, i))
+                    s.with_tracker(c)
+                    t.update()
+                    c.start()
+                    flag.with_status_msg('{}-{}'.format(n, i))
+                    if n == 0 and i == 2:
+                        c.fail()
+                        flag.start().succeed()
+                    t.update()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=work, args=(n,))
+                   for n in range(WORKERS)]
+        for th in threads:
+            th.start()
+        start.set()
+        for th in threads:
+            th.join()
+        assert errors == []
+        final = store.driver().get_all_by_id(pm.id)
+        s = final.find_id(shared_id)
+        assert len(s.children) == WORKERS * 3
+        assert final.failed_count == 1
+        assert final.find_friendly_id('flag').status == 'Succeeded'
+        # the shared tracker and every child but the failed one
+        assert final.in_progress_count == 1 + WORKERS * 3 - 1
+    run_in_store(make_store, run)
+
+
+def test_unconditional_writes_undo_other_writers():
+    store = RedisStore()
+    pm = setup_shared_tree(store)
+    a, b = [store.driver().get_all_by_id(pm.id) for i in range(2)]
+    a.find_friendly_id('shared').start().succeed()
+    a.update()
+    b.find_friendly_id('shared').with_status_msg('late')
+    b.update()
+    assert store.driver().get_by_friendly_id('shared').status == \
+        'Not started'
+
+
+def test_redis_conditional_write_takes_three_round_trips():
+    store = RedisStore()
+    pm = setup_shared_tree(store)
+    db = pm.db_conn
+    pm.children[0].with_status_msg('a')
+    db.round_trips = 0
+    pm.update_all()
+    assert db.round_trips == 3
+    assert pm.children[0].version == 2
+    # a conflict costs a read of the stale record and nothing else
+    other = store.driver(ConditionalWrites=True).get_all_by_id(pm.id)
+    other.find_id(pm.children[0].id).with_status_msg('b').update()
+    pm.children[0].with_status_msg('c')
+    db.round_trips = 0
+    pm.update_all()
+    assert db.round_trips == 4 and pm.children[0].version == 4
+
+
+def test_versions_are_loaded_and_bumped_by_every_write():
+    store = RedisStore()
+    pm = setup_shared_tree(store)
+    loaded = store.driver().get_all_by_id(pm.id)
+    assert loaded.version == pm.version == 1
+    loaded.with_status_msg('x').update()
+    assert store.driver().get_all_by_id(pm.id).version == 2
+
+
+@mock_dynamodb2
+def test_dynamodb_progress_from_other_workers_survives_a_put():
+    pm = setup_shared_tree(DynamoDbStore())
+    s = pm.children[0]
+    other = DynamoDbDriver(ConditionalWrites=True).get_all_by_id(pm.id)
+    other.find_id(s.id).with_progress_total(10).inc_progress(4)
+    other.find_id(s.id).flush_progress()
+    s.with_status_msg('after')
+    pm.update_all()
+    t = DynamoDbDriver().get_all_by_id(pm.id)
+    assert t.find_id(s.id).status_msg == 'after'
+    assert t.get_tracker_progress_total() == (4, 10)
+
+
+def test_cluster_driver_rejects_conditional_writes():
+    with pytest.raises(Exception) as e:
+        RedisClusterProgressManager(RedisConnection=fakeredis.FakeStrictRedis(),
+                                    ConditionalWrites=True)
+    assert 'WATCH' in str(e.value)
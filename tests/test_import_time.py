@@ -0,0 +1,42 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+
+#    http://aws.amazon.com/asl/
+
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY = ['boto3', 'botocore', 'fluentmetrics', 'arrow']
+
+
+def loaded_after(code):
+    probe = '{}\nimport json, sys\nprint(json.dumps([m for m in {!r} ' \
+        'if m in sys.modules]))'.format(code, HEAVY)
+    out = subprocess.check_output([sys.executable, '-c', probe], cwd=ROOT)
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def test_import_does_not_load_aws_modules():
+    assert loaded_after('from progressmonitor import DynamoDbDriver') == []
+
+
+def test_redis_trackers_do_not_load_aws_modules():
+    code = '\n'.join([
+        'import fakeredis',
+        'from progressmonitor import *',
+        'r = RedisProgressManager(RedisConnection=fakeredis.FakeStrictRedis())',
+        'pm = ProgressMonitor(DbConnection=r).start()',
+        't = ProgressTracker(Name="a", FriendlyId="a")',
+        'pm.with_tracker(t)',
+        't.start().with_estimated_seconds(10).inc_progress(1)',
+        'pm.update_all()',
+        't.succeed()',
+        'pm.update_all()',
+        'r.get_all_by_id(pm.id).children[0].elapsed_time_in_seconds'])
+    assert loaded_after(code) == []
+
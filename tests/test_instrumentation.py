@@ -0,0 +1,102 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+
+#    http://aws.amazon.com/asl/
+
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+import pytest
+import fakeredis
+from progressmonitor import ProgressMonitor, MemoryDriver, \
+    RedisProgressManager, DriverInstrumentation, codec
+from progressmonitor.helpers.tree_helpers import build_tree
+
+
+def setup_tree(d, width=3, depth=2):
+    pm = ProgressMonitor(DbConnection=d, Name='Root')
+    build_tree(pm, width, depth)
+    return pm
+
+
+def test_load_counts_each_level_as_a_round_trip():
+    d = MemoryDriver()
+    pm = setup_tree(d).update_all()
+    inst = DriverInstrumentation(Driver=d)
+    ProgressMonitor(DbConnection=d).load(pm.id)
+    ops = inst.stats['operations']
+    assert ops['get_all_by_id']['calls'] == 1
+    assert ops['get_all_by_id']['round_trips'] == 3
+    assert ops['get_level']['calls'] == 3 and ops['get_level']['bytes'] > 0
+
+
+def test_lazy_loads_are_counted_under_their_monitor():
+    d = MemoryDriver()
+    pm = setup_tree(d).update_all()
+    inst = DriverInstrumentation(Driver=d)
+    t = d.get_all_by_id(pm.id, depth=0)
+    inst.reset()
+    t.children[0].children
+    ops = inst.stats['monitors'][pm.id]
+    assert ops['load_children']['calls'] == 2
+    assert ops['get_level']['calls'] == 2
+
+
+def test_writes_count_encoded_bytes_per_monitor():
+    r = fakeredis.FakeStrictRedis()
+    r.flushall()
+    d = RedisProgressManager(RedisConnection=r)
+    inst = DriverInstrumentation(Driver=d)
+    a = setup_tree(d, 2, 1)
+    b = setup_tree(d, 3, 1)
+    a.update_all()
+    b.update_all()
+    stats = inst.stats
+    sizes = [len(codec.encode(t)) for t in [a] + a.children]
+    assert stats['monitors'][a.id]['update_trackers']['bytes'] == sum(sizes)
+    assert stats['monitors'][b.id]['update_trackers']['calls'] == 1
+    assert stats['operations']['update_trackers']['calls'] == 2
+
+
+def test_latency_lands_in_the_histogram():
+    d = MemoryDriver(Latency=.006)
+    inst = DriverInstrumentation(Driver=d)
+    for i in range(4):
+        d.get_children('x')
+    s = inst.stats['operations']['get_children']
+    assert s['histogram']['0.01'] == 4 and s['p99_seconds'] == .01
+    assert s['max_seconds'] >= .006 and s['seconds'] >= .024
+
+
+def test_errors_are_counted():
+    d = MemoryDriver(FailureRate=1)
+    inst = DriverInstrumentation(Driver=d)
+    pm = ProgressMonitor(DbConnection=d)
+    with pytest.raises(Exception):
+        pm.update()
+    s = inst.stats['operations']['update_tracker']
+    assert s['errors'] == 1 and 'Injected failure' in s['last_error']
+
+
+def test_exporter_is_called_every_interval():
+    exported = []
+    d = MemoryDriver()
+    inst = DriverInstrumentation(Driver=d, Exporter=exported.append,
+                                 ExportInterval=0)
+    d.get_by_id('x')
+    assert exported[-1]['operations']['get_by_id']['calls'] == 1
+    inst.export_interval = 60
+    d.get_by_id('x')
+    assert len(exported) == 1
+    inst.export()
+    assert exported[-1]['operations']['get_by_id']['calls'] == 2
+
+
+def test_disabled_and_removed_instrumentation_records_nothing():
+    d = MemoryDriver()
+    inst = DriverInstrumentation(Driver=d)
+    inst.enabled = False
+    d.get_by_id('x')
+    inst.remove()
+    d.get_by_id('x')
+    assert inst.stats['operations'] == {}
+    assert 'get_by_id' not in vars(d)
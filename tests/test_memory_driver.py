@@ -0,0 +1,102 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+
+#    http://aws.amazon.com/asl/
+
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+import time
+import pytest
+from progressmonitor import ProgressTracker, ProgressMonitor, MemoryDriver, \
+    WriteBehindDriver
+from progressmonitor.helpers.tree_helpers import build_tree
+
+
+def setup_memory_tree(width, depth, **kwargs):
+    d = MemoryDriver(**kwargs)
+    pm = ProgressMonitor(DbConnection=d, Name='Root', FriendlyId='root')
+    build_tree(pm, width, depth)
+    pm.update_all()
+    return d, pm
+
+
+def test_memory_driver_loads_a_copy_of_the_tree():
+    d, pm = setup_memory_tree(3, 2)
+    a = pm.children[0]
+    a.start(Parents=True).with_progress_total(10).inc_progress(4)
+    pm.update_all()
+    t = d.get_all_by_id(pm.id)
+    assert t is not pm and t.all_children_count == 12
+    loaded = t.find_id(a.id)
+    assert loaded is not a and loaded.status == 'In Progress'
+    assert loaded.start_time == a.start_time
+    assert t.get_tracker_progress_total() == (4, 10)
+    assert d.get_by_friendly_id('root').id == pm.id
+
+
+def test_memory_driver_counts_calls():
+    d, pm = setup_memory_tree(3, 3)
+    d.reset_stats()
+    d.get_all_by_id(pm.id)
+    assert d.stats['calls'] == {'get_level': 4}
+    d.reset_stats()
+    # lazily loaded levels are read a level at a time, not a tracker at a
+    # time
+    d.get_all_by_id(pm.id, depth=0).find_id(pm.children[2].children[0].id)
+    assert d.stats['calls'] == {'get_level': 4}
+
+
+def test_memory_driver_waits_latency_plus_jitter():
+    d = MemoryDriver(Latency=.02, Jitter=.01, Seed=1)
+    start = time.time()
+    d.get_level(['a', 'b'])
+    assert time.time() - start >= .02
+    assert .02 <= d.stats['waited_seconds'] <= .03
+
+
+def test_memory_driver_injected_failures_change_nothing():
+    d = MemoryDriver(FailureRate=1)
+    pm = ProgressMonitor(DbConnection=d)
+    with pytest.raises(Exception) as e:
+        pm.update()
+    assert 'Injected failure in update_tracker' in str(e.value)
+    assert d.records == {} and d.stats['failures'] == 1
+
+
+def test_memory_driver_failures_are_repeatable_with_a_seed():
+    def failures(seed):
+        d = MemoryDriver(FailureRate=.5, Seed=seed)
+        out = []
+        for i in range(20):
+            try:
+                d.get_children('a')
+                out.append(False)
+            except Exception:
+                out.append(True)
+        return out
+    assert failures(7) == failures(7) and any(failures(7))
+
+
+def test_memory_driver_refreshes_changed_trackers():
+    d, pm = setup_memory_tree(2, 2)
+    t = d.get_all_by_id(pm.id)
+    time.sleep(.01)
+    pm.children[1].start(Parents=True).succeed()
+    pm.children[0].with_tracker(ProgressTracker(Name='new', FriendlyId='new'))
+    pm.update_all()
+    t.refresh()
+    assert t.find_id(pm.children[1].id).status == 'Succeeded'
+    assert t.find_friendly_id('new').parent.id == pm.children[0].id
+
+
+def test_memory_driver_behind_write_behind_takes_one_call_per_batch():
+    d = MemoryDriver(Latency=.001)
+    wb = WriteBehindDriver(Driver=d, FlushInterval=60)
+    pm = ProgressMonitor(DbConnection=wb, Name='Root')
+    for i in range(10):
+        pm.with_tracker(ProgressTracker(Name=str(i)))
+    pm.update_all()
+    assert wb.flush(5)
+    assert d.stats['calls'] == {'update_trackers': 1}
+    assert d.get_all_by_id(pm.id).all_children_count == 10
+    wb.close()
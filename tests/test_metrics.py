@@ -0,0 +1,154 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+
+#    http://aws.amazon.com/asl/
+
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+import time
+import boto3
+from mock import patch
+from progressmonitor import ProgressTracker, ProgressMonitor, MetricsBuffer
+
+
+boto3.setup_default_session(region_name='foo')
+
+
+class StubSink(object):
+    def __init__(self):
+        self.calls = []
+
+    def put_metric_data(self, Namespace, MetricData):
+        self.calls.append((Namespace, MetricData))
+
+    @property
+    def datums(self):
+        return [d for ns, data in self.calls for d in data]
+
+    def find(self, name, dimensions):
+        for d in self.datums:
+            if d['MetricName'] == name and d['Dimensions'] == dimensions:
+                return d
+
+
+class MockProgressManager(object):
+    def update_tracker(self, pt):
+        return None
+
+
+def finish_tasks(buf, n, status='succeed'):
+    pm = ProgressMonitor(DbConnection=MockProgressManager(),
+                         MetricsBuffer=buf)
+    pm.start()
+    for i in range(n):
+        t = ProgressTracker(Name='Task').with_metric(Namespace='ns',
+                                                     Metric='copy')
+        t.metric.with_dimension('os', 'linux')
+        pm.with_tracker(t)
+        getattr(t.start(), status)()
+    return pm
+
+
+@patch('fluentmetrics.FluentMetric.seconds')
+@patch('fluentmetrics.FluentMetric.count')
+def test_done_trackers_are_buffered_instead_of_sent(c_mock, s_mock):
+    sink = StubSink()
+    buf = MetricsBuffer(Sink=sink, FlushInterval=60)
+    finish_tasks(buf, 3)
+    assert not sink.calls and buf.stats['samples'] == 6
+    assert s_mock.call_count == 0 and c_mock.call_count == 0
+    buf.close()
+
+
+def test_done_metrics_are_aggregated_into_statistic_sets():
+    sink = StubSink()
+    buf = MetricsBuffer(Sink=sink, FlushInterval=60)
+    finish_tasks(buf, 3)
+    finish_tasks(buf, 1, 'fail')
+    assert buf.flush(5)
+    os_dim = [{'Name': 'os', 'Value': 'linux'}]
+    seconds = sink.find('copy', os_dim)
+    assert seconds['Unit'] == 'Seconds'
+    assert seconds['StatisticValues']['SampleCount'] == 4
+    assert sink.find('copy/Succeeded', os_dim)['StatisticValues'] == \
+        {'SampleCount': 3, 'Sum': 3.0, 'Minimum': 1.0, 'Maximum': 1.0}
+    assert sink.find('copy/Failed', os_dim)['StatisticValues']['Sum'] == 1
+    assert len(sink.datums) == 3 and len(sink.calls) == 1
+    buf.close()
+
+
+def test_a_single_dimension_is_sent_once_for_all_trackers():
+    sink = StubSink()
+    buf = MetricsBuffer(Sink=sink, FlushInterval=60)
+    # every tracker keeps the stream id FluentMetric gave it
+    finish_tasks(buf, 3)
+    buf.close()
+    seconds = [d for d in sink.datums if d['MetricName'] == 'copy']
+    assert [d['Dimensions'] for d in seconds] == \
+        [[{'Name': 'os', 'Value': 'linux'}]]
+    assert seconds[0]['StatisticValues']['SampleCount'] == 3
+
+
+def test_dimensions_are_sent_alone_and_together():
+    sink = StubSink()
+    buf = MetricsBuffer(Sink=sink, FlushInterval=60)
+    pm = finish_tasks(buf, 0)
+    t = ProgressTracker(Name='Task').with_metric(Namespace='ns',
+                                                 Metric='copy')
+    t.metric.with_dimension('os', 'linux').with_dimension('az', 'a')
+    pm.with_tracker(t)
+    t.start().succeed()
+    buf.close()
+    os_dim = {'Name': 'os', 'Value': 'linux'}
+    az_dim = {'Name': 'az', 'Value': 'a'}
+    seconds = [d for d in sink.datums if d['MetricName'] == 'copy']
+    assert sorted([d['Dimensions'] for d in seconds]) == \
+        sorted([[os_dim], [az_dim], [os_dim, az_dim]])
+
+
+def test_buffer_is_sent_when_it_reaches_max_datums():
+    sink = StubSink()
+    buf = MetricsBuffer(Sink=sink, FlushInterval=60, MaxDatums=2)
+    finish_tasks(buf, 1)
+    deadline = time.time() + 5
+    while not sink.calls and time.time() < deadline:
+        time.sleep(.01)
+    assert len(sink.datums) == 2
+    buf.close()
+
+
+def test_buffer_is_sent_after_flush_interval():
+    sink = StubSink()
+    buf = MetricsBuffer(Sink=sink, FlushInterval=.1)
+    finish_tasks(buf, 1)
+    time.sleep(.5)
+    assert len(sink.datums) == 2
+    buf.close()
+
+
+def test_datums_are_sent_20_per_call():
+    sink = StubSink()
+    buf = MetricsBuffer(Sink=sink, FlushInterval=60)
+    for i in range(45):
+        buf.add('ns', 'm{}'.format(i), 'Count', [], 1)
+    buf.close()
+    assert [len(d) for ns, d in sink.calls] == [20, 20, 5]
+    assert buf.stats['datums_sent'] == 45
+
+
+def test_sink_errors_are_counted():
+    sink = StubSink()
+    sink.put_metric_data = lambda **kwargs: 1 / 0
+    buf = MetricsBuffer(Sink=sink, FlushInterval=60)
+    finish_tasks(buf, 1)
+    buf.flush(5)
+    assert buf.stats['failed'] == 2 and buf.stats['datums_sent'] == 0
+    buf.close()
+
+
+def test_trackers_done_after_close_only_log_the_error():
+    buf = MetricsBuffer(Sink=StubSink(), FlushInterval=60)
+    buf.close()
+    pm = finish_tasks(buf, 1)
+    assert pm.children[0].status == 'Succeeded'
+    assert buf.stats['samples'] == 0
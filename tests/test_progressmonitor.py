@@ -7,7 +7,9 @@
 # or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
 import uuid
 from progressmonitor import ProgressTracker, ProgressMonitor, TrackerBase
-from progressmonitor import RedisProgressManager, DynamoDbDriver
+from progressmonitor import RedisProgressManager, DynamoDbDriver, MemoryDriver
+from progressmonitor import STATUSES
+import threading
 import time
 import pytest
 from mock import patch
@@ -15,6 +17,8 @@ import json
 import arrow
 from moto import mock_dynamodb2
 import boto3
+from progressmonitor.helpers.tree_helpers import build_tree
+import fakeredis
 
 
 redis_data = """
@@ -100,12 +104,15 @@ class MockProgressManager(object):
     def add_tracker(self, e):
         return None
 
-    def inc_progress(self, e, value):
+    def inc_progress(self, e, value=1, total=0):
         return None
 
     def update_tracker(self, pt):
         return None
 
+    def update_trackers(self, trackers):
+        return None
+
 
 def test_can_create_rollup_event():
     r = ProgressTracker(Id='test')
@@ -420,6 +427,14 @@ def test_can_convert_start_time_from_json():
     assert t.start_time == start
 
 
+def test_start_time_can_be_given_to_the_constructor():
+    start = arrow.get('2017-03-01T12:00:00+00:00')
+    assert ProgressTracker(StartTime=start).start_time == start
+    assert ProgressTracker(StartTime=start.isoformat()).start_time == start
+    assert ProgressTracker(StartTime=100)._start_time == 100.0
+    assert ProgressTracker().start_time is None
+
+
 def test_can_convert_in_canceled_status_from_json():
     a = setup_basic().find_friendly_id('a').cancel()
     t = TrackerBase.from_json(a.id, a.to_json())
@@ -458,21 +473,21 @@ def children_side_effect(id):
     return None
 
 
-@patch('progressmonitor.RedisProgressManager.get_by_id')
-@patch('progressmonitor.RedisProgressManager.get_children')
-def test_can_convert_from_db(c_mock, g_mock):
-    g_mock.side_effect = get_by_id_side_effect
-    c_mock.side_effect = children_side_effect
+def level_side_effect(ids, root_ids=None):
+    return [(get_by_id_side_effect(i), children_side_effect(i)) for i in ids]
+
+
+@patch('progressmonitor.RedisProgressManager.get_level')
+def test_can_convert_from_db(l_mock):
+    l_mock.side_effect = level_side_effect
     pm = ProgressMonitor(DbConnection=RedisProgressManager())
     pm = pm.load('94a52a41-bf9e-43e3-9650-859f7c263dc8')
     assert len(pm.all_children) == 5
 
 
-@patch('progressmonitor.RedisProgressManager.get_by_id')
-@patch('progressmonitor.RedisProgressManager.get_children')
-def test_can_start_all_parents(c_mock, g_mock):
-    g_mock.side_effect = get_by_id_side_effect
-    c_mock.side_effect = children_side_effect
+@patch('progressmonitor.RedisProgressManager.get_level')
+def test_can_start_all_parents(l_mock):
+    l_mock.side_effect = level_side_effect
     pm = ProgressMonitor(DbConnection=RedisProgressManager())
     pm = pm.load('94a52a41-bf9e-43e3-9650-859f7c263dc8')
     t = pm.find_id('039fe353-2c01-49f4-a743-b09c02c9f683')
@@ -767,3 +782,792 @@ def test_refresh_calls_load(load_mock):
     t = setup_basic_d().start().succeed().update()
     t.refresh()
     assert load_mock.called_once()
+
+
+def recount_status(t):
+    counts = {}
+    for c in t.all_children:
+        counts[c.status] = counts.get(c.status, 0) + 1
+    return counts
+
+
+def assert_status_counts_consistent(t):
+    assert (t.status_counts or {}) == recount_status(t)
+    assert t.all_children_count == len(t.all_children)
+    for c in t.children:
+        assert_status_counts_consistent(c)
+
+
+def test_status_counts_match_after_building_tree():
+    pm = setup_basic_multi_children()
+    assert_status_counts_consistent(pm)
+    assert pm.all_children_count == 8
+
+
+def test_status_counts_match_after_status_changes():
+    pm = setup_basic_multi_children()
+    pm.find_friendly_id('c').start(Parents=True)
+    pm.find_friendly_id('c1').start(Parents=True).fail()
+    pm.find_friendly_id('d2').start(Parents=True).succeed()
+    pm.find_friendly_id('c2').cancel()
+    assert_status_counts_consistent(pm)
+    assert pm.done_count == 3
+    assert pm.find_friendly_id('a').in_progress_count == 4
+
+
+def test_status_counts_match_when_adding_started_subtree():
+    pm = setup_basic()
+    pm.start()
+    s = ProgressTracker(Name='SubWorkflow')
+    pm.with_tracker(s)
+    s.start()
+    s.with_tracker(ProgressTracker(Name='Task'))
+    assert_status_counts_consistent(pm)
+    assert pm.in_progress_count == 1 and pm.not_started_count == 4
+
+
+@patch('progressmonitor.RedisProgressManager.get_level')
+def test_status_counts_match_after_load(l_mock):
+    l_mock.side_effect = level_side_effect
+    pm = ProgressMonitor(DbConnection=RedisProgressManager())
+    pm = pm.load('94a52a41-bf9e-43e3-9650-859f7c263dc8')
+    assert_status_counts_consistent(pm)
+    assert pm.not_started_count == 4
+
+
+def test_total_estimate_is_cached_until_estimate_changes():
+    pm = setup_basic_multi_children()
+    assert pm.total_estimate == 33
+    c = pm.find_friendly_id('c')
+    assert pm.find_friendly_id('br1').total_estimate == 11
+    c.with_estimated_seconds(20)
+    assert pm.total_estimate == 43
+    assert pm.find_friendly_id('br1')._estimate_rollup is not None
+
+
+def test_total_estimate_changes_with_parallel_children():
+    pm = setup_basic_multi_children()
+    a = pm.find_friendly_id('a')
+    assert pm.total_estimate == 33
+    a.with_parallel_children()
+    assert pm.total_estimate == 12
+    a.without_parallel_children()
+    assert pm.total_estimate == 33
+
+
+def test_total_estimate_includes_added_tracker():
+    pm = setup_basic()
+    assert pm.total_estimate == 10
+    pm.find_friendly_id('a').with_tracker(
+        ProgressTracker(EstimatedSeconds=5))
+    assert pm.total_estimate == 15
+
+
+def test_remaining_tracker_time_of_not_started_tree_is_total_estimate():
+    pm = setup_basic_multi_children()
+    assert pm.remaining_tracker_time_in_seconds == 33
+
+
+def test_remaining_tracker_time_skips_done_trackers():
+    pm = setup_basic_multi_children()
+    pm.find_friendly_id('c1').start(Parents=True).succeed()
+    assert pm.remaining_tracker_time_in_seconds == 22
+
+
+def test_remaining_tracker_time_counts_down_in_progress_trackers():
+    pm = setup_basic_multi_children()
+    start = arrow.utcnow().shift(seconds=-5)
+    pm.find_friendly_id('c').start(Parents=True, StartTime=start)
+    assert pm.remaining_tracker_time_in_seconds == 28
+
+
+def test_remaining_tracker_time_of_parallel_children_is_longest():
+    pm = setup_parallel()
+    start = arrow.utcnow().shift(seconds=-5)
+    pm.find_friendly_id('c1').start(Parents=True, StartTime=start)
+    assert pm.remaining_tracker_time_in_seconds == 12
+    d2 = pm.find_friendly_id('c2').children[0]
+    d2.start(Parents=True, StartTime=start)
+    assert pm.remaining_tracker_time_in_seconds == 10
+
+
+def test_monitor_indexes_trackers_added_before_and_after_attach():
+    pm = setup_basic()
+    assert pm.trackers[pm.find_friendly_id('c').id].friendly_id == 'c'
+    assert pm.index.friendly_ids['b'].name == 'CreateFolder'
+
+
+def test_find_id_only_returns_descendants():
+    pm = setup_basic_multi_children()
+    b = pm.find_friendly_id('b')
+    c1 = pm.find_friendly_id('c1')
+    assert pm.find_id(c1.id) is c1
+    assert b.find_id(c1.id) is None
+    assert pm.find_id(pm.id) is None
+
+
+def test_find_friendly_id_follows_renamed_friendly_id():
+    pm = setup_basic()
+    b = pm.find_friendly_id('b')
+    b.with_friendly_id('renamed')
+    assert pm.find_friendly_id('renamed') is b
+    assert not pm.find_friendly_id('b')
+
+
+def test_find_friendly_id_with_shared_friendly_id_searches_branch():
+    pm = setup_parallel()
+    c2 = pm.find_friendly_id('c2')
+    d2 = c2.children[0]
+    assert c2.find_friendly_id('c2') is d2
+
+
+@patch('progressmonitor.RedisProgressManager.get_level')
+def test_load_indexes_loaded_trackers(l_mock):
+    l_mock.side_effect = level_side_effect
+    pm = ProgressMonitor(DbConnection=RedisProgressManager())
+    pm = pm.load('94a52a41-bf9e-43e3-9650-859f7c263dc8')
+    t = pm.find_id('039fe353-2c01-49f4-a743-b09c02c9f683')
+    assert t and t.index is pm.index
+    assert len(pm.index.ids) == 6
+
+
+@patch('tests.test_progressmonitor.MockProgressManager.update_trackers')
+def test_update_all_flushes_dirty_trackers_parents_first(ut_mock):
+    pm = setup_basic()
+    pm.update_all()
+    assert ut_mock.call_count == 1
+    flushed = ut_mock.call_args[0][0]
+    assert [t.friendly_id for t in flushed] == [None, 'a', 'b', 'c']
+    assert not pm.index.dirty
+
+
+@patch('tests.test_progressmonitor.MockProgressManager.update_trackers')
+def test_update_all_flushes_only_changed_trackers(ut_mock):
+    pm = setup_basic()
+    pm.update_all()
+    pm.find_friendly_id('c').with_status_msg('copying')
+    pm.update_all()
+    flushed = ut_mock.call_args[0][0]
+    assert [t.friendly_id for t in flushed] == ['c']
+    assert not pm.find_friendly_id('c').is_dirty
+
+
+@patch('tests.test_progressmonitor.MockProgressManager.update_trackers')
+def test_update_all_with_nothing_dirty_skips_db(ut_mock):
+    pm = setup_basic()
+    pm.update_all()
+    pm.update_all()
+    assert ut_mock.call_count == 1
+
+
+@patch('tests.test_progressmonitor.MockProgressManager.update_trackers')
+def test_update_all_keeps_trackers_dirty_when_db_fails(ut_mock):
+    ut_mock.side_effect = Exception('unavailable')
+    pm = setup_basic()
+    with pytest.raises(Exception):
+        pm.update_all()
+    assert len(pm.index.dirty) == 4 and pm.is_dirty
+
+
+def test_update_clears_tracker_from_dirty_set():
+    pm = setup_basic()
+    a = pm.find_friendly_id('a')
+    a.update(False)
+    assert a.id not in pm.index.dirty and pm.id not in pm.index.dirty
+
+
+class CountingPipeline(object):
+    def __init__(self, pipe, counter):
+        self.pipe = pipe
+        self.counter = counter
+
+    def __getattr__(self, name):
+        return getattr(self.pipe, name)
+
+    def execute(self):
+        self.counter['round_trips'] += 1
+        return self.pipe.execute()
+
+
+def setup_redis_tree(width, depth):
+    r = fakeredis.FakeStrictRedis()
+    r.flushall()
+    rpm = RedisProgressManager(RedisConnection=r)
+    pm = ProgressMonitor(DbConnection=rpm, Name='Root')
+    build_tree(pm, width, depth)
+    pm.update_all()
+    return r, pm
+
+
+def test_redis_load_reads_one_pipeline_per_level():
+    r, pm = setup_redis_tree(3, 3)
+    counter = {'round_trips': 0}
+    pipeline = r.pipeline
+    r.pipeline = lambda *args: CountingPipeline(pipeline(*args), counter)
+    t = RedisProgressManager(RedisConnection=r).get_all_by_id(pm.id)
+    assert t.all_children_count == 39
+    assert counter['round_trips'] == 4
+    assert sorted([c.name for c in t.children]) == ['0-0', '0-1', '0-2']
+
+
+def test_redis_load_of_missing_id_returns_none():
+    r = fakeredis.FakeStrictRedis()
+    r.flushall()
+    assert RedisProgressManager(RedisConnection=r).get_all_by_id('x') is None
+
+
+def setup_dynamodb_tree(width, depth, **kwargs):
+    d = DynamoDbDriver(**kwargs)
+    pm = ProgressMonitor(DbConnection=d, Name='Root')
+    build_tree(pm, width, depth)
+    pm.update_all()
+    return d, pm
+
+
+@mock_dynamodb2
+def test_dynamodb_load_batches_each_level():
+    d, pm = setup_dynamodb_tree(3, 3)
+    d.round_trips = 0
+    t = d.get_all_by_id(pm.id)
+    assert t.all_children_count == 39
+    assert d.round_trips == 4
+    assert sorted([c.name for c in t.children]) == ['0-0', '0-1', '0-2']
+
+
+@mock_dynamodb2
+def test_dynamodb_load_splits_levels_into_100_key_batches():
+    d, pm = setup_dynamodb_tree(60, 1)
+    d.round_trips = 0
+    t = d.get_all_by_id(pm.id)
+    assert t.all_children_count == 60
+    assert d.round_trips == 3
+
+
+@mock_dynamodb2
+def test_dynamodb_load_of_missing_id_returns_none():
+    d = DynamoDbDriver()
+    assert d.get_all_by_id('missing') is None
+
+
+@mock_dynamodb2
+def test_dynamodb_drivers_describe_each_table_once_per_process():
+    DynamoDbDriver(TablePrefix='a')
+    with patch('progressmonitor.helpers.db_helpers.does_table_exist') as m:
+        DynamoDbDriver(TablePrefix='a')
+        DynamoDbDriver(TablePrefix='a')
+        assert m.call_count == 0
+        m.return_value = True
+        DynamoDbDriver(TablePrefix='b')
+        assert m.call_count == 3
+
+
+@mock_dynamodb2
+def test_dynamodb_driver_can_skip_table_validation():
+    d = DynamoDbDriver(TablePrefix='a', ValidateTables=False)
+    client = d.dynamodb.meta.client
+    assert client.list_tables()['TableNames'] == []
+
+
+@mock_dynamodb2
+def test_dynamodb_drivers_share_one_client_and_a_resource_per_thread():
+    a = DynamoDbDriver()
+    b = DynamoDbDriver(TablePrefix='b')
+    assert a.dynamodb is b.dynamodb
+    client = a.dynamodb.meta.client
+    assert client.meta.config.max_pool_connections == 25
+    assert a.dynamodb.Table(a.TRACKER_TABLE).meta.client is client
+    other = []
+    thread = threading.Thread(target=lambda: other.append(a.dynamodb))
+    thread.start()
+    thread.join()
+    assert other[0] is not a.dynamodb
+    assert other[0].meta.client is client
+
+
+@mock_dynamodb2
+@patch('progressmonitor.time.sleep')
+def test_dynamodb_load_retries_unprocessed_keys(sleep_mock):
+    d, pm = setup_dynamodb_tree(2, 1)
+    batch_get_item = d.dynamodb.batch_get_item
+    calls = []
+
+    def throttle_first_call(RequestItems):
+        calls.append(RequestItems)
+        if len(calls) > 1:
+            return batch_get_item(RequestItems=RequestItems)
+        return {'Responses': {}, 'UnprocessedKeys': RequestItems}
+
+    d.dynamodb.batch_get_item = throttle_first_call
+    t = d.get_all_by_id(pm.id)
+    assert t.all_children_count == 2
+    assert sleep_mock.call_count == 1
+
+
+@mock_dynamodb2
+def test_dynamodb_batch_writes_group_25_items_per_call():
+    d, pm = setup_dynamodb_tree(10, 2, BatchWrites=True)
+    assert d.round_trips == 5
+    t = d.get_all_by_id(pm.id)
+    assert t.all_children_count == 110
+
+
+@mock_dynamodb2
+def test_dynamodb_batch_writes_save_tracker_fields():
+    d = DynamoDbDriver(BatchWrites=True)
+    pm = ProgressMonitor(DbConnection=d, Name='Root')
+    a = ProgressTracker(Name='a', FriendlyId='fa', EstimatedSeconds=10)
+    pm.with_tracker(a)
+    pm.start()
+    a.start().fail(Message='broken')
+    pm.update_all()
+    t = d.get_by_friendly_id('fa')
+    assert t.id == a.id and t.status == 'Failed' and t.is_done
+    assert t.status_msg == 'broken' and t.total_estimate == 10
+
+
+@mock_dynamodb2
+def test_dynamodb_batch_writes_send_shared_friendly_id_once():
+    d = DynamoDbDriver(BatchWrites=True)
+    pm = ProgressMonitor(DbConnection=d, Name='Root')
+    a = ProgressTracker(Name='a', FriendlyId='shared')
+    b = ProgressTracker(Name='b', FriendlyId='shared')
+    pm.with_tracker(a).with_tracker(b)
+    pm.update_all()
+    assert d.round_trips == 1
+    assert d.get_by_friendly_id('shared').id in [a.id, b.id]
+
+
+@mock_dynamodb2
+@patch('progressmonitor.time.sleep')
+def test_dynamodb_batch_writes_retry_unprocessed_items(sleep_mock):
+    d = DynamoDbDriver(BatchWrites=True)
+    batch_write_item = d.dynamodb.batch_write_item
+    calls = []
+
+    def throttle_first_call(RequestItems):
+        calls.append(RequestItems)
+        if len(calls) > 1:
+            return batch_write_item(RequestItems=RequestItems)
+        return {'UnprocessedItems': RequestItems}
+
+    d.dynamodb.batch_write_item = throttle_first_call
+    pm = ProgressMonitor(DbConnection=d, Name='Root')
+    pm.with_tracker(ProgressTracker(Name='a'))
+    pm.update_all()
+    assert len(calls) == 2 and sleep_mock.call_count == 1
+    assert d.get_all_by_id(pm.id).all_children_count == 1
+
+
+@mock_dynamodb2
+def test_dynamodb_batch_writes_keep_what_other_writers_changed():
+    d = DynamoDbDriver(BatchWrites=True)
+    pm = ProgressMonitor(DbConnection=d, Name='Root')
+    build_tree(pm, 2, 1)
+    pm.start()
+    pm.update_all()
+    # another worker adds progress and finishes a child, and the tree is
+    # given a TTL
+    other = DynamoDbDriver().get_all_by_id(pm.id)
+    c = other.find_id(pm.children[0].id)
+    c.with_progress_total(4).inc_progress(3)
+    c.start().succeed()
+    other.update()
+    table = d.dynamodb.Table(d.TRACKER_TABLE)
+    table.update_item(Key={'Id': pm.id}, UpdateExpression='SET ExpiresAt=:e',
+                      ExpressionAttributeValues={':e': 5})
+    version = table.get_item(Key={'Id': pm.id})['Item']['Version']
+    # the batch writer only knows its own changes
+    pm.children[1].start()
+    pm.with_status_msg('busy')
+    pm.update_all()
+    item = table.get_item(Key={'Id': pm.id}, ConsistentRead=True)['Item']
+    assert item['ExpiresAt'] == 5 and item['Version'] >= version
+    t = DynamoDbDriver().get_all_by_id(pm.id, 0)
+    assert t.status_msg == 'busy'
+    assert t.get_tracker_progress_total() == (3, 4)
+    assert t.succeeded_count == 1 and t.in_progress_count == 1
+
+
+def test_redis_update_all_writes_one_pipeline():
+    r, pm = setup_redis_tree(3, 3)
+    assert pm.db_conn.round_trips == 1
+    t = RedisProgressManager(RedisConnection=r).get_all_by_id(pm.id)
+    assert t.all_children_count == 39
+
+
+def test_redis_update_all_chunks_pipeline():
+    r = fakeredis.FakeStrictRedis()
+    r.flushall()
+    rpm = RedisProgressManager(RedisConnection=r, FlushChunkSize=2,
+                               TransactionalFlush=True)
+    pm = ProgressMonitor(DbConnection=rpm, Name='Root')
+    for i in range(4):
+        pm.with_tracker(ProgressTracker(Name=str(i), FriendlyId=str(i)))
+    pm.update_all()
+    assert rpm.round_trips == 3
+    assert rpm.get_by_friendly_id('3').name == '3'
+
+
+def test_progress_rolls_up_to_ancestors():
+    pm = setup_basic()
+    b = pm.find_friendly_id('b')
+    c = pm.find_friendly_id('c')
+    b.with_progress_total(10)
+    c.with_progress_total(40)
+    c.inc_progress(5)
+    b.inc_progress()
+    assert pm.get_tracker_progress_total() == (6, 50)
+    assert c.get_progress_complete() == .125
+    assert pm.find_friendly_id('a').get_progress_remaining() == .88
+
+
+def test_progress_of_attached_subtree_rolls_up():
+    pm = setup_basic()
+    s = ProgressTracker().with_progress_total(20)
+    s.with_tracker(ProgressTracker().with_progress_total(30))
+    s.children[0].inc_progress(3)
+    pm.with_tracker(s)
+    assert pm.get_tracker_progress_total() == (3, 50)
+
+
+@patch('tests.test_progressmonitor.MockProgressManager.inc_progress')
+def test_progress_increments_are_coalesced(ip_mock):
+    pm = setup_basic()
+    c = pm.find_friendly_id('c')
+    c.progress_batch_size = 10
+    c.progress_flush_interval = 60
+    c.with_progress_total(100)
+    for i in range(25):
+        c.inc_progress()
+    assert ip_mock.call_count == 2
+    assert ip_mock.call_args[0] == (c, 10, 0)
+    pm.update_all()
+    assert ip_mock.call_count == 3 and ip_mock.call_args[0] == (c, 5, 0)
+
+
+def test_redis_progress_is_incremented_on_server_with_rollup():
+    r, pm = setup_redis_tree(2, 2)
+    leaf = pm.children[0].children[0]
+    leaf.with_progress_total(50)
+    leaf.progress_batch_size = 1000
+    leaf.progress_flush_interval = 60
+    for i in range(7):
+        leaf.inc_progress()
+    leaf.update()
+    assert r.hget(leaf.id, 'curr_prog') == '7'
+    rpm = RedisProgressManager(RedisConnection=r)
+    root = rpm.from_json(pm.id, rpm.get_by_id(pm.id))
+    assert root.get_tracker_progress_total() == (7, 50)
+    assert rpm.get_all_by_id(pm.id).get_tracker_progress_total() == (7, 50)
+
+
+@mock_dynamodb2
+def test_dynamodb_progress_is_incremented_on_server_with_rollup():
+    d, pm = setup_dynamodb_tree(2, 2)
+    leaf = pm.children[0].children[0]
+    leaf.with_progress_total(50).inc_progress(3)
+    pm.update_all()
+    root = d.from_json(pm.id, d.get_by_id(pm.id))
+    assert root.get_tracker_progress_total() == (3, 50)
+    assert d.get_all_by_id(pm.id).get_tracker_progress_total() == (3, 50)
+
+
+def fresh_redis_driver():
+    r = fakeredis.FakeStrictRedis()
+    r.flushall()
+    return RedisProgressManager(RedisConnection=r)
+
+
+@pytest.mark.parametrize('make_driver', [MemoryDriver, fresh_redis_driver,
+                                         DynamoDbDriver])
+def test_progress_of_a_tracker_loaded_alone_rolls_up(make_driver):
+    with mock_dynamodb2():
+        d = make_driver()
+        pm = ProgressMonitor(DbConnection=d, Name='Root')
+        leaves = build_tree(pm, 2, 2, friendly=True)
+        pm.update_all()
+        leaf = d.get_by_friendly_id(leaves[3].friendly_id)
+        assert leaf.parent is None
+        leaf.with_progress_total(100)
+        for i in range(10):
+            leaf.inc_progress()
+        leaf.flush_progress()
+        # with Depth=0 the root's stored rollup is all there is
+        assert d.get_all_by_id(pm.id, 0).get_tracker_progress_total() == \
+            (10, 100)
+        t = d.get_all_by_id(pm.id, 1)
+        assert t.find_id(leaves[3].parent.id).get_tracker_progress_total() \
+            == (10, 100)
+
+        # the ancestors are only looked up once
+        levels = []
+        get_level = d.get_level
+        d.get_level = lambda *args: levels.append(args) or get_level(*args)
+        leaf.inc_progress(5).flush_progress()
+        assert levels == []
+        assert d.get_all_by_id(pm.id, 0).get_tracker_progress_total() == \
+            (15, 100)
+
+
+@pytest.mark.parametrize('make_driver', [MemoryDriver, fresh_redis_driver,
+                                         DynamoDbDriver])
+def test_counts_of_unloaded_children_come_from_the_store(make_driver):
+    with mock_dynamodb2():
+        d = make_driver()
+        pm = ProgressMonitor(DbConnection=d, Name='Root')
+        leaves = build_tree(pm, 3, 2, friendly=True)
+        pm.start()
+        leaves[0].parent.start()
+        leaves[0].start().succeed()
+        leaves[1].start()
+        pm.update_all()
+        t = d.get_all_by_id(pm.id, 0)
+        trips = d.round_trips
+        assert t.all_children_count == 12
+        assert t.succeeded_count == 1 and t.in_progress_count == 2
+        assert t.not_started_count == 9
+        assert d.round_trips == trips
+
+        # a tracker loaded on its own counts in its stored ancestors
+        leaf = d.get_by_friendly_id(leaves[1].friendly_id)
+        leaf.fail()
+        leaf.update()
+        t.refresh()
+        assert t.failed_count == 1 and t.in_progress_count == 1
+        t.load_subtree()
+        assert_status_counts_consistent(t)
+        assert t.failed_count == 1 and t.in_progress_count == 1
+
+
+@pytest.mark.parametrize('make_driver', [MemoryDriver, fresh_redis_driver,
+                                         DynamoDbDriver])
+def test_two_writers_of_a_status_count_it_once(make_driver):
+    with mock_dynamodb2():
+        d = make_driver()
+        pm = ProgressMonitor(DbConnection=d, Name='Root')
+        build_tree(pm, 3, 1)
+        pm.start()
+        pm.update_all()
+        c0, c1 = pm.children[0].id, pm.children[1].id
+        # both workers read the tree before either writes
+        copies = [d.get_all_by_id(pm.id) for i in range(2)]
+        for n, t in enumerate(copies):
+            t.find_id(c0).start().succeed()
+            if n == 0:
+                t.find_id(c1).start().succeed()
+            else:
+                t.find_id(c1).start().fail()
+            t.update()
+        stored = d.get_all_by_id(pm.id, 0)
+        full = d.get_all_by_id(pm.id)
+        assert (full.find_id(c0).status, full.find_id(c1).status) == \
+            ('Succeeded', 'Failed')
+        assert stored.all_children_count == 3
+        assert (stored.succeeded_count, stored.failed_count,
+                stored.not_started_count) == (1, 1, 1)
+
+
+def test_trackers_have_no_instance_dict():
+    pm = setup_basic()
+    for t in [pm, pm.find_friendly_id('a')]:
+        assert not hasattr(t, '__dict__')
+    with pytest.raises(AttributeError):
+        pm.find_friendly_id('a').not_a_field = 1
+
+
+def test_status_is_stored_as_a_code():
+    a = setup_basic().find_friendly_id('a')
+    a.start(Parents=True)
+    assert a.status == 'In Progress' and isinstance(a._status, int)
+    a.status = 'Custom'
+    assert a.status == 'Custom' and a.parent.get_status_count(['Custom']) == 1
+    # statuses outside STATUSES don't get a code
+    assert a._status == 'Custom' and 'Custom' not in STATUSES
+
+
+def test_times_are_stored_as_epoch_seconds():
+    start = arrow.utcnow().shift(seconds=-5)
+    a = setup_basic().find_friendly_id('a')
+    a.start(Parents=True, StartTime=start)
+    assert a._start_time == start.float_timestamp
+    assert a.start_time == start and a.finish_time is None
+    a.succeed()
+    assert isinstance(a._finish_time, float)
+    assert a.elapsed_time_in_seconds == 5
+    assert a.snapshot().to_json()['start'] == start.isoformat()
+
+
+def test_redis_load_with_depth_reads_only_the_root():
+    r, pm = setup_redis_tree(10, 3)
+    pm.children[0].children[0].children[0].with_progress_total(4) \
+        .inc_progress(3)
+    pm.update_all()
+    rpm = RedisProgressManager(RedisConnection=r)
+    t = ProgressMonitor(DbConnection=rpm).load(pm.id, Depth=0)
+    assert rpm.round_trips == 1
+    assert t.name == 'Root' and t.status == 'Not started'
+    assert t.get_tracker_progress_total() == (3, 4)
+    assert len(t.loaded_children) == 0 and len(t.child_ids) == 10
+
+
+def test_redis_lazy_children_load_a_sibling_group_at_once():
+    r, pm = setup_redis_tree(10, 3)
+    rpm = RedisProgressManager(RedisConnection=r)
+    t = rpm.get_all_by_id(pm.id, 1)
+    assert rpm.round_trips == 2
+    c = t.children[0]
+    assert len(c.loaded_children) == 0
+    assert len(c.children) == 10 and rpm.round_trips == 3
+    assert not c.is_dirty and c.id not in t.index.dirty
+    assert t.find_id(pm.children[9].children[9].children[9].id)
+    assert t.all_children_count == 1110
+    assert_status_counts_consistent(t)
+
+
+def test_lazy_children_rebuild_the_progress_rollup():
+    r, pm = setup_redis_tree(3, 3)
+    pm.children[1].children[2].children[0].with_progress_total(10) \
+        .inc_progress(6)
+    pm.update_all()
+    rpm = RedisProgressManager(RedisConnection=r)
+    t = rpm.get_all_by_id(pm.id, 1)
+    assert t.get_tracker_progress_total() == (6, 10)
+    c = t.find_id(pm.children[1].id)
+    c.children
+    assert t.get_tracker_progress_total() == (6, 10)
+    assert c.get_tracker_progress_total() == (6, 10)
+
+
+@mock_dynamodb2
+def test_dynamodb_load_with_depth_reads_only_the_root():
+    d, pm = setup_dynamodb_tree(3, 3)
+    d.round_trips = 0
+    t = d.get_all_by_id(pm.id, 0)
+    assert d.round_trips == 1 and len(t.child_ids) == 3
+    assert len(t.all_children) == 39
+
+
+def change_tree(pm):
+    a = pm.children[0]
+    a.start(Parents=True)
+    a.children[1].start().with_progress_total(10).inc_progress(4)
+    a.children[2].succeed()
+    a.with_tracker(ProgressTracker(Name='new', FriendlyId='new'))
+    pm.update_all()
+    return a
+
+
+@patch('progressmonitor.REFRESH_OVERLAP', 0)
+def test_redis_refresh_updates_the_tree_in_place():
+    r, pm = setup_redis_tree(3, 2)
+    rpm = RedisProgressManager(RedisConnection=r)
+    t = rpm.get_all_by_id(pm.id)
+    leaf = t.find_id(pm.children[0].children[1].id)
+    time.sleep(.01)
+    a = change_tree(pm)
+    rpm.round_trips = 0
+    assert t.refresh() is t
+    assert rpm.round_trips == 3
+    assert t.find_id(leaf.id) is leaf and leaf.status == 'In Progress'
+    assert t.find_id(a.id).status == 'In Progress'
+    assert t.find_friendly_id('new').parent is t.find_id(a.id)
+    assert t.succeeded_count == 1 and t.all_children_count == 13
+    assert t.get_tracker_progress_total() == (4, 10)
+    assert_status_counts_consistent(t)
+    assert not t.index.dirty
+
+
+@patch('progressmonitor.REFRESH_OVERLAP', 0)
+def test_redis_refresh_reads_only_changed_trackers():
+    r, pm = setup_redis_tree(3, 2)
+    rpm = RedisProgressManager(RedisConnection=r)
+    t = rpm.get_all_by_id(pm.id)
+    time.sleep(.01)
+    pm.children[2].with_status_msg('changed').update(False)
+    changes, synced = rpm.get_changes(t.root_id, t.index.synced_at)
+    # the newest trackers already seen come back too, since is inclusive
+    newest = [n.id for n in t.index.ids.itervalues()
+              if n._last_update == t.index.synced_at]
+    assert set([i for i, j, c in changes]) == \
+        set(newest + [pm.children[2].id])
+    t.refresh()
+    assert t.find_id(pm.children[2].id).status_msg == 'changed'
+    assert rpm.get_changes(t.root_id, synced + .000001)[0] == []
+
+
+def test_refresh_keeps_unwritten_changes():
+    r, pm = setup_redis_tree(2, 1)
+    rpm = RedisProgressManager(RedisConnection=r)
+    t = rpm.get_all_by_id(pm.id)
+    c = t.find_id(pm.children[0].id).with_status_msg('mine')
+    pm.children[0].with_status_msg('theirs').update(False)
+    t.refresh()
+    assert c.status_msg == 'mine'
+
+
+@mock_dynamodb2
+@patch('progressmonitor.REFRESH_OVERLAP', 0)
+def test_dynamodb_refresh_updates_the_tree_in_place():
+    d, pm = setup_dynamodb_tree(3, 2)
+    t = d.get_all_by_id(pm.id)
+    leaf = t.find_id(pm.children[0].children[1].id)
+    time.sleep(.01)
+    newest = [n for n in t.index.ids.values()
+              if n._last_update == t.index.synced_at]
+    a = change_tree(pm)
+    changes, synced = d.get_changes(t.root_id, t.index.synced_at)
+    # the newest records already loaded are read again, as they may have
+    # been written again in the same microsecond
+    changed = [pm, a, a.children[1], a.children[2], a.children[3]] + newest
+    assert sorted([i for i, j, c in changes]) == \
+        sorted(set([n.id for n in changed]))
+    t.refresh()
+    assert t.find_id(leaf.id) is leaf and leaf.status == 'In Progress'
+    assert t.find_friendly_id('new').parent is t.find_id(a.id)
+    assert t.succeeded_count == 1 and t.all_children_count == 13
+    assert t.get_tracker_progress_total() == (4, 10)
+    assert_status_counts_consistent(t)
+
+
+def test_redis_writes_are_stamped_with_the_server_clock():
+    r = fakeredis.FakeStrictRedis()
+    r.flushall()
+    # a server clock an hour ahead of this one
+    r.time = lambda: divmod(int((time.time() + 3600) * 1000000), 1000000)
+    d = RedisProgressManager(RedisConnection=r)
+    pm = ProgressMonitor(DbConnection=d, Name='Root')
+    pm.update_all()
+    score = r.zscore(d.changes_key(pm.id), pm.id)
+    assert abs(score - (time.time() + 3600)) < 5
+    assert abs(pm._last_update - score) < .001
+
+
+def test_refresh_sees_redis_writers_with_a_slow_clock():
+    r = fakeredis.FakeStrictRedis()
+    r.flushall()
+    real = time.time
+    r.time = lambda: divmod(int(real() * 1000000), 1000000)
+    pm = ProgressMonitor(DbConnection=RedisProgressManager(RedisConnection=r),
+                         Name='Root')
+    build_tree(pm, 2, 1)
+    pm.update_all()
+    t = RedisProgressManager(RedisConnection=r).get_all_by_id(pm.id)
+    c = RedisProgressManager(RedisConnection=r) \
+        .get_all_by_id(pm.children[0].id)
+    with patch('progressmonitor.time.time', lambda: real() - 30):
+        c.with_status_msg('late').update()
+    t.refresh()
+    assert t.find_id(c.id).status_msg == 'late'
+
+
+def test_refresh_overlap_covers_writers_with_a_slow_clock():
+    d = MemoryDriver(RefreshOverlap=60)
+    pm = ProgressMonitor(DbConnection=d, Name='Root')
+    build_tree(pm, 2, 1)
+    pm.update_all()
+    t = d.get_all_by_id(pm.id)
+    real = time.time
+    with patch('progressmonitor.time.time', lambda: real() - 30):
+        pm.children[0].with_status_msg('late').update(False)
+    t.refresh()
+    assert t.find_id(pm.children[0].id).status_msg == 'late'
@@ -0,0 +1,121 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+
+#    http://aws.amazon.com/asl/
+
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+import time
+import fakeredis
+from progressmonitor import ProgressTracker, ProgressMonitor, \
+    RedisClusterProgressManager, ChangeSubscriber
+from progressmonitor.helpers.redis_helpers import key_slot
+from progressmonitor.helpers.tree_helpers import build_tree
+
+
+def setup_cluster_tree(width=3, depth=2, **kwargs):
+    r = fakeredis.FakeStrictRedis()
+    r.flushall()
+    rpm = RedisClusterProgressManager(RedisConnection=r, **kwargs)
+    pm = ProgressMonitor(DbConnection=rpm, Name='Root', FriendlyId='root')
+    build_tree(pm, width, depth, friendly=True)
+    pm.update_all()
+    return r, rpm, pm
+
+
+class PipelineRecorder(object):
+    def __init__(self, r):
+        self.transactions = []
+        self.pipeline = r.pipeline
+        r.pipeline = self
+
+    def __call__(self, transaction=True):
+        self.transactions.append(transaction)
+        return self.pipeline(transaction)
+
+
+def test_every_tree_key_of_a_monitor_is_in_its_slot():
+    r, rpm, a = setup_cluster_tree()
+    b = ProgressMonitor(DbConnection=rpm, Name='Other')
+    b.with_tracker(ProgressTracker(Name='b-0'))
+    b.update_all()
+    for pm in [a, b]:
+        keys = r.keys('{{{}}}*'.format(pm.id))
+        # records and counted statuses, children sets of the parents and
+        # the change index
+        assert len(keys) == 2 * (pm.all_children_count + 1) + \
+            len([t for t in pm.all_children if t.children]) + 2
+        assert set([key_slot(k) for k in keys]) == \
+            set([rpm.tree_slot(pm.id)])
+    others = set([k for k in r.keys() if not k.startswith('{')])
+    ids = [t.id for pm in [a, b] for t in [pm] + pm.all_children]
+    friendly_ids = [t.friendly_id for t in [a] + a.all_children]
+    assert others == set(['{}:root'.format(i) for i in ids] + friendly_ids)
+
+
+def test_load_knows_the_root_of_every_level():
+    r, rpm, pm = setup_cluster_tree()
+    rpm.round_trips = 0
+    t = rpm.get_all_by_id(pm.id)
+    # the root lookup, then one pipeline per level
+    assert rpm.round_trips == 4
+    assert t.all_children_count == 12
+    assert sorted([c.name for c in t.children]) == ['0-0', '0-1', '0-2']
+    f = rpm.get_by_friendly_id('root-1-2')
+    assert f.name == '1-2' and f.root_id == pm.id
+
+
+def test_subtrees_and_single_trackers_load_by_id():
+    r, rpm, pm = setup_cluster_tree()
+    b = pm.children[1]
+    t = rpm.get_all_by_id(b.id)
+    assert t.name == '0-1' and t.all_children_count == 3
+    assert t.root_id == pm.id
+    assert rpm.get_by_id(b.children[0].id)
+    assert rpm.get_children(b.id) == set([c.id for c in b.children])
+    assert rpm.get_children(b.children[0].id) is None
+    assert rpm.get_all_by_id('missing') is None
+
+
+def test_lazy_loads_progress_and_refresh_use_the_tree_keys():
+    r, rpm, pm = setup_cluster_tree()
+    t = rpm.get_all_by_id(pm.id, 1)
+    leaf = pm.children[2].children[1]
+    time.sleep(.01)
+    leaf.start(Parents=True).with_progress_total(10).inc_progress(4)
+    pm.children[0].children[0].start(Parents=True).succeed()
+    pm.update_all()
+    t.refresh()
+    assert t.find_id(leaf.id).current_progress == 4
+    assert t.get_tracker_progress_total() == (4, 10)
+    assert t.succeeded_count == 1 and t.all_children_count == 12
+
+
+def test_writes_never_use_multi():
+    r = fakeredis.FakeStrictRedis()
+    r.flushall()
+    recorder = PipelineRecorder(r)
+    rpm = RedisClusterProgressManager(RedisConnection=r,
+                                      TransactionalFlush=True)
+    pm = ProgressMonitor(DbConnection=rpm)
+    t = ProgressTracker(Name='a')
+    pm.with_tracker(t)
+    pm.update()
+    pm.update_all()
+    t.start(Parents=True).inc_progress(1)
+    t.update()
+    assert recorder.transactions and not any(recorder.transactions)
+
+
+def test_change_events_use_the_tree_channel():
+    r, rpm, pm = setup_cluster_tree(PublishChanges=True)
+    reader = RedisClusterProgressManager(RedisConnection=r)
+    t = reader.get_all_by_id(pm.id)
+    sub = ChangeSubscriber(Tracker=t)
+    assert key_slot(sub.channel) == rpm.tree_slot(pm.id)
+    sub.poll()
+    pm.children[1].start(Parents=True)
+    pm.update_all()
+    assert sub.poll() == 2
+    assert t.find_id(pm.children[1].id).status == 'In Progress'
+    sub.close()
@@ -0,0 +1,206 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+
+#    http://aws.amazon.com/asl/
+
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+import time
+import boto3
+import fakeredis
+import pytest
+from mock import MagicMock
+from moto import mock_dynamodb2
+from progressmonitor import ProgressMonitor, \
+    RedisProgressManager, RedisClusterProgressManager, DynamoDbDriver
+from progressmonitor.helpers.tree_helpers import build_tree
+
+boto3.setup_default_session(region_name='foo')
+
+
+def setup_tree(db, name, width=3):
+    pm = ProgressMonitor(DbConnection=db, Name=name, FriendlyId=name)
+    # children with friendly ids <name>-<n>, each with one leaf
+    for c in build_tree(pm, width, 1, friendly=True):
+        build_tree(c, 1, 1)
+    pm.update_all()
+    return pm
+
+
+def finish(pm):
+    for t in pm.all_children:
+        if not t.children:
+            t.start(Parents=True).with_progress_total(2).inc_progress(2)
+            t.succeed()
+    for t in pm.all_children:
+        if t.children:
+            t.succeed()
+    pm.succeed()
+    pm.update_all()
+    return pm
+
+
+def redis_driver(cls=RedisProgressManager, **kwargs):
+    r = fakeredis.FakeStrictRedis()
+    r.flushall()
+    return r, cls(RedisConnection=r, RetentionSeconds=3600, **kwargs)
+
+
+@pytest.mark.parametrize('cls', [RedisProgressManager,
+                                 RedisClusterProgressManager])
+def test_sweep_expires_every_key_of_finished_trees_only(cls):
+    r, db = redis_driver(cls)
+    done = finish(setup_tree(db, 'done'))
+    running = setup_tree(db, 'running')
+    running.start()
+    running.update_all()
+    assert db.sweep() == 1
+    assert db.sweep() == 0
+    expiring = set([k for k in r.keys() if r.ttl(k) > 0])
+    for k in r.keys():
+        assert r.ttl(k) in [-1, 3600]
+    for t in [done] + done.all_children:
+        for k in db.tree_keys(done.id, t.id):
+            if r.exists(k):
+                assert k in expiring
+    assert db.changes_key(done.id) in expiring
+    assert set(['done', 'done-0', 'done-1', 'done-2']) <= expiring
+    for t in [running] + running.all_children:
+        for k in db.tree_keys(running.id, t.id):
+            assert k not in expiring
+    assert db.changes_key(running.id) not in expiring
+
+
+def test_sweep_takes_the_same_round_trips_for_many_trees():
+    r, db = redis_driver(ArchiveDone=True)
+    for n in range(20):
+        finish(setup_tree(db, 't{}'.format(n)))
+    db.round_trips = 0
+    assert db.sweep(limit=15) == 15
+    assert db.round_trips == 4
+    assert db.sweep() == 5
+
+
+def test_reopened_trees_are_not_expired():
+    r, db = redis_driver()
+    pm = finish(setup_tree(db, 'a'))
+    # another worker rewrites the root as running
+    pm.is_done = False
+    pm.is_dirty = True
+    pm.update(False)
+    assert db.sweep() == 0
+    assert r.ttl(pm.id) == -1
+
+
+def test_friendly_ids_taken_by_newer_trackers_are_kept():
+    r, db = redis_driver()
+    finish(setup_tree(db, 'a'))
+    ProgressMonitor(DbConnection=db, Name='new', FriendlyId='a-1').update()
+    db.sweep()
+    assert r.ttl('a-0') == 3600
+    assert r.ttl('a-1') == -1
+    assert db.get_by_friendly_id('a-1').name == 'new'
+
+
+def test_archive_summarizes_the_tree_and_is_kept():
+    r, db = redis_driver(ArchiveDone=True)
+    pm = finish(setup_tree(db, 'a'))
+    db.sweep()
+    a = db.get_archive(pm.id)
+    assert r.ttl(db.archive_key(pm.id)) == -1
+    assert a['id'] == pm.id and a['name'] == 'a'
+    assert a['friendly_id'] == 'a' and a['status'] == 'Succeeded'
+    assert a['trackers'] == 7
+    assert a['counts'] == {'Succeeded': 7}
+    assert a['progress'] == [6, 6]
+    assert a['elapsed_seconds'] == pm._finish_time - pm._start_time
+    assert set([i[0] for i in a['items']]) == \
+        set([t.id for t in [pm] + pm.all_children])
+    assert db.get_archive('missing') is None
+
+
+def test_sweep_needs_retention():
+    r = fakeredis.FakeStrictRedis()
+    db = RedisProgressManager(RedisConnection=r)
+    finish(setup_tree(db, 'a'))
+    assert db.sweep() == 0
+    with pytest.raises(Exception) as e:
+        db.expire_trees(['x'])
+    assert 'RetentionSeconds' in str(e.value)
+
+
+@mock_dynamodb2
+def test_dynamodb_sweep_sets_expires_at_on_every_item():
+    db = DynamoDbDriver(BatchWrites=True, RetentionSeconds=3600,
+                        ArchiveDone=True)
+    done = finish(setup_tree(db, 'done'))
+    running = setup_tree(db, 'running')
+    ProgressMonitor(DbConnection=db, Name='new', FriendlyId='done-1').update()
+    start = time.time()
+    assert db.sweep() == 1
+    assert db.sweep() == 0
+
+    def items(table, key, values):
+        t = db.dynamodb.Table(table)
+        return [t.get_item(Key={key: v})['Item'] for v in values]
+
+    for item in items(db.TRACKER_TABLE, 'Id',
+                      [t.id for t in [done] + done.all_children]):
+        assert start + 3600 - 1 <= item['ExpiresAt'] <= time.time() + 3600
+    for item in items(db.CHILDREN_TABLE, 'Id',
+                      [t.id for t in [done] + done.children]):
+        assert 'ExpiresAt' in item
+    friendly = items(db.FRIENDLY_ID_TABLE, 'FriendlyId',
+                     ['done', 'done-0', 'done-1'])
+    assert ['ExpiresAt' in f for f in friendly] == [True, True, False]
+    for item in items(db.TRACKER_TABLE, 'Id',
+                      [t.id for t in [running] + running.all_children]):
+        assert 'ExpiresAt' not in item
+    assert db.get_archive(done.id)['counts'] == {'Succeeded': 7}
+    assert db.get_all_by_id(done.id).find_friendly_id('done-2').is_done
+
+
+@pytest.mark.parametrize('batch', [False, True])
+def test_dynamodb_sweep_finds_roots_finished_by_other_drivers(batch):
+    with mock_dynamodb2():
+        db = DynamoDbDriver(BatchWrites=batch, RetentionSeconds=3600)
+        done = [finish(setup_tree(db, 'a')), finish(setup_tree(db, 'b'))]
+        setup_tree(db, 'running')
+        # a janitor process has no trackers of its own
+        janitor = DynamoDbDriver(RetentionSeconds=3600)
+        assert janitor.sweep(limit=1) == 1
+        assert janitor.sweep() == 1
+        assert janitor.sweep() == 0
+        table = db.dynamodb.Table(db.TRACKER_TABLE)
+        for pm in done:
+            assert 'ExpiresAt' in table.get_item(Key={'Id': pm.id})['Item']
+
+
+@mock_dynamodb2
+def test_dynamodb_reopened_trees_are_not_expired():
+    db = DynamoDbDriver(RetentionSeconds=3600)
+    pm = finish(setup_tree(db, 'a'))
+    pm.is_done = False
+    pm.is_dirty = True
+    pm.update(False)
+    # the marker is dropped without expiring the tree
+    assert db.sweep() == 1
+    assert db.sweep() == 0
+    table = db.dynamodb.Table(db.TRACKER_TABLE)
+    assert 'ExpiresAt' not in table.get_item(Key={'Id': pm.id})['Item']
+
+
+def test_retention_turns_on_ttl_where_it_is_off():
+    resource = MagicMock()
+    client = resource.meta.client
+    client.describe_time_to_live.side_effect = lambda TableName: {
+        'TimeToLiveDescription': {
+            'TimeToLiveStatus': 'ENABLED' if 'Children' in TableName
+            else 'DISABLED'}}
+    db = DynamoDbDriver(DynamoDbResource=resource, RetentionSeconds=3600)
+    assert sorted([c[1]['TableName'] for c in
+                   client.update_time_to_live.call_args_list]) == \
+        [db.FRIENDLY_ID_TABLE, db.TRACKER_TABLE]
+    # checked once per process
+    DynamoDbDriver(DynamoDbResource=resource, RetentionSeconds=3600)
+    assert client.describe_time_to_live.call_count == 3
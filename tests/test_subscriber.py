@@ -0,0 +1,100 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+
+#    http://aws.amazon.com/asl/
+
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+import fakeredis
+from progressmonitor import ProgressTracker, ProgressMonitor, \
+    RedisProgressManager, ChangeSubscriber
+from progressmonitor.helpers.tree_helpers import build_tree
+
+
+def setup_watched_tree(width=3, depth=2, **kwargs):
+    r = fakeredis.FakeStrictRedis()
+    r.flushall()
+    writer = RedisProgressManager(RedisConnection=r, PublishChanges=True)
+    pm = ProgressMonitor(DbConnection=writer, Name='Root')
+    build_tree(pm, width, depth)
+    pm.update_all()
+    reader = RedisProgressManager(RedisConnection=r)
+    t = reader.get_all_by_id(pm.id, kwargs.get('Depth'))
+    sub = ChangeSubscriber(Tracker=t)
+    sub.poll()
+    return pm, reader, t, sub
+
+
+def test_status_and_progress_changes_are_applied():
+    pm, reader, t, sub = setup_watched_tree()
+    leaf = pm.children[1].children[0]
+    leaf.start(Parents=True).with_progress_total(10).inc_progress(3)
+    pm.children[2].children[1].start(Parents=True).succeed()
+    pm.update_all()
+    reader.round_trips = 0
+    assert sub.poll() > 0
+    assert reader.round_trips == 0
+    local = t.find_id(leaf.id)
+    assert local.status == 'In Progress' and local.start_time
+    assert local.get_tracker_progress_total() == (3, 10)
+    assert t.get_tracker_progress_total() == (3, 10)
+    assert t.in_progress_count == 3 and t.succeeded_count == 1
+    assert t.find_id(pm.children[2].children[1].id).is_done
+    sub.close()
+
+
+def test_counts_of_unloaded_trackers_are_applied():
+    pm, reader, t, sub = setup_watched_tree(Depth=0)
+    pm.children[1].children[0].start(Parents=True).succeed()
+    pm.update_all()
+    reader.round_trips = 0
+    sub.poll()
+    assert t.succeeded_count == 1 and t.in_progress_count == 1
+    assert t.not_started_count == 10
+    assert reader.round_trips == 0
+    sub.close()
+
+
+def test_new_trackers_are_loaded_and_attached():
+    pm, reader, t, sub = setup_watched_tree()
+    c = ProgressTracker(Name='new', FriendlyId='new')
+    pm.children[0].with_tracker(c)
+    pm.update_all()
+    sub.poll()
+    assert t.find_friendly_id('new').parent is t.find_id(pm.children[0].id)
+    assert t.all_children_count == 13
+    assert not t.index.dirty
+    sub.close()
+
+
+def test_events_published_by_the_same_driver_are_skipped():
+    pm, reader, t, sub = setup_watched_tree()
+    own = ChangeSubscriber(Tracker=pm)
+    pm.children[0].start(Parents=True)
+    pm.update_all()
+    # the child's status event, the root's, and the child's count event
+    assert own.poll() == 0 and own.stats['received'] == 3
+    assert pm.in_progress_count == 1
+    own.close()
+    sub.close()
+
+
+def test_progress_under_unloaded_children_updates_the_rollup():
+    pm, reader, t, sub = setup_watched_tree(Depth=0)
+    pm.children[2].children[2].with_progress_total(4).inc_progress(1)
+    pm.update_all()
+    sub.poll()
+    assert len(t.loaded_children) == 0
+    assert t.get_tracker_progress_total() == (1, 4)
+    sub.close()
+
+
+def test_nothing_is_published_by_default():
+    r = fakeredis.FakeStrictRedis()
+    r.flushall()
+    rpm = RedisProgressManager(RedisConnection=r)
+    pm = ProgressMonitor(DbConnection=rpm, Name='Root')
+    sub = ChangeSubscriber(Tracker=pm, RedisConnection=r)
+    pm.start().update()
+    assert sub.poll() == 0 and sub.stats['received'] == 0
+    sub.close()
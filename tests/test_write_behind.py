@@ -0,0 +1,201 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+
+#    http://aws.amazon.com/asl/
+
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+import threading
+import time
+import pytest
+import fakeredis
+from progressmonitor import ProgressTracker, ProgressMonitor, \
+    RedisProgressManager, MemoryDriver, WriteBehindDriver, NOT_COUNTED
+
+
+class RecordingDriver(object):
+    def __init__(self):
+        self.batches = []
+        self.gate = threading.Event()
+        self.gate.set()
+        self.fail = False
+        self.failures_left = 0
+
+    def update_trackers(self, trackers):
+        self.gate.wait()
+        if self.fail:
+            raise Exception('unavailable')
+        if self.failures_left:
+            self.failures_left = self.failures_left - 1
+            raise Exception('unavailable')
+        self.batches.append(trackers)
+
+    @property
+    def written(self):
+        return [t for b in self.batches for t in b]
+
+
+def setup_write_behind(**kwargs):
+    d = RecordingDriver()
+    wb = WriteBehindDriver(Driver=d, **kwargs)
+    pm = ProgressMonitor(DbConnection=wb, Name='Root')
+    return d, wb, pm
+
+
+def test_update_all_is_written_by_flush():
+    d, wb, pm = setup_write_behind()
+    pm.with_tracker(ProgressTracker(Name='a'))
+    pm.update_all()
+    assert wb.flush(5)
+    assert sorted([t.name for t in d.written]) == ['Root', 'a']
+    assert wb.stats['flushed'] == 2 and wb.queue_depth == 0
+    wb.close()
+
+
+def test_queued_snapshot_ignores_later_changes():
+    d, wb, pm = setup_write_behind()
+    d.gate.clear()
+    pm.update()
+    pm.with_status_msg('changed')
+    d.gate.set()
+    wb.flush(5)
+    assert d.written[0].status_msg is None
+    wb.close()
+
+
+def test_repeated_updates_are_coalesced():
+    d, wb, pm = setup_write_behind(FlushInterval=5)
+    a = ProgressTracker(Name='a')
+    pm.with_tracker(a)
+    pm.start()
+    a.start().update()
+    a.with_status_msg('half way').update()
+    a.succeed().update()
+    wb.flush(5)
+    written = [t for t in d.written if t.id == a.id]
+    assert len(written) == 1 and written[0].status == 'Succeeded'
+    assert wb.stats['coalesced'] == 2
+    wb.close()
+
+
+def test_conditional_writes_are_refused():
+    with pytest.raises(Exception) as e:
+        WriteBehindDriver(Driver=MemoryDriver(ConditionalWrites=True))
+    assert 'ConditionalWrites' in str(e.value)
+
+
+def test_full_queue_raises_with_raise_policy():
+    d, wb, pm = setup_write_behind(MaxQueueSize=1, Backpressure='raise',
+                                   FlushInterval=5)
+    wb.update_tracker(ProgressTracker(Name='a'))
+    with pytest.raises(Exception) as e:
+        wb.update_tracker(ProgressTracker(Name='b'))
+    assert 'full' in str(e.value)
+    wb.close()
+
+
+def test_full_queue_writes_in_caller_with_sync_policy():
+    d, wb, pm = setup_write_behind(MaxQueueSize=1, Backpressure='sync',
+                                   FlushInterval=5)
+    wb.update_tracker(ProgressTracker(Name='a'))
+    wb.update_tracker(ProgressTracker(Name='b'))
+    assert [t.name for t in d.written] == ['b']
+    wb.close()
+    assert sorted([t.name for t in d.written]) == ['a', 'b']
+
+
+def test_failed_writes_are_counted():
+    d, wb, pm = setup_write_behind(RetryBackoff=.01)
+    d.fail = True
+    pm.update()
+    assert not wb.flush(5)
+    assert wb.stats['failed'] == 1 and wb.stats['flushed'] == 0
+    assert wb.stats['retried'] == 3
+    wb.close()
+
+
+def test_failed_writes_are_retried_until_the_store_recovers():
+    d, wb, pm = setup_write_behind(RetryBackoff=.01)
+    d.failures_left = 2
+    pm.with_tracker(ProgressTracker(Name='a'))
+    pm.update_all()
+    assert wb.flush(5)
+    assert sorted([t.name for t in d.written]) == ['Root', 'a']
+    assert wb.stats['retried'] == 4 and wb.stats['failed'] == 0
+    assert wb.close(5)
+
+
+def test_flush_and_close_report_trackers_that_were_dropped():
+    db = MemoryDriver(FailureRate=1)
+    wb = WriteBehindDriver(Driver=db, MaxRetries=1, RetryBackoff=.01)
+    pm = ProgressMonitor(DbConnection=wb, Name='Root')
+    pm.with_tracker(ProgressTracker(Name='a'))
+    pm.update_all()
+    assert not wb.flush(5)
+    assert wb.stats['failed'] == 2 and db.records == {}
+    # each failure is reported once
+    assert wb.flush(5)
+    pm.with_status_msg('again').update(False)
+    assert not wb.close(5)
+
+
+def test_dropped_writes_leave_their_count_changes_to_the_next_write():
+    db = MemoryDriver(FailureRate=1)
+    wb = WriteBehindDriver(Driver=db, MaxRetries=1, RetryBackoff=.01)
+    pm = ProgressMonitor(DbConnection=wb, Name='Root')
+    a = ProgressTracker(Name='a')
+    pm.with_tracker(a)
+    pm.update_all()
+    assert not wb.flush(5)
+    assert a.counted_status is NOT_COUNTED
+    db.failure_rate = 0
+    a.start(Parents=True).succeed()
+    pm.update_all()
+    assert wb.close(5)
+    assert db.get_all_by_id(pm.id, 0).succeeded_count == 1
+
+
+def test_writes_waiting_on_a_full_queue_fail_when_it_closes():
+    d, wb, pm = setup_write_behind(MaxQueueSize=1, FlushInterval=0)
+    d.gate.clear()
+    wb.update_tracker(ProgressTracker(Name='a'))
+    while not wb.in_flight:
+        time.sleep(.01)
+    wb.update_tracker(ProgressTracker(Name='b'))
+    errors = []
+
+    def blocked():
+        try:
+            wb.update_tracker(ProgressTracker(Name='c'))
+        except Exception as e:
+            errors.append(e)
+    thread = threading.Thread(target=blocked)
+    thread.start()
+    time.sleep(.1)
+    wb.close(.1)
+    thread.join(5)
+    d.gate.set()
+    wb.close(5)
+    assert 'closed' in str(errors[0])
+    assert sorted([t.name for t in d.written]) == ['a', 'b']
+
+
+def test_close_writes_pending_trackers():
+    d, wb, pm = setup_write_behind(FlushInterval=60)
+    pm.update()
+    assert wb.close(5)
+    assert len(d.written) == 1
+    with pytest.raises(Exception):
+        pm.with_status_msg('too late').update()
+
+
+def test_loaded_trees_write_through_the_queue():
+    r = fakeredis.FakeStrictRedis()
+    r.flushall()
+    wb = WriteBehindDriver(Driver=RedisProgressManager(RedisConnection=r))
+    pm = ProgressMonitor(DbConnection=wb, Name='Root')
+    pm.with_tracker(ProgressTracker(Name='a', FriendlyId='a'))
+    pm.update_all()
+    t = wb.get_by_friendly_id('a')
+    assert t.name == 'a' and t.db_conn is wb
+    wb.close()
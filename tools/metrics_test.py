@@ -1,10 +1,10 @@
 import redis
 import time
-from progressinsight import RedisProgressManager, ProgressInsight, ProgressTracker
+from progressmonitor import RedisProgressManager, ProgressMonitor, ProgressTracker
 pool = redis.ConnectionPool(host='localhost', port=6379, db=0)
 r = redis.Redis(connection_pool=pool)
 rpm = RedisProgressManager(RedisConnection=r)
-pm = ProgressInsight(DbConnection=rpm)
+pm = ProgressMonitor(DbConnection=rpm)
 c = ProgressTracker(Name='ConvertVMWorkflow').with_metric(Namespace='test',
                                                           Metric='convert_vm')
 c.metric.with_dimension('linux_flavor', 'redhat') \
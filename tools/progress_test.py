@@ -1,12 +1,12 @@
 import redis
 import random
-from progressinsight import RedisProgressManager, ProgressInsight, ProgressTracker
+from progressmonitor import RedisProgressManager, ProgressMonitor, ProgressTracker
 
 
 pool = redis.ConnectionPool(host='localhost', port=6379, db=0)
 r = redis.Redis(connection_pool=pool)
 rpm = RedisProgressManager(RedisConnection=r)
-pm = ProgressInsight(DbConnection=rpm)
+pm = ProgressMonitor(DbConnection=rpm)
 def create_children(t, n):
     r = random.randint(0, 10)
     i = 0